@@ -319,13 +319,17 @@ def job_config(mpicomm, cases):
         atm_ystep = 10.0
         atm_zstep = 10.0
         atm_nelem_sim_max = 10000
+        atm_rmax = 10000.0
+        atm_step_exponent = 0.5
         atm_wind_dist = 3000.0
         atm_z0_center = 2000.0
         atm_z0_sigma = 0.0
         atm_T0_center = 280.0
         atm_T0_sigma = 10.0
         atm_cache = None
+        atm_cache_size = None
         atm_apply_flags = False
+        atm_table = False
         # Noise simulation options
         simulate_noise = False
         # Gain scrambler
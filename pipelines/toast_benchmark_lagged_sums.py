@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2015-2020 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+"""Benchmark the direct and FFT-based lagged sums of the noise estimation.
+
+Flagged random signals of several lengths are correlated with both
+evaluation methods of toast.fod.lagged_sums for a range of maximum lags.
+The run times show where the FFT evaluation overtakes the direct one,
+which is what FFT_LAG_FACTOR encodes for the automatic method.
+
+"""
+import sys
+import argparse
+import traceback
+
+import numpy as np
+
+from toast.mpi import get_world
+
+from toast.utils import Logger
+
+from toast.timing import Timer
+
+from toast.fod import lagged_sums
+from toast.fod.psd_math import FFT_LAG_FACTOR
+
+
+def time_lagged_sums(x, y, good, lagmax, method, nrepeat):
+    """Return the best run time of one lagged sum evaluation."""
+    timer = Timer()
+    best = None
+    for _ in range(nrepeat):
+        timer.clear()
+        timer.start()
+        lagged_sums(x, y, good, lagmax, method=method)
+        timer.stop()
+        if best is None or timer.seconds() < best:
+            best = timer.seconds()
+    return best
+
+
+def main():
+    log = Logger.get()
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the direct and FFT-based lagged sums"
+    )
+
+    parser.add_argument(
+        "--nsamp",
+        required=False,
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="The interval lengths to benchmark",
+    )
+
+    parser.add_argument(
+        "--lagmax",
+        required=False,
+        type=int,
+        nargs="+",
+        default=[16, 64, 256, 1024, 4096],
+        help="The maximum lags to benchmark",
+    )
+
+    parser.add_argument(
+        "--flag-fraction",
+        required=False,
+        type=float,
+        default=0.1,
+        help="The fraction of randomly flagged samples",
+    )
+
+    parser.add_argument(
+        "--cross",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Benchmark cross correlations instead of auto correlations",
+    )
+
+    parser.add_argument(
+        "--nrepeat",
+        required=False,
+        type=int,
+        default=3,
+        help="The number of repetitions, the best time is reported",
+    )
+
+    try:
+        args = parser.parse_args()
+    except SystemExit:
+        return
+
+    mpiworld, procs, rank = get_world()
+    if rank != 0:
+        return
+
+    np.random.seed(12345)
+    for nsamp in args.nsamp:
+        x = np.random.randn(nsamp)
+        y = None
+        if args.cross:
+            y = np.random.randn(nsamp)
+        good = np.random.rand(nsamp) > args.flag_fraction
+        for lagmax in args.lagmax:
+            if lagmax > nsamp:
+                continue
+            t_direct = time_lagged_sums(x, y, good, lagmax, "direct", args.nrepeat)
+            t_fft = time_lagged_sums(x, y, good, lagmax, "fft", args.nrepeat)
+            if lagmax > FFT_LAG_FACTOR * np.log2(max(2, nsamp + lagmax)):
+                auto = "fft"
+            else:
+                auto = "direct"
+            log.info(
+                "nsamp = {:8}, lagmax = {:5}: direct {:8.4f} s, fft {:8.4f} s, "
+                "auto selects {}".format(nsamp, lagmax, t_direct, t_fft, auto)
+            )
+
+    return
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except:
+        # We have an unhandled exception on at least one process.  Print a stack
+        # trace for this process and then abort so that all processes terminate.
+        mpiworld, procs, rank = get_world()
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        lines = ["Proc {}: {}".format(rank, x) for x in lines]
+        print("".join(lines), flush=True)
+        if mpiworld is not None:
+            mpiworld.Abort(6)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2015-2020 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+"""Benchmark the reduction of distributed sparse observation matrices.
+
+Every process builds a random observation matrix that couples the pixels
+of its own patch of the sky, with a small overlap between neighboring
+processes.  This mimics the mostly disjoint sparsity patterns that
+OpFilterBin accumulates when observations are distributed by detector.
+The matrices are then summed one row slice at a time with the same
+reduction that OpFilterBin._collect_obs_matrix uses.
+
+"""
+import sys
+import argparse
+import traceback
+
+import numpy as np
+import scipy.sparse
+
+from toast.mpi import get_world
+
+from toast.utils import Logger
+
+from toast.timing import Timer
+
+from toast.todmap.filterbin import reduce_csr_slices, OBS_MATRIX_NSLICE
+
+
+def local_obs_matrix(nside, nnz, fsky, overlap, ncoupling, rank, ntask):
+    """Build the random local observation matrix of one process."""
+    npix = 12 * nside ** 2
+    npixtot = npix * nnz
+    npatch = max(1, int(fsky * npix / ntask))
+    nhit = npatch + 2 * overlap
+    hit = (rank * npatch - overlap + np.arange(nhit)) % npix
+    nlocal = nhit * nnz
+    block = scipy.sparse.random(
+        nlocal,
+        nlocal,
+        density=min(1.0, ncoupling / nlocal),
+        format="coo",
+        random_state=rank,
+    )
+    local_to_global = np.hstack([hit + inz * npix for inz in range(nnz)])
+    return scipy.sparse.csr_matrix(
+        (block.data, (local_to_global[block.row], local_to_global[block.col])),
+        shape=(npixtot, npixtot),
+    )
+
+
+def main():
+    log = Logger.get()
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the reduction of distributed sparse matrices"
+    )
+
+    parser.add_argument(
+        "--nside",
+        required=False,
+        type=int,
+        nargs="+",
+        default=[256, 512, 1024],
+        help="The HEALPix resolutions to benchmark",
+    )
+
+    parser.add_argument(
+        "--nnz",
+        required=False,
+        type=int,
+        default=3,
+        help="The number of map components",
+    )
+
+    parser.add_argument(
+        "--fsky",
+        required=False,
+        type=float,
+        default=0.05,
+        help="The sky fraction observed by all processes together",
+    )
+
+    parser.add_argument(
+        "--overlap",
+        required=False,
+        type=int,
+        default=1000,
+        help="The number of pixels shared with each neighboring process",
+    )
+
+    parser.add_argument(
+        "--ncoupling",
+        required=False,
+        type=int,
+        default=100,
+        help="The average number of non-zeros per matrix row",
+    )
+
+    parser.add_argument(
+        "--nslice",
+        required=False,
+        type=int,
+        default=OBS_MATRIX_NSLICE,
+        help="The minimum number of row slices",
+    )
+
+    try:
+        args = parser.parse_args()
+    except SystemExit:
+        return
+
+    mpiworld, procs, rank = get_world()
+
+    for nside in args.nside:
+        matrix = local_obs_matrix(
+            nside, args.nnz, args.fsky, args.overlap, args.ncoupling, rank, procs
+        )
+        nrow = matrix.shape[0]
+        nslice = max(args.nslice, procs)
+        if mpiworld is not None:
+            mpiworld.barrier()
+        timer = Timer()
+        timer.start()
+        nnz = 0
+        for islice, row_start, row_stop, reduced in reduce_csr_slices(
+            mpiworld, lambda start, stop: matrix[start:stop], nrow, nrow, nslice
+        ):
+            nnz += reduced.nnz
+        if mpiworld is not None:
+            mpiworld.barrier()
+            nnz = mpiworld.allreduce(nnz)
+        timer.stop()
+        if rank == 0:
+            log.info(
+                "nside = {:5}, {} processes, {} slices: reduced {} non-zeros in "
+                "{:.2f} s".format(nside, procs, nslice, nnz, timer.seconds())
+            )
+        del matrix
+
+    return
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except:
+        # We have an unhandled exception on at least one process.  Print a stack
+        # trace for this process and then abort so that all processes terminate.
+        mpiworld, procs, rank = get_world()
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        lines = ["Proc {}: {}".format(rank, x) for x in lines]
+        print("".join(lines), flush=True)
+        if mpiworld is not None:
+            mpiworld.Abort(6)
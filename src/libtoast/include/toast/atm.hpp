@@ -178,6 +178,52 @@ int atm_sim_observe(
     double * realization
     );
 
+int atm_sim_observe_many(
+    size_t nsamp,
+    size_t ndet,
+    double * times,
+    double * az,
+    double * el,
+    uint8_t * good,
+    double * tod,
+    double T0,
+    double azmin,
+    double azmax,
+    double elmin,
+    double elmax,
+    double tmin,
+    double tmax,
+    double rmin,
+    double rmax,
+    double fixed_r,
+    double zatm,
+    double zmax,
+    double wx,
+    double wy,
+    double wz,
+    double xstep,
+    double ystep,
+    double zstep,
+    double xstart,
+    double delta_x,
+    double ystart,
+    double delta_y,
+    double zstart,
+    double delta_z,
+    double maxdist,
+    int64_t nn,
+    int64_t nx,
+    int64_t ny,
+    int64_t nz,
+    int64_t xstride,
+    int64_t ystride,
+    int64_t zstride,
+    int64_t nelem,
+    int64_t * compressed_index,
+    int64_t * full_index,
+    double * realization
+    );
+
 void atm_sim_kolmogorov_init_rank(
     int64_t nr,
     double * kolmo_x,
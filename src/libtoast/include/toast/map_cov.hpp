@@ -6,6 +6,9 @@
 #ifndef TOAST_MAP_COV_HPP
 #define TOAST_MAP_COV_HPP
 
+#ifdef _OPENMP
+# include <omp.h>
+#endif // ifdef _OPENMP
 
 namespace toast {
 void cov_accum_diag(int64_t nsub, int64_t subsize, int64_t nnz,
@@ -41,6 +44,74 @@ void cov_mult_diag(int64_t nsub, int64_t subsize, int64_t nnz,
 
 void cov_apply_diag(int64_t nsub, int64_t subsize, int64_t nnz,
                     double const * mat, double * vec);
+
+// Accumulate the diagonal noise products directly from global pixel
+// numbers and native precision pointing weights.  Samples are flagged,
+// translated to local submaps and accumulated in a single pass.  Any of the
+// flag, signal and output pointers may be NULL to skip that part.
+template <typename P, typename W>
+void cov_accum_diag_flagged(int64_t nsub, int64_t subsize, int64_t nnz,
+                            int64_t nsamp, P const * pixels,
+                            W const * weights,
+                            uint8_t const * common_flags, uint8_t common_mask,
+                            uint8_t const * det_flags, uint8_t det_mask,
+                            int64_t const * global2local, double scale,
+                            double const * signal, double * zdata,
+                            int64_t * hits, double * invnpp) {
+    const int64_t block = (int64_t)(nnz * (nnz + 1) / 2);
+    #pragma omp parallel
+    {
+        #ifdef _OPENMP
+        int nthread = omp_get_num_threads();
+        int trank = omp_get_thread_num();
+        int64_t npix_thread = nsub * subsize / nthread + 1;
+        int64_t first_pix = trank * npix_thread;
+        int64_t last_pix = first_pix + npix_thread - 1;
+        #endif // ifdef _OPENMP
+
+        for (int64_t i = 0; i < nsamp; ++i) {
+            const int64_t pixel = static_cast <int64_t> (pixels[i]);
+            if (pixel < 0) continue;
+            if ((common_flags != NULL) && ((common_flags[i] & common_mask) != 0)) {
+                continue;
+            }
+            if ((det_flags != NULL) && ((det_flags[i] & det_mask) != 0)) continue;
+
+            const int64_t submap = pixel / subsize;
+            const int64_t local_submap = global2local[submap];
+            if (local_submap < 0) continue;
+
+            const int64_t hpx = local_submap * subsize + pixel - submap * subsize;
+            #ifdef _OPENMP
+            if ((hpx < first_pix) || (hpx > last_pix)) continue;
+            #endif // ifdef _OPENMP
+
+            W const * wpointer = weights + i * nnz;
+            if (zdata != NULL) {
+                const double scaled_signal = scale * signal[i];
+                double * zpointer = zdata + hpx * nnz;
+                for (int64_t j = 0; j < nnz; ++j) {
+                    zpointer[j] += static_cast <double> (wpointer[j]) * scaled_signal;
+                }
+            }
+            if (invnpp != NULL) {
+                double * covpointer = invnpp + hpx * block;
+                for (int64_t j = 0; j < nnz; ++j) {
+                    const double scaled_weight =
+                        static_cast <double> (wpointer[j]) * scale;
+                    for (int64_t k = j; k < nnz; ++k, ++covpointer) {
+                        *covpointer += static_cast <double> (wpointer[k]) *
+                                       scaled_weight;
+                    }
+                }
+            }
+            if (hits != NULL) {
+                hits[hpx] += 1;
+            }
+        }
+    }
+    return;
+}
 }
 
 #endif // ifndef TOAST_MAP_COV_HPP
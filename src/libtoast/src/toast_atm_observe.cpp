@@ -305,6 +305,17 @@ int toast::atm_sim_observe(
     double sinel0 = sin(el0);
     double cosel0 = cos(el0);
 
+    // Tile the shell [rmin, rmax] with equal steps no longer than xstep and
+    // integrate at the step midpoints, so that nested shells integrate
+    // adjacent, disjoint ranges.  The first xstep is never integrated.
+
+    double rlow = std::max(rmin, xstep);
+    double rstep = xstep;
+    if (rmax > rlow) {
+        double nstep = std::ceil((rmax - rlow) * xstepinv);
+        rstep = (rmax - rlow) / nstep;
+    }
+
     std::ostringstream o;
     o.precision(16);
 
@@ -356,12 +367,14 @@ int toast::atm_sim_observe(
             double sin_az = sin(az_now);
             double cos_az = cos(az_now);
 
-            double r = 1.5 * xstep;
-            double rstep = xstep;
-            while (r < rmin) r += rstep;
+            double r = rlow + 0.5 * rstep;
+            double weight = rstep;
 
             double val = 0;
-            if (fixed_r > 0) r = fixed_r;
+            if (fixed_r > 0) {
+                r = fixed_r;
+                weight = xstep;
+            }
 
             while (true) {
                 if (r > rmax) break;
@@ -481,7 +494,277 @@ int toast::atm_sim_observe(
                 // if ( fixed_r > 0 and r > fixed_r ) break;
             }
 
-            tod[i] = val * rstep * T0;
+            tod[i] = val * weight * T0;
+        }
+    }
+    return error;
+}
+
+int toast::atm_sim_observe_many(
+    size_t nsamp,
+    size_t ndet,
+    double * times,
+    double * az,
+    double * el,
+    uint8_t * good,
+    double * tod,
+    double T0,
+    double azmin,
+    double azmax,
+    double elmin,
+    double elmax,
+    double tmin,
+    double tmax,
+    double rmin,
+    double rmax,
+    double fixed_r,
+    double zatm,
+    double zmax,
+    double wx,
+    double wy,
+    double wz,
+    double xstep,
+    double ystep,
+    double zstep,
+    double xstart,
+    double delta_x,
+    double ystart,
+    double delta_y,
+    double zstart,
+    double delta_z,
+    double maxdist,
+    int64_t nn,
+    int64_t nx,
+    int64_t ny,
+    int64_t nz,
+    int64_t xstride,
+    int64_t ystride,
+    int64_t zstride,
+    int64_t nelem,
+    int64_t * compressed_index,
+    int64_t * full_index,
+    double * realization
+    ) {
+    // Same integration as atm_sim_observe, for several detectors that share
+    // the timestamps.  The pointing and output buffers are detector-major,
+    // (ndet x nsamp).  Samples with zero `good` are not observed and their
+    // output is left untouched.
+    //
+    // Every thread integrates all detectors of one sample at a time.  The
+    // wind shift is computed once per sample and the detectors are stepped
+    // along their lines of sight together, so neighboring detectors reuse
+    // the interpolation nodes looked up for the previous detector.
+
+    double zatm_inv = 1.0 / zatm;
+
+    double xstepinv = 1.0 / xstep;
+    double ystepinv = 1.0 / ystep;
+    double zstepinv = 1.0 / zstep;
+
+    double delta_az = (azmax - azmin);
+    double delta_el = (elmax - elmin);
+    double delta_t = tmax - tmin;
+
+    double az0 = azmin + delta_az / 2;
+    double el0 = elmin + delta_el / 2;
+    double sinel0 = sin(el0);
+    double cosel0 = cos(el0);
+    double sin_el_max = sin(elmax);
+
+    // Tile the shell [rmin, rmax] with equal steps no longer than xstep and
+    // integrate at the step midpoints, so that nested shells integrate
+    // adjacent, disjoint ranges.  The first xstep is never integrated.
+
+    double rlow = std::max(rmin, xstep);
+    double rstep = xstep;
+    if (rmax > rlow) {
+        double nstep = std::ceil((rmax - rlow) * xstepinv);
+        rstep = (rmax - rlow) / nstep;
+    }
+
+    // Detector states during the integration of one sample
+
+    const uint8_t state_skip = 0;
+    const uint8_t state_active = 1;
+    const uint8_t state_failed = 2;
+
+    std::ostringstream o;
+    o.precision(16);
+
+    int error = 0;
+
+    # pragma omp parallel
+    {
+        std::vector <int64_t> last_ind(3);
+        std::vector <double> last_nodes(8);
+
+        std::vector <uint8_t> state(ndet);
+        std::vector <double> val(ndet);
+        std::vector <double> sin_el(ndet);
+        std::vector <double> cos_el(ndet);
+        std::vector <double> sin_az(ndet);
+        std::vector <double> cos_az(ndet);
+
+        # pragma omp for schedule(static, 100)
+        for (size_t i = 0; i < nsamp; ++i) {
+            double t_now = times[i] - tmin;
+
+            double xtel_now = wx * t_now;
+            double ytel_now = wy * t_now;
+            double ztel_now = wz * t_now;
+
+            size_t nactive = 0;
+            for (size_t idet = 0; idet < ndet; ++idet) {
+                size_t j = idet * nsamp + i;
+                state[idet] = state_skip;
+                if (good[j] == 0) continue;
+                if ((!((azmin <= az[j]) && (az[j] <= azmax)) &&
+                     !((azmin <= az[j] - 2 * M_PI) && (az[j] - 2 * M_PI <= azmax)))
+                    || !((elmin <= el[j]) && (el[j] <= elmax))) {
+                # pragma omp flush(error)
+                    if (error == 0) {
+                        if (atm_verbose()) {
+                            o.str("");
+                            o <<
+                                "atm_sim_observe_many : observation out of bounds "
+                              << "(az, el, t) = (" << az[j] << ",  " << el[j]
+                              << ", " << times[i] << ") allowed: ("
+                              << azmin << " - " << azmax << ", "
+                              << elmin << " - " << elmax << ", "
+                              << tmin << " - " << tmax << ")";
+                            auto & logger = toast::Logger::get();
+                            logger.warning(o.str().c_str());
+                        }
+                        error = 1;
+                    # pragma omp flush(error)
+                    }
+                    continue;
+                }
+                double az_now = az[j] - az0; // Relative to center of field
+                sin_el[idet] = sin(el[j]);
+                cos_el[idet] = cos(el[j]);
+                sin_az[idet] = sin(az_now);
+                cos_az[idet] = cos(az_now);
+                val[idet] = 0;
+                state[idet] = state_active;
+                ++nactive;
+            }
+            if (nactive == 0) continue;
+
+            double r = rlow + 0.5 * rstep;
+            double weight = rstep;
+
+            if (fixed_r > 0) {
+                r = fixed_r;
+                weight = xstep;
+            }
+
+            while (true) {
+                if (r > rmax) break;
+
+                // Check if the top of the focal plane hits zmax at
+                // this distance.  This way all lines-of-sight get
+                // integrated to the same distance
+                if (r * sin_el_max >= zmax) break;
+
+                for (size_t idet = 0; idet < ndet; ++idet) {
+                    if (state[idet] != state_active) continue;
+
+                    // Horizontal coordinates
+
+                    double zz = r * sin_el[idet];
+                    double rproj = r * cos_el[idet];
+                    double xx = rproj * cos_az[idet];
+                    double yy = rproj * sin_az[idet];
+
+                    // Rotate to scan frame and translate by the wind
+
+                    double x = xx * cosel0 + zz * sinel0 + xtel_now;
+                    double y = yy + ytel_now;
+                    double z = -xx * sinel0 + zz * cosel0 + ztel_now;
+
+# ifndef NO_ATM_CHECKS
+                    if ((x < xstart) || (x > xstart + delta_x) ||
+                        (y < ystart) || (y > ystart + delta_y) ||
+                        (z < zstart) || (z > zstart + delta_z)) {
+                    #  pragma omp flush (error)
+                        if (error == 0) {
+                            if (atm_verbose()) {
+                                o.str("");
+                                o << "atm_sim_observe_many : (x,y,z) out of bounds: "
+                                  << std::endl
+                                  << "x = " << x << std::endl
+                                  << "y = " << y << std::endl
+                                  << "z = " << z << std::endl;
+                                auto & logger = toast::Logger::get();
+                                logger.warning(o.str().c_str());
+                            }
+                            error = 1;
+                        #  pragma omp flush (error)
+                        }
+                        val[idet] = 0;
+                        state[idet] = state_failed;
+                        continue;
+                    }
+# endif // ifndef NO_ATM_CHECKS
+
+                    // Combine atmospheric emission (via interpolation) with the
+                    // ambient temperature.
+                    // Note that the r^2 (beam area) and 1/r^2 (source
+                    // distance) factors cancel in the integral.
+
+                    double step_val;
+                    try {
+                        step_val = toast::atm_sim_interp(
+                            x, y, z, last_ind, last_nodes,
+                            xstart, ystart, zstart,
+                            nn, nx, ny, nz,
+                            xstride, ystride, zstride,
+                            xstep, ystep, zstep,
+                            xstepinv, ystepinv, zstepinv,
+                            t_now, delta_t, delta_az, elmin, elmax,
+                            wx, wy, wz,
+                            maxdist, cosel0, sinel0,
+                            nelem, compressed_index, full_index,
+                            realization
+                            ) * (1. - z * zatm_inv);
+                    } catch (const std::runtime_error & e) {
+                        # pragma omp flush(error)
+                        if (error == 0) {
+                            if (atm_verbose()) {
+                                o.str("");
+                                o << "atm_sim_observe_many : interp failed at "
+                                  << std::endl
+                                  << "xyz = (" << x << ", " << y << ", " << z << ")"
+                                  << std::endl
+                                  << "r = " << r << std::endl
+                                  << "( t, det ) = " << "( " << t_now << ", "
+                                  << idet << ")" << " with "
+                                  << std::endl << e.what() << std::endl;
+                                auto & logger = toast::Logger::get();
+                                logger.warning(o.str().c_str());
+                            }
+                            error = 1;
+                        # pragma omp flush(error)
+                        }
+                        val[idet] = 0;
+                        state[idet] = state_failed;
+                        continue;
+                    }
+                    val[idet] += step_val;
+                }
+
+                // Prepare for the next step
+
+                r += rstep;
+
+                if (fixed_r > 0) break;
+            }
+
+            for (size_t idet = 0; idet < ndet; ++idet) {
+                if (state[idet] == state_skip) continue;
+                tod[idet * nsamp + i] = val[idet] * weight * T0;
+            }
         }
     }
     return error;
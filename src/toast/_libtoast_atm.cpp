@@ -329,6 +329,148 @@ void init_atm(py::module & m) {
      Internal function used by AtmSim class.
     )");
 
+    m.def("atm_sim_observe_many",
+          [](
+              py::buffer times,
+              py::buffer az,
+              py::buffer el,
+              py::buffer good,
+              py::buffer tod,
+              double T0,
+              double azmin,
+              double azmax,
+              double elmin,
+              double elmax,
+              double tmin,
+              double tmax,
+              double rmin,
+              double rmax,
+              double fixed_r,
+              double zatm,
+              double zmax,
+              double wx,
+              double wy,
+              double wz,
+              double xstep,
+              double ystep,
+              double zstep,
+              double xstart,
+              double delta_x,
+              double ystart,
+              double delta_y,
+              double zstart,
+              double delta_z,
+              double maxdist,
+              int64_t nx,
+              int64_t ny,
+              int64_t nz,
+              int64_t xstride,
+              int64_t ystride,
+              int64_t zstride,
+              py::buffer compressed_index,
+              py::buffer full_index,
+              py::buffer realization
+              ) {
+              pybuffer_check_1D <double> (times);
+              pybuffer_check_1D <double> (az);
+              pybuffer_check_1D <double> (el);
+              pybuffer_check_1D <uint8_t> (good);
+              pybuffer_check_1D <double> (tod);
+              pybuffer_check_1D <int64_t> (compressed_index);
+              pybuffer_check_1D <int64_t> (full_index);
+              pybuffer_check_1D <double> (realization);
+              py::buffer_info info_times = times.request();
+              py::buffer_info info_az = az.request();
+              py::buffer_info info_el = el.request();
+              py::buffer_info info_good = good.request();
+              py::buffer_info info_tod = tod.request();
+              py::buffer_info info_comp_index = compressed_index.request();
+              py::buffer_info info_full_index = full_index.request();
+              py::buffer_info info_realiz = realization.request();
+              int64_t nsamp = info_times.size;
+              int64_t ndet = 0;
+              if (nsamp > 0) {
+                  ndet = info_tod.size / nsamp;
+              }
+              if ((info_tod.size != ndet * nsamp) || (info_az.size != ndet * nsamp)
+                  || (info_el.size != ndet * nsamp)
+                  || (info_good.size != ndet * nsamp)) {
+                  auto log = toast::Logger::get();
+                  std::ostringstream o;
+                  o << "time domain buffer sizes are not consistent.";
+                  log.error(o.str().c_str());
+                  throw std::runtime_error(o.str().c_str());
+              }
+              int64_t nelem = info_realiz.size;
+              if (info_full_index.size != nelem) {
+                  auto log = toast::Logger::get();
+                  std::ostringstream o;
+                  o << "full_index and realization sizes are not consistent.";
+                  log.error(o.str().c_str());
+                  throw std::runtime_error(o.str().c_str());
+              }
+              int64_t nn = info_comp_index.size;
+              double * raw_times = reinterpret_cast <double *> (info_times.ptr);
+              double * raw_az = reinterpret_cast <double *> (info_az.ptr);
+              double * raw_el = reinterpret_cast <double *> (info_el.ptr);
+              uint8_t * raw_good = reinterpret_cast <uint8_t *> (info_good.ptr);
+              double * raw_tod = reinterpret_cast <double *> (info_tod.ptr);
+              double * raw_realiz = reinterpret_cast <double *> (info_realiz.ptr);
+              int64_t * raw_full = reinterpret_cast <int64_t *> (info_full_index.ptr);
+              int64_t * raw_comp = reinterpret_cast <int64_t *> (info_comp_index.ptr);
+              int status = toast::atm_sim_observe_many(
+                  nsamp,
+                  ndet,
+                  raw_times,
+                  raw_az,
+                  raw_el,
+                  raw_good,
+                  raw_tod,
+                  T0,
+                  azmin,
+                  azmax,
+                  elmin,
+                  elmax,
+                  tmin,
+                  tmax,
+                  rmin,
+                  rmax,
+                  fixed_r,
+                  zatm,
+                  zmax,
+                  wx,
+                  wy,
+                  wz,
+                  xstep,
+                  ystep,
+                  zstep,
+                  xstart,
+                  delta_x,
+                  ystart,
+                  delta_y,
+                  zstart,
+                  delta_z,
+                  maxdist,
+                  nn,
+                  nx,
+                  ny,
+                  nz,
+                  xstride,
+                  ystride,
+                  zstride,
+                  nelem,
+                  raw_comp,
+                  raw_full,
+                  raw_realiz
+                  );
+              return status;
+          }, R"(
+     Internal function used by AtmSim class.
+
+     The pointing, flag and output buffers are flattened (ndet x nsamp)
+     arrays that share the nsamp timestamps.
+    )");
+
     m.def("atm_sim_compress_flag_hits_rank",
           [](
               py::buffer hit,
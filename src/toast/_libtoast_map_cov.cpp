@@ -6,6 +6,82 @@
 #include <_libtoast.hpp>
 
 
+template <typename P, typename W>
+void cov_accum_diag_flagged(int64_t nsub, int64_t nsubpix, int64_t nnz,
+                            py::array_t <P, py::array::c_style> pixels,
+                            py::array_t <W, py::array::c_style> weights,
+                            py::buffer common_flags, uint8_t common_mask,
+                            py::buffer det_flags, uint8_t det_mask,
+                            py::buffer global2local, double scale,
+                            py::buffer tod, py::buffer invnpp, py::buffer hits,
+                            py::buffer zmap) {
+    auto & gt = toast::GlobalTimers::get();
+    gt.start("cov_accum_diag_flagged");
+    pybuffer_check_1D <uint8_t> (common_flags);
+    pybuffer_check_1D <uint8_t> (det_flags);
+    pybuffer_check_1D <int64_t> (global2local);
+    pybuffer_check_1D <double> (tod);
+    pybuffer_check_1D <double> (invnpp);
+    pybuffer_check_1D <int64_t> (hits);
+    pybuffer_check_1D <double> (zmap);
+    py::buffer_info info_pixels = pixels.request();
+    py::buffer_info info_weights = weights.request();
+    py::buffer_info info_common = common_flags.request();
+    py::buffer_info info_det = det_flags.request();
+    py::buffer_info info_g2l = global2local.request();
+    py::buffer_info info_tod = tod.request();
+    py::buffer_info info_invnpp = invnpp.request();
+    py::buffer_info info_hits = hits.request();
+    py::buffer_info info_zmap = zmap.request();
+    size_t nsamp = info_pixels.size;
+    size_t nw = (size_t)(info_weights.size / nnz);
+
+    // Empty buffers disable the corresponding flags and products.  The
+    // weights are not needed for the hit map alone.
+    bool need_weights = (info_zmap.size != 0) || (info_invnpp.size != 0);
+    if ((need_weights && (nw != nsamp)) ||
+        ((info_common.size != 0) && (info_common.size != nsamp)) ||
+        ((info_det.size != 0) && (info_det.size != nsamp)) ||
+        ((info_zmap.size != 0) && (info_tod.size != nsamp))) {
+        auto log = toast::Logger::get();
+        std::ostringstream o;
+        o << "Buffer sizes are not consistent.";
+        log.error(o.str().c_str());
+        throw std::runtime_error(o.str().c_str());
+    }
+    uint8_t * rawcommon = NULL;
+    if (info_common.size != 0) {
+        rawcommon = reinterpret_cast <uint8_t *> (info_common.ptr);
+    }
+    uint8_t * rawdet = NULL;
+    if (info_det.size != 0) {
+        rawdet = reinterpret_cast <uint8_t *> (info_det.ptr);
+    }
+    double * rawzmap = NULL;
+    if (info_zmap.size != 0) {
+        rawzmap = reinterpret_cast <double *> (info_zmap.ptr);
+    }
+    int64_t * rawhits = NULL;
+    if (info_hits.size != 0) {
+        rawhits = reinterpret_cast <int64_t *> (info_hits.ptr);
+    }
+    double * rawinvnpp = NULL;
+    if (info_invnpp.size != 0) {
+        rawinvnpp = reinterpret_cast <double *> (info_invnpp.ptr);
+    }
+    toast::cov_accum_diag_flagged <P, W> (
+        nsub, nsubpix, nnz, nsamp,
+        reinterpret_cast <P *> (info_pixels.ptr),
+        reinterpret_cast <W *> (info_weights.ptr),
+        rawcommon, common_mask, rawdet, det_mask,
+        reinterpret_cast <int64_t *> (info_g2l.ptr), scale,
+        reinterpret_cast <double *> (info_tod.ptr), rawzmap, rawhits,
+        rawinvnpp);
+    gt.stop("cov_accum_diag_flagged");
+    return;
+}
+
+
 void init_map_cov(py::module & m) {
     m.def("cov_accum_diag",
           [](int64_t nsub, int64_t nsubpix, int64_t nnz, py::buffer submap,
@@ -83,6 +159,54 @@ void init_map_cov(py::module & m) {
 
     )");
 
+    // Register the pixel and weight types produced by the pointing
+    // operators.  The exact types are matched before any conversion.
+    m.def("cov_accum_diag_flagged", &cov_accum_diag_flagged <int64_t, double>,
+          py::arg("nsub"), py::arg("nsubpix"), py::arg("nnz"), py::arg("pixels"),
+          py::arg("weights"), py::arg("common_flags"), py::arg("common_mask"),
+          py::arg("det_flags"), py::arg("det_mask"), py::arg("global2local"),
+          py::arg("scale"), py::arg("tod"), py::arg("invnpp"), py::arg("hits"),
+          py::arg(
+              "zmap"), R"(
+        Accumulate block diagonal noise products from global pixels.
+
+        This applies the flags, translates the global pixel numbers into
+        local submaps and accumulates the local pieces of the inverse diagonal
+        pixel covariance, hits, and noise weighted map in a single pass.  The
+        pixels and weights are used in their native precision.
+
+        Args:
+            nsub (int):  The number of locally stored submaps.
+            nsubpix (int):  The number of pixels in each submap.
+            nnz (int):  The number of non-zeros in each row of the pointing matrix.
+            pixels (array, int64 or int32):  The global pixel index of each
+                time domain sample.  Negative indices are skipped.
+            weights (array, float64 or float32):  The pointing matrix weights
+                for each time sample and map.
+            common_flags (array, uint8):  Common flags or an empty array.
+            common_mask (uint8):  Bit mask applied to the common flags.
+            det_flags (array, uint8):  Detector flags or an empty array.
+            det_mask (uint8):  Bit mask applied to the detector flags.
+            global2local (array, int64):  The local submap for each global
+                submap (-1 if not local).
+            scale (float):  Optional scaling factor.
+            tod (array, float64):  The timestream to accumulate in the noise
+                weighted map or an empty array.
+            invnpp (array, float64):  The local buffer of diagonal inverse pixel
+                covariances, stored as the lower triangle for each pixel, or
+                an empty array.
+            hits (array, int64):  The local hitmap buffer or an empty array.
+            zmap (array, float64):  The local noise weighted map buffer or an
+                empty array.
+
+        Returns:
+            None.
+
+    )");
+    m.def("cov_accum_diag_flagged", &cov_accum_diag_flagged <int32_t, float>);
+    m.def("cov_accum_diag_flagged", &cov_accum_diag_flagged <int64_t, float>);
+    m.def("cov_accum_diag_flagged", &cov_accum_diag_flagged <int32_t, double>);
+
     m.def("cov_accum_diag_hits",
           [](int64_t nsub, int64_t nsubpix, int64_t nnz, py::buffer submap,
              py::buffer subpix, py::buffer hits) {
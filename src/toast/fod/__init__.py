@@ -2,6 +2,6 @@
 # All rights reserved.  Use of this source code is governed by
 # a BSD-style license that can be found in the LICENSE file.
 
-from .psd_math import autocov_psd, crosscov_psd
+from .psd_math import autocov_psd, crosscov_psd, lagged_sums
 
-from .noise_estimation import OpNoiseEstim
+from .noise_estimation import OpNoiseEstim, load_noise_model
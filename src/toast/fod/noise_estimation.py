@@ -2,8 +2,6 @@
 # All rights reserved.  Use of this source code is governed by
 # a BSD-style license that can be found in the LICENSE file.
 
-import copy
-
 import os
 
 import numpy as np
@@ -12,13 +10,15 @@ import scipy.signal
 
 import astropy.io.fits as pf
 
+import h5py
+
 from .. import qarray as qa
 
 from ..timing import Timer, function_timer
 
 from ..todmap import MapSampler
 
-from ..tod import flagged_running_average, Interval
+from ..tod import flagged_running_average, Interval, Noise
 
 from .psd_math import autocov_psd, crosscov_psd
 
@@ -26,12 +26,20 @@ from .psd_math import autocov_psd, crosscov_psd
 class OpNoiseEstim:
     """Noise estimation operator.
 
+    The data may be distributed by detector and by time.  Detector pairs
+    are divided between the process rows of the TOD grid and detectors
+    owned by another row are communicated on demand.  The binning and
+    outlier rejection of each pair happen on one process of the row that
+    estimated it and all pairs of an observation are written into a single
+    HDF5 file, `<out>/noise_<obs>.h5`, that `load_noise_model` reads back
+    as a `toast.tod.Noise` object.
+
     Args:
         signal(str):  Cache object name to analyze
         flags(str):  Cached flags to apply
         detmask(byte):  Flag bits to consider
         commonmask(byte):  Flag bits to consider
-        out(str):  Output directory to write the PSDs to.
+        out(str):  Output directory to write the noise model to.
         maskfile(str):  FITS file name to read the mask from.
         mapfile(str):  FITS map to sample and subtract from the signal.
         pol(bool):  Sample also the polarized part of the map.
@@ -50,6 +58,8 @@ class OpNoiseEstim:
         pairs(iterable):  Detector pairs to estimate noise for.  Overrides
             nosingle and nocross.
         save_cov(bool):  Save also the sample covariance.
+        fits_per_pair(bool):  Also write the binned PSDs of every pair into
+            a separate FITS file.
 
     """
 
@@ -74,6 +84,7 @@ class OpNoiseEstim:
         apply_intervals=False,
         pairs=None,
         save_cov=False,
+        fits_per_pair=False,
     ):
         self._signal = signal
         self._flags = flags
@@ -95,6 +106,7 @@ class OpNoiseEstim:
         self._nsum = nsum
         self._naverage = naverage
         self._save_cov = save_cov
+        self._fits_per_pair = fits_per_pair
 
     @function_timer
     def exec(self, data):
@@ -109,10 +121,6 @@ class OpNoiseEstim:
 
         for obs in data.obs:
             tod = obs["tod"]
-            if len(tod.local_dets) < len(tod.detectors):
-                raise RuntimeError(
-                    "Noise estimation does not work on " "detector-split data"
-                )
             dets = {}
             for idet, det in enumerate(tod.detectors):
                 dets[det] = idet
@@ -179,42 +187,224 @@ class OpNoiseEstim:
                     gap_stop_nsum = min(offset + nsamp, gap_stop_nsum - offset)
                     gapflags_nsum[gap_start:gap_stop_nsum] = True
 
-            # FIXME: This operator needs to handle situations where
-            # det1 and det2 are not on the same process.  Then the
-            # check at the top of the loop can be removed.
+            # Detector pairs are distributed across the process rows of
+            # the TOD grid.  Every process in a row handles the same pairs
+            # and shares the time-domain work through the row communicator.
 
-            for det1, det2 in pairs:
-                if det1 not in dets or det2 not in dets:
-                    # User-specified pair is invalid
-                    continue
-                signal1 = tod.local_signal(det1)
-                flags1 = tod.local_flags(det1, name=self._flags)
-                flags = flags1 & self._detmask != 0
-                signal2 = None
-                flags2 = None
-                if det1 != det2:
-                    signal2 = tod.local_signal(det2)
-                    flags2 = tod.local_flags(det2, name=self._flags)
-                    flags[flags2 & self._detmask != 0] = True
-                flags[commonflags] = True
-
-                self.process_noise_estimate(
-                    signal1,
-                    signal2,
-                    flags,
-                    gapflags,
-                    gapflags_nsum,
-                    timestamps,
-                    fsample,
-                    comm,
-                    fileroot,
-                    det1,
-                    det2,
-                    intervals,
+            time_comm = None
+            if tod.mpicomm is not None:
+                time_comm = tod.grid_comm_row
+            owner, plan = self._distribute_pairs(tod, pairs)
+            remotes = [[det for det in x if det is not None] for x in plan]
+            my_plan = plan[tod.grid_ranks[0]]
+
+            args = (
+                commonflags,
+                gapflags,
+                gapflags_nsum,
+                timestamps,
+                fsample,
+                time_comm,
+                fileroot,
+                intervals,
+            )
+
+            # The post-processing of consecutive pairs is assigned to
+            # consecutive processes in the row.
+
+            row_size = 1
+            if time_comm is not None:
+                row_size = time_comm.size
+            results = []
+            ipair = 0
+
+            # Pairs with both detectors on this process
+
+            for det1, det2 in my_plan.get(None, []):
+                result = self._estimate_pair(
+                    tod, det1, det2, None, ipair % row_size, *args
                 )
+                if result is not None:
+                    results.append(result)
+                ipair += 1
+
+            # Pairs that need a detector from another process row.  Each
+            # remote detector is fetched once and used for all of its pairs.
+
+            nround = max([len(x) for x in remotes])
+            for iround in range(nround):
+                remote = self._fetch_remote(tod, owner, remotes, iround)
+                if remote is None:
+                    continue
+                for det1, det2 in my_plan[remote[0]]:
+                    result = self._estimate_pair(
+                        tod, det1, det2, remote, ipair % row_size, *args
+                    )
+                    if result is not None:
+                        results.append(result)
+                    ipair += 1
+                del remote
+
+            if self._out is not None:
+                fname = os.path.join(self._out, "{}.h5".format(fileroot))
+                self.save_noise_model(comm, fname, results, fsample)
+            del results
 
         return
 
+    def _distribute_pairs(self, tod, pairs):
+        """Assign detector pairs to the process rows of the TOD grid.
+
+        Every pair is assigned to a process row that owns at least one of
+        its detectors, balancing the number of pairs per row.  The
+        assignment is deterministic so all processes agree on it without
+        further communication.
+
+        Args:
+            tod (TOD):  The TOD to analyze.
+            pairs (iterable):  Detector pairs.
+
+        Returns:
+            (tuple):  Dictionary of detector owners and, for every process
+                row, a dictionary of pairs keyed by the remote detector they
+                need (None for pairs that are entirely local).
+
+        """
+        det_comm = tod.grid_comm_col
+        if tod.mpicomm is None or det_comm is None:
+            all_dets = [tod.local_dets]
+        else:
+            all_dets = det_comm.allgather(tod.local_dets)
+        owner = {}
+        for rank, dets in enumerate(all_dets):
+            for det in dets:
+                owner[det] = rank
+        load = np.zeros(len(all_dets), dtype=np.int64)
+        plan = [dict() for _ in all_dets]
+        for det1, det2 in pairs:
+            if det1 not in owner or det2 not in owner:
+                # User-specified pair is invalid
+                continue
+            owner1 = owner[det1]
+            owner2 = owner[det2]
+            if owner1 == owner2:
+                target, remote = owner1, None
+            elif load[owner1] <= load[owner2]:
+                target, remote = owner1, det2
+            else:
+                target, remote = owner2, det1
+            load[target] += 1
+            plan[target].setdefault(remote, []).append((det1, det2))
+        return owner, plan
+
+    def _fetch_remote(self, tod, owner, remotes, iround):
+        """Exchange one round of remote detector data.
+
+        In every round each process row receives at most one detector
+        from the row that owns it.
+
+        Args:
+            tod (TOD):  The TOD to analyze.
+            owner (dict):  Process row owning each detector.
+            remotes (list):  Remote detectors needed by each process row.
+            iround (int):  Exchange round.
+
+        Returns:
+            (tuple):  The received detector name, signal and flags, or None
+                if this process does not receive anything in this round.
+
+        """
+        det_comm = tod.grid_comm_col
+        my_rank = tod.grid_ranks[0]
+        nsamp = tod.local_samples[1]
+        requests = []
+        for rank, dets in enumerate(remotes):
+            if iround >= len(dets):
+                continue
+            det = dets[iround]
+            if owner[det] != my_rank:
+                continue
+            signal = np.ascontiguousarray(
+                tod.local_signal(det, name=self._signal), dtype=np.float64
+            )
+            flags = tod.local_flags(det, name=self._flags) & self._detmask != 0
+            flags = flags.astype(np.uint8)
+            requests.append((det_comm.Isend(signal, dest=rank, tag=0), signal))
+            requests.append((det_comm.Isend(flags, dest=rank, tag=1), flags))
+        result = None
+        my_remotes = remotes[my_rank]
+        if iround < len(my_remotes):
+            det = my_remotes[iround]
+            signal = np.empty(nsamp, dtype=np.float64)
+            flags = np.empty(nsamp, dtype=np.uint8)
+            det_comm.Recv(signal, source=owner[det], tag=0)
+            det_comm.Recv(flags, source=owner[det], tag=1)
+            result = (det, signal, flags != 0)
+        for request, _ in requests:
+            request.wait()
+        return result
+
+    def _estimate_pair(
+        self,
+        tod,
+        det1,
+        det2,
+        remote,
+        root,
+        commonflags,
+        gapflags,
+        gapflags_nsum,
+        timestamps,
+        fsample,
+        comm,
+        fileroot,
+        intervals,
+    ):
+        """Estimate the noise spectrum of one detector pair.
+
+        The covariance is evaluated separately for every pair.  The pair
+        flags combine the flags of both detectors, so the prewhitening
+        filter and the lagged sums differ between pairs even when they
+        share a detector.  Only the communication of the remote signal is
+        shared across the pairs that need it.
+
+        Returns:
+            (dict):  The binned PSDs on process `root` of `comm`, None
+                elsewhere.
+
+        """
+
+        def get_data(det):
+            if remote is not None and remote[0] == det:
+                return remote[1], remote[2]
+            signal = tod.local_signal(det, name=self._signal)
+            flags = tod.local_flags(det, name=self._flags) & self._detmask != 0
+            return signal, flags
+
+        signal1, flags1 = get_data(det1)
+        flags = flags1.copy()
+        signal2 = None
+        if det1 != det2:
+            signal2, flags2 = get_data(det2)
+            flags[flags2] = True
+        flags[commonflags] = True
+
+        return self.process_noise_estimate(
+            signal1,
+            signal2,
+            flags,
+            gapflags,
+            gapflags_nsum,
+            timestamps,
+            fsample,
+            comm,
+            fileroot,
+            det1,
+            det2,
+            intervals,
+            root=root,
+        )
+
     def highpass_signal(self, tod, comm, intervals):
         """Suppress the sub-harmonic modes in the TOD by high-pass
         filtering.
@@ -352,9 +542,7 @@ class OpNoiseEstim:
         bins[-1] *= 1.01  # Widen the last bin not to have a bin with one entry
 
         locs = np.digitize(freq, bins).astype(np.int32)
-        hits = np.zeros(nbin + 2, dtype=np.int32)
-        for loc in locs:
-            hits[loc] += 1
+        hits = np.bincount(locs, minlength=nbin + 2).astype(np.int32)
         return locs, hits
 
     def bin_psds(self, my_psds, fmin=None, fmax=None):
@@ -371,9 +559,7 @@ class OpNoiseEstim:
                 locs, hits = self.log_bin(
                     freq[good], nbin=self._nbin_psd, fmin=fmin, fmax=fmax
                 )
-                binfreq = np.zeros(hits.size)
-                for loc, f in zip(locs, freq[good]):
-                    binfreq[loc] += f
+                binfreq = np.bincount(locs, weights=freq[good], minlength=hits.size)
                 binfreq = binfreq[hits != 0] / hits[hits != 0]
             else:
                 binfreq = freq
@@ -386,9 +572,7 @@ class OpNoiseEstim:
                     raise Exception("Binned PSD frequencies change")
 
             if self._nbin_psd is not None:
-                binpsd = np.zeros(hits.size)
-                for loc, p in zip(locs, psd[good]):
-                    binpsd[loc] += p
+                binpsd = np.bincount(locs, weights=psd[good], minlength=hits.size)
                 binpsd = binpsd[hits != 0] / hits[hits != 0]
             else:
                 binpsd = psd
@@ -397,78 +581,77 @@ class OpNoiseEstim:
             my_binned_psds.append(binpsd)
         return my_binned_psds, my_times, binfreq0
 
-    def discard_outliers(self, binfreq, all_psds, all_times, all_cov):
-        all_psds = copy.deepcopy(all_psds)
-        all_times = copy.deepcopy(all_times)
-        if self._save_cov:
-            all_cov = copy.deepcopy(all_cov)
+    def flag_outliers(self, binfreq, psds):
+        """Identify empty and outlier PSDs.
 
-        nrow, ncol = np.shape(all_psds)
+        The local (running median) and global outlier tests are applied to
+        all frequency bins at once.
 
-        # Discard empty PSDs
+        Args:
+            binfreq (array):  Binned frequencies.
+            psds (array):  Binned PSDs, one row per stationary period.
 
-        i = 1
-        nempty = 0
-        while i < nrow:
-            p = all_psds[i]
-            if np.all(p == 0) or np.any(np.isnan(p)):
-                del all_psds[i]
-                del all_times[i]
-                if self._save_cov:
-                    del all_cov[i]
-                nrow -= 1
-                nempty += 1
-            else:
-                i += 1
+        Returns:
+            (tuple):  Boolean arrays flagging the empty and the outlier
+                PSDs.
 
-        if nempty > 0:
-            print("Discarded {} empty or NaN psds".format(nempty), flush=True)
+        """
+        nrow, ncol = psds.shape
+        empty = np.logical_or(np.all(psds == 0, axis=1), np.any(np.isnan(psds), axis=1))
+        outlier = np.zeros(nrow, dtype=bool)
+        valid = np.logical_not(empty)
+        if np.sum(valid) < 10:
+            return empty, outlier
 
         # Throw away outlier PSDs by comparing the PSDs in specific bins
 
-        if nrow < 10:
-            nbad = 0
-        else:
-            all_good = np.isfinite(np.sum(all_psds, 1))
-            for col in range(ncol - 1):
-                if binfreq[col] < 0.001:
-                    continue
-
-                # Local outliers
-
-                psdvalues = np.array([x[col] for x in all_psds])
-                smooth_values = scipy.signal.medfilt(psdvalues, 11)
-                good = np.ones(psdvalues.size, dtype=bool)
-                good[psdvalues == 0] = False
-
+        values = psds[valid]
+        bad = np.logical_not(np.isfinite(np.sum(values, 1)))
+        cols = np.arange(ncol - 1)[binfreq[: ncol - 1] >= 0.001]
+        if cols.size > 0:
+            values = values[:, cols]
+            smooth_values = scipy.signal.medfilt(values, [11, 1])
+            good = values != 0
+
+            def masked_std(x):
+                # Standard deviation of the good entries in each column.
+                # `x` is zero for the bad entries.
+                ngood = np.sum(good, axis=0)
+                mean = np.sum(x, axis=0) / ngood
+                return np.sqrt(np.sum(((x - mean) * good) ** 2, axis=0) / ngood)
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                log_values = np.log(np.where(good, values, 1))
+                log_smooth = np.log(smooth_values)
                 for i in range(10):
                     # Local test
-                    diff = np.zeros(psdvalues.size)
-                    diff[good] = np.log(psdvalues[good]) - np.log(smooth_values[good])
-                    sdev = np.std(diff[good])
-                    good[np.abs(diff) > 5 * sdev] = False
+                    diff = np.where(good, log_values - log_smooth, 0)
+                    good[np.abs(diff) > 5 * masked_std(diff)] = False
                     # Global test
-                    diff = np.zeros(psdvalues.size)
-                    diff[good] = np.log(psdvalues[good]) - np.mean(
-                        np.log(psdvalues[good])
-                    )
-                    sdev = np.std(diff[good])
-                    good[np.abs(diff) > 5 * sdev] = False
-
-                all_good[np.logical_not(good)] = False
+                    ngood = np.sum(good, axis=0)
+                    mean = np.sum(np.where(good, log_values, 0), axis=0) / ngood
+                    diff = np.where(good, log_values - mean, 0)
+                    good[np.abs(diff) > 5 * masked_std(diff)] = False
+            bad[np.logical_not(np.all(good, axis=1))] = True
 
-            bad = np.logical_not(all_good)
-            nbad = np.sum(bad)
-            if nbad > 0:
-                for ii in np.argwhere(bad).ravel()[::-1]:
-                    del all_psds[ii]
-                    del all_times[ii]
-                    if self._save_cov:
-                        del all_cov[ii]
+        outlier[valid] = bad
+        return empty, outlier
 
-            if nbad > 0:
-                print("Masked extra {} psds due to outliers." "".format(nbad))
-        return all_psds, all_times, nempty + nbad, all_cov
+    def discard_outliers(self, binfreq, all_psds, all_times, all_cov):
+        empty, outlier = self.flag_outliers(binfreq, np.array(all_psds))
+        nempty = np.sum(empty)
+        nbad = np.sum(outlier)
+        if nempty > 0:
+            print("Discarded {} empty or NaN psds".format(nempty), flush=True)
+        if nbad > 0:
+            print("Masked extra {} psds due to outliers." "".format(nbad))
+        good = np.logical_not(np.logical_or(empty, outlier))
+        good_psds = [x for x, g in zip(all_psds, good) if g]
+        good_times = [x for x, g in zip(all_times, good) if g]
+        good_cov = all_cov
+        if self._save_cov:
+            good_cov = [x for x, g in zip(all_cov, good) if g]
+        return good_psds, good_times, nempty + nbad, good_cov
 
     def save_psds(
         self, binfreq, all_psds, all_times, det1, det2, fsample, rootname, all_cov
@@ -649,6 +832,7 @@ class OpNoiseEstim:
         det1,
         det2,
         local_intervals,
+        root=0,
     ):
         # High pass filter the signal to avoid aliasing
         # self.highpass(signal1, noise_flags)
@@ -756,17 +940,17 @@ class OpNoiseEstim:
             have_bins_all = [have_bins]
         else:
             have_bins_all = comm.allgather(have_bins)
-        root = 0
+        bin_root = 0
         if np.any(have_bins_all):
-            while not have_bins_all[root]:
-                root += 1
+            while not have_bins_all[bin_root]:
+                bin_root += 1
         else:
             raise RuntimeError("None of the processes have valid PSDs")
         binfreq = None
         if comm is None:
             binfreq = binfreq0
         else:
-            binfreq = comm.bcast(binfreq0, root=root)
+            binfreq = comm.bcast(binfreq0, root=bin_root)
         if binfreq0 is not None and np.any(binfreq != binfreq0):
             raise Exception(
                 "{:4} : Binned PSD frequencies change. len(binfreq0)={}"
@@ -786,61 +970,62 @@ class OpNoiseEstim:
             all_times = [my_times]
             all_psds = [my_binned_psds]
         else:
-            all_times = comm.gather(my_times, root=0)
-            all_psds = comm.gather(my_binned_psds, root=0)
+            all_times = comm.gather(my_times, root=root)
+            all_psds = comm.gather(my_binned_psds, root=root)
         all_cov = None
         if self._save_cov:
             if comm is None:
                 all_cov = [my_cov]
             else:
-                all_cov = comm.gather(my_cov, root=0)
+                all_cov = comm.gather(my_cov, root=root)
         if rank == 0:
             timer.report_clear("Collect PSDs")
 
-        if rank == 0:
-            # FIXME: original code had no timing report here for the previous block.
-            # Was one intended?
-            if len(all_times) != len(all_psds):
-                raise Exception(
-                    "ERROR: Process {} has len(all_times) = {}, len(all_psds)"
-                    " = {} before deglitch".format(rank, len(all_times), len(all_psds))
-                )
-            # De-glitch the binned PSDs and write them to file
-            i = 0
-            while i < len(all_times):
-                if len(all_times[i]) == 0:
-                    del all_times[i]
-                    del all_psds[i]
-                    if self._save_cov:
-                        del all_cov[i]
-                else:
-                    i += 1
+        if rank != root:
+            return None
+
+        # Stack the PSDs of all processes that have any
 
-            if len(all_times) != len(all_psds):
-                raise Exception(
-                    "ERROR: Process {} has len(all_times) = {}, len(all_psds)"
-                    " = {} AFTER deglitch".format(rank, len(all_times), len(all_psds))
+        times = np.array([t for x in all_times for t in x])
+        psds = np.array([p for x in all_psds for p in x])
+        cov = None
+        if self._save_cov:
+            cov = np.array([c for x in all_cov for c in x])
+        if times.size != psds.shape[0]:
+            raise RuntimeError(
+                "ERROR: Process {} has {} times but {} PSDs".format(
+                    rank, times.size, psds.shape[0]
                 )
+            )
 
-            all_times = list(np.hstack(all_times))
-            all_psds = list(np.hstack(all_psds))
-            if self._save_cov:
-                all_cov = list(np.hstack(all_cov))
+        # De-glitch the binned PSDs
 
-            good_psds, good_times, nbad, good_cov = self.discard_outliers(
-                binfreq, all_psds, all_times, all_cov
+        empty, outlier = self.flag_outliers(binfreq, psds)
+        good = np.logical_not(np.logical_or(empty, outlier))
+        nempty = np.sum(empty)
+        nbad = np.sum(outlier)
+        if nempty > 0:
+            print(
+                "{} vs. {}: Discarded {} empty or NaN psds".format(det1, det2, nempty),
+                flush=True,
             )
-            timer.report_clear("Discard outliers")
-
-            self.save_psds(
-                binfreq, all_psds, all_times, det1, det2, fsample, fileroot, all_cov
+        if nbad > 0:
+            print(
+                "{} vs. {}: Masked extra {} psds due to outliers."
+                "".format(det1, det2, nbad),
+                flush=True,
             )
 
-            if nbad > 0:
+        if self._fits_per_pair:
+            self.save_psds(binfreq, psds, times, det1, det2, fsample, fileroot, cov)
+            if not np.all(good):
+                good_cov = None
+                if self._save_cov:
+                    good_cov = cov[good]
                 self.save_psds(
                     binfreq,
-                    good_psds,
-                    good_times,
+                    psds[good],
+                    times[good],
                     det1,
                     det2,
                     fsample,
@@ -849,4 +1034,147 @@ class OpNoiseEstim:
                 )
             timer.report_clear("Write PSDs")
 
+        if np.any(good):
+            psd = np.mean(psds[good], axis=0)
+        else:
+            psd = np.zeros(binfreq.size)
+
+        return {
+            "det1": det1,
+            "det2": det2,
+            "freq": binfreq,
+            "psd": psd,
+            "times": times,
+            "psds": psds,
+            "good": good,
+            "cov": cov,
+        }
+
+    @function_timer
+    def save_noise_model(self, comm, fname, results, fsample):
+        """Write the noise estimates of one observation into a single file.
+
+        Every detector pair is stored in the HDF5 group `pairs/<det1>/<det2>`.
+        If h5py has MPI support, the processes write their own pairs into the
+        file in parallel.  Otherwise the estimates are sent to the root
+        process for writing.
+
+        Args:
+            comm (mpi4py.MPI.Comm):  The observation communicator.
+            fname (str):  Output file name.
+            results (list):  Noise estimates computed by this process.
+            fsample (float):  Sampling rate.
+
+        Returns:
+            None
+
+        """
+        timer = Timer()
+        timer.start()
+
+        def describe(result):
+            cov_shape = None
+            if result["cov"] is not None:
+                cov_shape = result["cov"].shape
+            return (
+                result["det1"],
+                result["det2"],
+                result["freq"].size,
+                result["times"].size,
+                int(np.sum(result["good"])),
+                cov_shape,
+            )
+
+        rank = 0
+        parallel = False
+        if comm is None or comm.size == 1:
+            entries = [describe(x) for x in results]
+        else:
+            rank = comm.rank
+            fsample = comm.bcast(fsample, root=0)
+            parallel = h5py.get_config().mpi
+            if parallel:
+                all_entries = comm.allgather([describe(x) for x in results])
+                entries = [x for proc_entries in all_entries for x in proc_entries]
+            else:
+                all_results = comm.gather(results, root=0)
+                if rank != 0:
+                    return
+                results = [x for proc_results in all_results for x in proc_results]
+                entries = [describe(x) for x in results]
+
+        if parallel:
+            hf = h5py.File(fname, "w", driver="mpio", comm=comm)
+        else:
+            hf = h5py.File(fname, "w")
+        hf.attrs["rate"] = fsample
+
+        # Creating the groups and datasets is a collective operation
+
+        pairs = hf.create_group("pairs")
+        datasets = {}
+        for det1, det2, nbin, ntime, ngood, cov_shape in sorted(
+            entries, key=lambda x: x[:2]
+        ):
+            group = pairs.require_group(det1).create_group(det2)
+            group.attrs["ngood"] = ngood
+            dsets = {
+                "freq": group.create_dataset("freq", (nbin,), dtype=np.float64),
+                "psd": group.create_dataset("psd", (nbin,), dtype=np.float64),
+                "times": group.create_dataset("times", (ntime,), dtype=np.float64),
+                "psds": group.create_dataset("psds", (ntime, nbin), dtype=np.float64),
+                "good": group.create_dataset("good", (ntime,), dtype=np.uint8),
+            }
+            if cov_shape is not None:
+                dsets["cov"] = group.create_dataset("cov", cov_shape, dtype=np.float64)
+            datasets[(det1, det2)] = dsets
+
+        # Every process writes the pairs it estimated
+
+        for result in results:
+            dsets = datasets[(result["det1"], result["det2"])]
+            for key, dset in dsets.items():
+                if dset.size > 0:
+                    dset[...] = result[key]
+        hf.close()
+
+        if rank == 0:
+            timer.report_clear("Write noise model to {}".format(fname))
         return
+
+
+def load_noise_model(fname):
+    """Load a noise model written by OpNoiseEstim.
+
+    The model is built from the mean of the good auto-spectra.  Cross
+    spectra are available in the file but not included in the model.
+
+    Args:
+        fname (str):  Path to the noise model file.
+
+    Returns:
+        (Noise):  The noise model of all detectors with a good PSD.
+
+    """
+    dets = []
+    freqs = {}
+    psds = {}
+    with h5py.File(fname, "r") as hf:
+        fnyquist = 0.5 * hf.attrs["rate"]
+        pairs = hf["pairs"]
+        for det in pairs:
+            if det not in pairs[det]:
+                continue
+            group = pairs[det][det]
+            if group.attrs["ngood"] == 0:
+                continue
+            freq = group["freq"][:]
+            psd = group["psd"][:]
+            if freq[-1] < fnyquist:
+                # The Noise class expects the last frequency at Nyquist
+                freq = np.append(freq, fnyquist)
+                psd = np.append(psd, psd[-1])
+            dets.append(det)
+            freqs[det] = freq
+            psds[det] = psd
+    return Noise(detectors=dets, freqs=freqs, psds=psds)
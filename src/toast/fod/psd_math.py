@@ -4,6 +4,7 @@
 
 import numpy as np
 
+from scipy.fftpack import next_fast_len
 from scipy.signal import fftconvolve
 
 from ..mpi import MPI
@@ -45,6 +46,86 @@ def highpass_flagged_signal(sig, good, naverage):
     return sig
 
 
+# The FFT-based lagged sums are used when lagmax exceeds this multiple
+# of log2 of the transform length.
+FFT_LAG_FACTOR = 16
+
+covariance_methods = ("auto", "direct", "fft")
+
+
+def _lagged_sums_fft(x, y, good, lagmax):
+    """Evaluate the lagged sums with zero-padded Fourier transforms.
+
+    The transforms are padded to at least `x.size + lagmax` samples so the
+    circular correlation has no wrap-around for the requested lags.  The
+    hit counts are the autocorrelation of the sample mask.
+
+    """
+    n = x.size
+    nfft = next_fast_len(n + lagmax)
+    mask = good.astype(np.float64)
+    fmask = np.fft.rfft(mask, n=nfft)
+    hits = np.fft.irfft(fmask * np.conj(fmask), n=nfft)[:lagmax]
+    hits = np.rint(hits).astype(np.int64)
+    fx = np.fft.rfft(x * mask, n=nfft)
+    if y is None:
+        sums = np.fft.irfft(fx * np.conj(fx), n=nfft)[:lagmax]
+    else:
+        fy = np.fft.rfft(y * mask, n=nfft)
+        # Symmetrize the cross correlation to double the statistics
+        sums = np.fft.irfft(2 * (np.conj(fx) * fy).real, n=nfft)[:lagmax]
+        hits *= 2
+    # Lags beyond the signal length have no sample pairs
+    if n < lagmax:
+        sums[n:] = 0
+        hits[n:] = 0
+    return sums, hits
+
+
+@function_timer
+def lagged_sums(x, y, good, lagmax, method="auto"):
+    """Accumulate the lagged products of flagged signals.
+
+    For every lag below `lagmax`, sum the products of unflagged sample pairs
+    separated by that lag and count the pairs.  The cross sums are
+    symmetrized:  both x[i] * y[i + lag] and x[i + lag] * y[i] are included.
+
+    The direct evaluation scales as N * lagmax while the zero-padded FFT
+    evaluation scales as N log N.  Both give the same lag estimates to
+    floating point precision.
+
+    Args:
+        x (array):  Signal vector.
+        y (array):  Second signal vector or None for the autocovariance.
+        good (array):  Sample flags (zero == *BAD*).
+        lagmax (int):  Largest sample separation to evaluate.
+        method (str):  "direct", "fft" or "auto" to select based on
+            lagmax and the signal length.
+
+    Returns:
+        (tuple):  The (sums, hits) arrays of length lagmax.
+
+    """
+    if method not in covariance_methods:
+        raise RuntimeError("Unknown covariance method: {}".format(method))
+    n = x.size
+    if method == "auto":
+        if lagmax > FFT_LAG_FACTOR * np.log2(max(2, n + lagmax)):
+            method = "fft"
+        else:
+            method = "direct"
+    good = good != 0
+    if method == "fft":
+        return _lagged_sums_fft(x, y, good, lagmax)
+    sums = np.zeros(lagmax, dtype=np.float64)
+    hits = np.zeros(lagmax, dtype=np.int64)
+    if y is None:
+        fod_autosums(x, good.astype(np.uint8), lagmax, sums, hits)
+    else:
+        fod_crosssums(x, y, good.astype(np.uint8), lagmax, sums, hits)
+    return sums, hits
+
+
 @function_timer
 def autocov_psd(
     times,
@@ -55,6 +136,7 @@ def autocov_psd(
     fsample,
     comm=None,
     return_cov=False,
+    method="auto",
 ):
     """Compute the sample autocovariance.
 
@@ -73,6 +155,7 @@ def autocov_psd(
         fsample (float):  The sampling frequency in Hz
         comm (MPI.Comm):  The MPI communicator or None.
         return_cov (bool): Return also the covariance function
+        method (str):  Lagged sum evaluation, see `lagged_sums`.
 
     Returns:
         (list):  List of local tuples of (start_time, stop_time, bin_frequency,
@@ -80,7 +163,16 @@ def autocov_psd(
 
     """
     return crosscov_psd(
-        times, signal, None, flags, lagmax, stationary_period, fsample, comm, return_cov
+        times,
+        signal,
+        None,
+        flags,
+        lagmax,
+        stationary_period,
+        fsample,
+        comm=comm,
+        return_cov=return_cov,
+        method=method,
     )
 
 
@@ -95,6 +187,7 @@ def crosscov_psd(
     fsample,
     comm=None,
     return_cov=False,
+    method="auto",
 ):
     """Compute the sample (cross)covariance.
 
@@ -114,6 +207,7 @@ def crosscov_psd(
         fsample (float):  The sampling frequency in Hz
         comm (MPI.Comm):  The MPI communicator or None.
         return_cov (bool): Return also the covariance function
+        method (str):  Lagged sum evaluation, see `lagged_sums`.
 
     Returns:
         (list):  List of local tuples of (start_time, stop_time, bin_frequency,
@@ -173,7 +267,7 @@ def crosscov_psd(
                     continue
                 comm.send(signal1[:lagmax], dest=rank - 1, tag=0)
                 if signal2 is not None:
-                    comm.send(signal1[:lagmax], dest=rank - 1, tag=3)
+                    comm.send(signal2[:lagmax], dest=rank - 1, tag=3)
                 comm.send(flags[:lagmax], dest=rank - 1, tag=1)
                 comm.send(times[:lagmax], dest=rank - 1, tag=2)
             else:
@@ -182,7 +276,7 @@ def crosscov_psd(
                     continue
                 extended_signal1[-lagmax:] = comm.recv(source=rank + 1, tag=0)
                 if signal2 is not None:
-                    extended_signal1[-lagmax:] = comm.recv(source=rank + 1, tag=3)
+                    extended_signal2[-lagmax:] = comm.recv(source=rank + 1, tag=3)
                 extended_flags[-lagmax:] = comm.recv(source=rank + 1, tag=1)
                 extended_times[-lagmax:] = comm.recv(source=rank + 1, tag=2)
 
@@ -207,15 +301,15 @@ def crosscov_psd(
         sig1 = highpass_flagged_signal(sig1, good, naverage)
         # High pass filter does not work at the ends
         ind = slice(naverage // 2, -naverage // 2)
-        cov_hits = np.zeros(lagmax, dtype=np.int64)
-        cov = np.zeros(lagmax, dtype=np.float64)
         if signal2 is None:
-            fod_autosums(sig1[ind], good[ind].astype(np.uint8), lagmax, cov, cov_hits)
+            cov, cov_hits = lagged_sums(
+                sig1[ind], None, good[ind], lagmax, method=method
+            )
         else:
             sig2 = extended_signal2[realflg].copy()
             sig2 = highpass_flagged_signal(sig2, good, lagmax)
-            fod_crosssums(
-                sig1[ind], sig2[ind], good[ind].astype(np.uint8), lagmax, cov, cov_hits
+            cov, cov_hits = lagged_sums(
+                sig1[ind], sig2[ind], good[ind], lagmax, method=method
             )
         covs[ireal] = (cov_hits, cov)
 
@@ -4,7 +4,7 @@
 
 # import functions in our public API
 
-from .pixels import DistPixels
+from .pixels import DistPixels, clear_local_pixels
 
 from .cov import (
     covariance_invert,
@@ -2,7 +2,9 @@
 # All rights reserved.  Use of this source code is governed by
 # a BSD-style license that can be found in the LICENSE file.
 
+import hashlib
 import os
+import re
 
 import numpy as np
 
@@ -18,6 +20,29 @@ from ..cache import Cache
 
 from .._libtoast import global_to_local as libtoast_global_to_local
 
+# Cache names of memoized local pixel indices are <pixels entry><tag><distribution>
+LOCAL_PIXELS_TAG = "_local_"
+
+
+def clear_local_pixels(cache, name, key=""):
+    """Discard the memoized local pixel indices of a cached pixel vector.
+
+    This must be called whenever the pixel numbers in the cache are
+    recomputed or modified.
+
+    Args:
+        cache (toast.Cache):  The cache holding the pixel numbers.
+        name (str):  The cache name of the pixel numbers.
+        key (str):  Only discard the indices of the distribution with this
+            `DistPixels.local_key`.  By default all are discarded.
+
+    Returns:
+        None
+
+    """
+    cache.clear(pattern=re.escape(name + LOCAL_PIXELS_TAG + key))
+    return
+
 
 class DistPixels(object):
     """A distributed map with multiple values per pixel.
@@ -83,6 +108,8 @@ class DistPixels(object):
         self._glob2loc = None
         self._cache = Cache()
         self._commsize = 5000000
+        self._reduce_plan = None
+        self._local_key = None
 
         # our data is a 3D array of submap, pixel, values
         # we allocate this as a contiguous block
@@ -154,6 +181,12 @@ class DistPixels(object):
         """(int): The number of submaps stored on this process."""
         return self._nsub
 
+    @property
+    def glob2loc(self):
+        """(array): The local index of every global submap (-1 if the submap
+        is not stored locally) or None if process has no data."""
+        return self._glob2loc
+
     @property
     def nested(self):
         """(bool): If True, data is HEALPix NESTED ordering."""
@@ -173,6 +206,63 @@ class DistPixels(object):
         """
         return libtoast_global_to_local(gl, self._npix_submap, self._glob2loc)
 
+    @property
+    def local_key(self):
+        """(str): A short identifier of the pixel distribution.  Maps with the
+        same submap size and local submaps share the same key."""
+        if self._local_key is None:
+            digest = hashlib.sha1(np.int64(self._npix_submap).tobytes())
+            if self._local_submaps is not None:
+                digest.update(np.asarray(self._local_submaps, dtype=np.int64))
+            self._local_key = digest.hexdigest()[:16]
+        return self._local_key
+
+    @property
+    def local_index_dtype(self):
+        """(dtype): The narrowest integer type holding both the local submap
+        and the local pixel indices."""
+        if max(self._nsub, self._npix_submap) < 2**31:
+            return np.int32
+        return np.int64
+
+    @function_timer
+    def cached_global_to_local(self, cache, name):
+        """Convert cached global pixel numbers into local submaps and pixels.
+
+        The translation is memoized in `cache` next to the pixel numbers, so
+        that repeated passes over unchanged pointing skip it.  All maps with
+        the same distribution share the memoized indices.  This is meant for
+        iterative consumers that scan the same pointing many times.  They
+        should call `clear_local_pixels` when done, the pointing operators
+        also do so when they recompute the pixel numbers.
+
+        The indices are stored as `local_index_dtype`, which costs two int32
+        numbers per sample unless the distribution is very large.
+
+        Args:
+            cache (toast.Cache):  The cache holding the pixel numbers.
+            name (str):  The cache name of the pixel numbers.
+
+        Returns:
+            (tuple):  The local submap indices and the pixel indices local to
+                those submaps, both int64 arrays.
+
+        """
+        localname = "{}{}{}".format(name, LOCAL_PIXELS_TAG, self.local_key)
+        if not cache.exists(localname):
+            pixels = cache.reference(name)
+            sm, lpix = self.global_to_local(pixels)
+            ref = cache.create(localname, self.local_index_dtype, (2, pixels.size))
+            ref[0] = sm
+            ref[1] = lpix
+            del ref
+            del pixels
+        ref = cache.reference(localname)
+        sm = ref[0].astype(np.int64, copy=False)
+        lpix = ref[1].astype(np.int64, copy=False)
+        del ref
+        return sm, lpix
+
     @function_timer
     def duplicate(self, copy=True, nnz=None):
         """Perform a deep copy of the distributed data.
@@ -214,11 +304,23 @@ class DistPixels(object):
         return nsub
 
     @function_timer
-    def allreduce(self, comm_bytes=None):
-        """Perform a buffered allreduce of the pixel domain data.
+    def allreduce(self, comm_bytes=None, sparse=None):
+        """Sum the pixel domain data across all processes.
+
+        Two reduction strategies are available.  The sparse reduction only
+        communicates submaps that are stored on more than one process:  every
+        such submap is assigned an owner among the processes that store it,
+        the other processes send their copies to the owner (an Alltoallv of
+        the hit submaps only), and the owner returns the sum.  The buffered
+        reduction performs a full-communicator Allreduce of every block of
+        submaps that is hit anywhere.
 
         Args:
-            comm_bytes (int): The approximate message size to use.
+            comm_bytes (int): The approximate message size to use in the
+                buffered reduction.
+            sparse (bool): If True, use the sparse reduction.  If False, use
+                the buffered reduction.  If None, use the sparse reduction
+                unless most processes store most of the hit submaps.
 
         Returns:
             None.
@@ -226,7 +328,155 @@ class DistPixels(object):
         """
         if self._comm is None:
             return
+        plan = self._get_reduce_plan()
+        if sparse is None:
+            sparse = plan["density"] < 0.5
+        if sparse:
+            self._allreduce_sparse(plan)
+        else:
+            self._allreduce_buffered(plan["allowners"], comm_bytes)
+        return
+
+    def _get_reduce_plan(self):
+        """Build the communication pattern of the sparse reduction.
+
+        The local submaps do not change over the lifetime of the object so
+        the pattern is computed once and cached.
+
+        Returns:
+            (dict):  The exchange pattern.
 
+        """
+        if self._reduce_plan is not None:
+            return self._reduce_plan
+        rank = self._comm.rank
+        nproc = self._comm.size
+        nsub = self._nglob
+
+        if self._local_submaps is None:
+            local_submaps = np.zeros(0, dtype=np.int64)
+        else:
+            local_submaps = np.asarray(self._local_submaps, dtype=np.int64)
+
+        # Lowest process storing each submap, as used by the serialization
+        owners = np.zeros(nsub, dtype=np.int32)
+        owners.fill(nproc)
+        owners[local_submaps] = rank
+        allowners = np.zeros_like(owners)
+        self._comm.Allreduce(owners, allowners, op=MPI.MIN)
+
+        # Every (submap, process) pair, sorted by submap and then process
+        all_local = self._comm.allgather(local_submaps)
+        pair_submap = np.concatenate(all_local)
+        pair_proc = np.concatenate(
+            [np.full(len(x), iproc, dtype=np.int64) for iproc, x in enumerate(all_local)]
+        )
+        order = np.lexsort((pair_proc, pair_submap))
+        pair_submap = pair_submap[order]
+        pair_proc = pair_proc[order]
+        nholder = np.bincount(pair_submap, minlength=nsub)
+        first = np.zeros(nsub, dtype=np.int64)
+        first[1:] = np.cumsum(nholder)[:-1]
+
+        # Spread the reduction work across the processes holding each submap
+        shared = np.arange(nsub)[nholder > 1]
+        reducer = np.full(nsub, -1, dtype=np.int64)
+        reducer[shared] = pair_proc[first[shared] + shared % nholder[shared]]
+        pair_reducer = reducer[pair_submap]
+
+        # Copies we send to reducers, ordered by destination and submap
+        send = np.logical_and(pair_proc == rank, pair_reducer != rank)
+        send[pair_reducer < 0] = False
+        order = np.lexsort((pair_submap[send], pair_reducer[send]))
+        send_submaps = pair_submap[send][order]
+        send_counts = np.bincount(pair_reducer[send], minlength=nproc)
+
+        # Copies we receive as a reducer, ordered by source and submap
+        recv = np.logical_and(pair_reducer == rank, pair_proc != rank)
+        order = np.lexsort((pair_submap[recv], pair_proc[recv]))
+        recv_submaps = pair_submap[recv][order]
+        recv_counts = np.bincount(pair_proc[recv], minlength=nproc)
+
+        nhit = np.count_nonzero(nholder)
+        density = 0.0
+        if nhit > 0:
+            density = len(pair_submap) / (nhit * nproc)
+
+        self._reduce_plan = {
+            "allowners": allowners,
+            "density": density,
+            "send_local": self._glob2loc[send_submaps] if len(send_submaps) else [],
+            "send_counts": send_counts,
+            "recv_local": self._glob2loc[recv_submaps] if len(recv_submaps) else [],
+            "recv_counts": recv_counts,
+        }
+        return self._reduce_plan
+
+    def _alltoallv_submaps(self, sendbuf, send_counts, recv_counts):
+        """Exchange whole submaps between all processes."""
+        nelem = self._npix_submap * self._nnz
+        send_counts = send_counts * nelem
+        recv_counts = recv_counts * nelem
+        send_displ = np.zeros_like(send_counts)
+        send_displ[1:] = np.cumsum(send_counts)[:-1]
+        recv_displ = np.zeros_like(recv_counts)
+        recv_displ[1:] = np.cumsum(recv_counts)[:-1]
+        recvbuf = np.zeros(
+            (np.sum(recv_counts) // nelem, self._npix_submap, self._nnz),
+            dtype=self._dtype,
+        )
+        self._comm.Alltoallv(
+            [sendbuf, (send_counts, send_displ)],
+            [recvbuf, (recv_counts, recv_displ)],
+        )
+        return recvbuf
+
+    @function_timer
+    def _allreduce_sparse(self, plan):
+        """Reduce shared submaps on their reducing process and return the sum."""
+        send_local = plan["send_local"]
+        send_counts = plan["send_counts"]
+        recv_local = plan["recv_local"]
+        recv_counts = plan["recv_counts"]
+
+        # Send our copies to the reducers and accumulate what we receive.
+        # Each source contributes any submap at most once.
+        if len(send_local) > 0:
+            sendbuf = np.ascontiguousarray(self.data[send_local])
+        else:
+            sendbuf = np.zeros(0, dtype=self._dtype)
+        recvbuf = self._alltoallv_submaps(sendbuf, send_counts, recv_counts)
+        offset = 0
+        for count in recv_counts:
+            if count > 0:
+                self.data[recv_local[offset : offset + count]] += recvbuf[
+                    offset : offset + count
+                ]
+            offset += count
+        del sendbuf
+
+        # Return the reduced submaps to the processes that sent them
+        if len(recv_local) > 0:
+            sendbuf = np.ascontiguousarray(self.data[recv_local])
+        else:
+            sendbuf = np.zeros(0, dtype=self._dtype)
+        recvbuf = self._alltoallv_submaps(sendbuf, recv_counts, send_counts)
+        if len(send_local) > 0:
+            self.data[send_local] = recvbuf
+        return
+
+    @function_timer
+    def _allreduce_buffered(self, allowners, comm_bytes=None):
+        """Perform a buffered allreduce of the pixel domain data.
+
+        Args:
+            allowners (array): The lowest process storing each submap.
+            comm_bytes (int): The approximate message size to use.
+
+        Returns:
+            None.
+
+        """
         if comm_bytes is None:
             comm_bytes = self._commsize
         comm_submap = self._comm_nsubmap(comm_bytes)
@@ -242,13 +492,6 @@ class DistPixels(object):
         )
         recvview = recvbuf.reshape(comm_submap, self._npix_submap, self._nnz)
 
-        owners = np.zeros(nsub, dtype=np.int32)
-        owners.fill(self._comm.size)
-        for m in self._local_submaps:
-            owners[m] = self._comm.rank
-        allowners = np.zeros_like(owners)
-        self._comm.Allreduce(owners, allowners, op=MPI.MIN)
-
         submap_off = 0
         ncomm = comm_submap
 
@@ -3,6 +3,7 @@
 # a BSD-style license that can be found in the LICENSE file.
 
 import argparse
+import itertools
 import os
 
 import numpy as np
@@ -28,6 +29,20 @@ if atm_available_utils:
 XAXIS, YAXIS, ZAXIS = np.eye(3)
 TCMB = 2.725
 
+# Node spacing of the absorption and loading lookup table.  The spectra are
+# evaluated on this grid and interpolated linearly in PWV [mm], air
+# temperature [K] and surface pressure [Pa].
+ATM_TABLE_PWV_STEP = 0.1
+ATM_TABLE_TEMPERATURE_STEP = 10.0
+ATM_TABLE_PRESSURE_STEP = 2000.0
+
+# Frequency grid of the lookup table [GHz].  All bands at a site are
+# interpolated from the same tabulated spectra.
+ATM_TABLE_FREQS = np.linspace(0, 1000, 1001)
+
+# The tabulated spectra, keyed by the site and the node
+_atm_tables = dict()
+
 
 def add_atmosphere_args(parser):
     """Add the atmospheric simulation arguments"""
@@ -75,6 +90,24 @@ def add_atmosphere_args(parser):
     )
     parser.set_defaults(simulate_atmosphere=False)
 
+    parser.add_argument(
+        "--atm-table",
+        required=False,
+        action="store_true",
+        help="Interpolate atmospheric absorption and loading from a per-site "
+        "lookup table.  Experimental, the interpolation error is not yet "
+        "characterized",
+        dest="atm_table",
+    )
+    parser.add_argument(
+        "--no-atm-table",
+        required=False,
+        action="store_false",
+        help="Evaluate atmospheric absorption and loading for every observation",
+        dest="atm_table",
+    )
+    parser.set_defaults(atm_table=False)
+
     parser.add_argument(
         "--focalplane-radius-deg",
         required=False,
@@ -173,6 +206,21 @@ def add_atmosphere_args(parser):
         type=np.int64,
         help="controls the size of the simulation slices",
     )
+    parser.add_argument(
+        "--atm-rmax",
+        required=False,
+        default=10000.0,
+        type=np.float64,
+        help="maximum line of sight distance [m]",
+    )
+    parser.add_argument(
+        "--atm-step-exponent",
+        required=False,
+        default=0.5,
+        type=np.float64,
+        help="growth of the volume elements with distance.  1 keeps the angular "
+        "resolution constant across the radial shells",
+    )
     parser.add_argument(
         "--atm-wind-dist",
         required=False,
@@ -214,6 +262,13 @@ def add_atmosphere_args(parser):
         default="atm_cache",
         help="Atmosphere cache directory",
     )
+    parser.add_argument(
+        "--atm-cache-size",
+        required=False,
+        type=np.float64,
+        help="Maximum size of the atmosphere cache [GB].  Least recently used "
+        "realizations are removed beyond this size.",
+    )
     parser.add_argument(
         "--atm-apply-flags",
         default=False,
@@ -295,6 +350,10 @@ def simulate_atmosphere(args, comm, data, mc, cache_name=None, verbose=True):
     if args.atm_verbosity > 1:
         write_debug = True
 
+    cache_size = None
+    if args.atm_cache_size is not None:
+        cache_size = int(args.atm_cache_size * 2 ** 30)
+
     # Simulate the atmosphere signal
 
     atm = OpSimAtmosphere(
@@ -311,11 +370,14 @@ def simulate_atmosphere(args, comm, data, mc, cache_name=None, verbose=True):
         ystep=args.atm_ystep,
         zstep=args.atm_zstep,
         nelem_sim_max=args.atm_nelem_sim_max,
+        rmax=args.atm_rmax,
+        step_exponent=args.atm_step_exponent,
         z0_center=args.atm_z0_center,
         z0_sigma=args.atm_z0_sigma,
         apply_flags=args.atm_apply_flags,
         common_flag_mask=args.common_flag_mask,
         cachedir=args.atm_cache,
+        cache_size=cache_size,
         wind_dist=args.atm_wind_dist,
         write_debug=write_debug,
     )
@@ -341,6 +403,7 @@ def simulate_atmosphere(args, comm, data, mc, cache_name=None, verbose=True):
             apply_flags=args.atm_apply_flags,
             common_flag_mask=args.common_flag_mask,
             cachedir=args.atm_cache,
+            cache_size=cache_size,
             wind_dist=10000,
             write_debug=write_debug,
         )
@@ -353,6 +416,127 @@ def simulate_atmosphere(args, comm, data, mc, cache_name=None, verbose=True):
     return
 
 
+def _atm_spectra(todcomm, altitude, air_temperature, surface_pressure, pwv, freqs):
+    """Evaluate the absorption and loading spectra.
+
+    The frequencies are distributed over the processes in todcomm.
+
+    """
+    nfreq = freqs.size
+    if todcomm is None:
+        nfreq_task = nfreq
+        my_ifreq_min = 0
+        my_ifreq_max = nfreq
+    else:
+        nfreq_task = int(nfreq // todcomm.size) + 1
+        my_ifreq_min = nfreq_task * todcomm.rank
+        my_ifreq_max = min(nfreq, nfreq_task * (todcomm.rank + 1))
+    my_nfreq = my_ifreq_max - my_ifreq_min
+    if my_nfreq > 0:
+        if atm_available_utils:
+            my_freqs = freqs[my_ifreq_min:my_ifreq_max]
+            my_absorption = atm_absorption_coefficient_vec(
+                altitude,
+                air_temperature,
+                surface_pressure,
+                pwv,
+                my_freqs[0],
+                my_freqs[-1],
+                my_nfreq,
+            )
+            my_loading = atm_atmospheric_loading_vec(
+                altitude,
+                air_temperature,
+                surface_pressure,
+                pwv,
+                my_freqs[0],
+                my_freqs[-1],
+                my_nfreq,
+            )
+        else:
+            raise RuntimeError("Atmosphere utilities from libaatm are not available")
+    else:
+        my_absorption = np.array([])
+        my_loading = np.array([])
+    if todcomm is None:
+        absorption = my_absorption
+        loading = my_loading
+    else:
+        absorption = np.hstack(todcomm.allgather(my_absorption))
+        loading = np.hstack(todcomm.allgather(my_loading))
+    return absorption, loading
+
+
+def atm_table_spectra(
+    todcomm, site_id, altitude, air_temperature, surface_pressure, pwv, freqs
+):
+    """Interpolate the absorption and loading spectra from a lookup table.
+
+    The table holds the spectra at ATM_TABLE_FREQS on a regular grid of
+    PWV, air temperature and surface pressure for every site.  Missing grid
+    nodes are evaluated on demand, so the radiative transfer is only run
+    for the weather conditions that the observations at the site actually
+    sample.  The table persists between calls, and all observations, bands
+    and Monte Carlo realizations at the site share it.  Elevation enters
+    the loading analytically and is not tabulated.
+
+    This call is collective over todcomm.
+
+    Args:
+        todcomm (mpi4py.MPI.Comm):  Communicator used to evaluate new nodes.
+        site_id (int):  The observing site.
+        altitude (float):  Site altitude [m].
+        air_temperature (float):  Air temperature [K].
+        surface_pressure (float):  Surface pressure [Pa].
+        pwv (float):  Precipitable water vapor [mm].
+        freqs (array):  Frequencies [GHz] within the range of
+            ATM_TABLE_FREQS.
+
+    Returns:
+        (tuple):  The absorption and loading spectra at freqs.
+
+    """
+    if np.amin(freqs) < ATM_TABLE_FREQS[0] or np.amax(freqs) > ATM_TABLE_FREQS[-1]:
+        raise RuntimeError(
+            "Frequencies {} - {} GHz are outside the atmosphere table".format(
+                np.amin(freqs), np.amax(freqs)
+            )
+        )
+    table = _atm_tables.setdefault((site_id, altitude), dict())
+    steps = [ATM_TABLE_PWV_STEP, ATM_TABLE_TEMPERATURE_STEP, ATM_TABLE_PRESSURE_STEP]
+    position = [
+        max(0.0, pwv) / steps[0],
+        air_temperature / steps[1],
+        surface_pressure / steps[2],
+    ]
+    lower = [int(np.floor(x)) for x in position]
+    frac = [x - i for x, i in zip(position, lower)]
+    absorption = np.zeros(ATM_TABLE_FREQS.size)
+    loading = np.zeros(ATM_TABLE_FREQS.size)
+    for corner in itertools.product((0, 1), repeat=3):
+        weight = 1.0
+        for c, f in zip(corner, frac):
+            weight *= f if c else 1 - f
+        if weight == 0:
+            continue
+        node = tuple(i + c for i, c in zip(lower, corner))
+        if node not in table:
+            table[node] = _atm_spectra(
+                todcomm,
+                altitude,
+                node[1] * steps[1],
+                node[2] * steps[2],
+                node[0] * steps[0],
+                ATM_TABLE_FREQS,
+            )
+        node_absorption, node_loading = table[node]
+        absorption += weight * node_absorption
+        loading += weight * node_loading
+    absorption = np.interp(freqs, ATM_TABLE_FREQS, absorption)
+    loading = np.interp(freqs, ATM_TABLE_FREQS, loading)
+    return absorption, loading
+
+
 @function_timer
 def scale_atmosphere_by_frequency(
     args, comm, data, freq=None, mc=0, cache_name=None, verbose=True
@@ -366,6 +550,10 @@ def scale_atmosphere_by_frequency(
     bandpasses for the detectors, the scaling is computed for each
     detector separately and `freq` is ignored.
 
+    If args.atm_table is set, the absorption and loading spectra are
+    interpolated from a per-site lookup table instead of being evaluated
+    for every observation.
+
     """
     if not args.simulate_atmosphere:
         return
@@ -375,6 +563,8 @@ def scale_atmosphere_by_frequency(
         log.info("Scaling atmosphere by frequency")
     timer = Timer()
     timer.start()
+    # Bandpass weights, including the conversion to thermodynamic units
+    band_weights = dict()
     for obs in data.obs:
         tod = obs["tod"]
         todcomm = tod.mpicomm
@@ -390,61 +580,31 @@ def scale_atmosphere_by_frequency(
         air_temperature = weather.air_temperature
         surface_pressure = weather.surface_pressure
         pwv = weather.pwv
-        # Use the entire processing group to sample the absorption
-        # coefficient as a function of frequency
-        freqmin = 0
-        if freq is None:
-            freqmax = 1000
-        else:
-            freqmax = 2 * freq
-        nfreq = 1001
-        freqstep = (freqmax - freqmin) / (nfreq - 1)
-        if todcomm is None:
-            nfreq_task = nfreq
-            my_ifreq_min = 0
-            my_ifreq_max = nfreq
+        if args.atm_table:
+            # All bands at the site share the tabulated frequency grid
+            freqs = ATM_TABLE_FREQS
+            absorption, loading = atm_table_spectra(
+                todcomm,
+                site_id,
+                altitude,
+                air_temperature,
+                surface_pressure,
+                pwv,
+                freqs,
+            )
         else:
-            nfreq_task = int(nfreq // todcomm.size) + 1
-            my_ifreq_min = nfreq_task * todcomm.rank
-            my_ifreq_max = min(nfreq, nfreq_task * (todcomm.rank + 1))
-        my_nfreq = my_ifreq_max - my_ifreq_min
-        if my_nfreq > 0:
-            if atm_available_utils:
-                my_freqs = freqmin + np.arange(my_ifreq_min, my_ifreq_max) * freqstep
-                my_absorption = atm_absorption_coefficient_vec(
-                    altitude,
-                    air_temperature,
-                    surface_pressure,
-                    pwv,
-                    my_freqs[0],
-                    my_freqs[-1],
-                    my_nfreq,
-                )
-                my_loading = atm_atmospheric_loading_vec(
-                    altitude,
-                    air_temperature,
-                    surface_pressure,
-                    pwv,
-                    my_freqs[0],
-                    my_freqs[-1],
-                    my_nfreq,
-                )
+            # Use the entire processing group to sample the absorption
+            # coefficient as a function of frequency
+            freqmin = 0
+            if freq is None:
+                freqmax = 1000
             else:
-                raise RuntimeError(
-                    "Atmosphere utilities from libaatm are not available"
-                )
-        else:
-            my_freqs = np.array([])
-            my_absorption = np.array([])
-            my_loading = np.array([])
-        if todcomm is None:
-            freqs = my_freqs
-            absorption = my_absorption
-            loading = my_loading
-        else:
-            freqs = np.hstack(todcomm.allgather(my_freqs))
-            absorption = np.hstack(todcomm.allgather(my_absorption))
-            loading = np.hstack(todcomm.allgather(my_loading))
+                freqmax = 2 * freq
+            nfreq = 1001
+            freqs = np.linspace(freqmin, freqmax, nfreq)
+            absorption, loading = _atm_spectra(
+                todcomm, altitude, air_temperature, surface_pressure, pwv, freqs
+            )
         for det in tod.local_dets:
             if "bandpass_transmission" in focalplane[det]:
                 # We have full bandpasses for the detector
@@ -466,20 +626,27 @@ def scale_atmosphere_by_frequency(
                     width = 0.2 * freq
                 bandpass_freqs = np.array([center - width / 2, center + width / 2])
                 bandpass = np.ones(2)
-            # Normalize and interpolate the bandpass
-            nstep = 1001
-            fmin, fmax = bandpass_freqs[0], bandpass_freqs[-1]
-            det_freqs = np.linspace(fmin, fmax, nstep)
-            det_bandpass = np.interp(det_freqs, bandpass_freqs, bandpass)
-            det_bandpass /= np.sum(det_bandpass)
+            band = (
+                np.asarray(bandpass_freqs, dtype=np.float64).tobytes(),
+                np.asarray(bandpass, dtype=np.float64).tobytes(),
+            )
+            if band not in band_weights:
+                # Normalize and interpolate the bandpass
+                nstep = 1001
+                fmin, fmax = bandpass_freqs[0], bandpass_freqs[-1]
+                det_freqs = np.linspace(fmin, fmax, nstep)
+                det_bandpass = np.interp(det_freqs, bandpass_freqs, bandpass)
+                det_bandpass /= np.sum(det_bandpass)
+                # From brightness to thermodynamic units
+                x = h * det_freqs * 1e9 / k / TCMB
+                rj2cmb = (x / (np.exp(x / 2) - np.exp(-x / 2))) ** -2
+                # Normalize to unity at 150GHz
+                rj2cmb *= 0.5763279042527544
+                band_weights[band] = (det_freqs, det_bandpass, rj2cmb)
+            det_freqs, det_bandpass, rj2cmb = band_weights[band]
             # Interpolate absorption and loading to bandpass frequencies
             absorption_det = np.interp(det_freqs, freqs, absorption)
             loading_det = np.interp(det_freqs, freqs, loading)
-            # From brightness to thermodynamic units
-            x = h * det_freqs * 1e9 / k / TCMB
-            rj2cmb = (x / (np.exp(x / 2) - np.exp(-x / 2))) ** -2
-            # Normalize to unity at 150GHz
-            rj2cmb *= 0.5763279042527544
             absorption_det *= rj2cmb
             # Average across the bandpass
             absorption_det = np.sum(absorption_det * det_bandpass)
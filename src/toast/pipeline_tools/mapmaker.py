@@ -45,6 +45,15 @@ def add_mapmaker_args(parser):
         help="Maximum number of CG iterations",
         dest="mapmaker_iter_max",
     )
+    parser.add_argument(
+        "--mapmaker-pcg-variant",
+        required=False,
+        default="standard",
+        choices=["standard", "pipelined"],
+        help="PCG iteration variant.  'pipelined' performs a single "
+        "non-blocking reduction per iteration.",
+        dest="mapmaker_pcg_variant",
+    )
     parser.add_argument(
         "--mapmaker-precond-width",
         required=False,
@@ -426,6 +435,7 @@ def apply_mapmaker(
                 use_noise_prior=args.mapmaker_noisefilter,
                 precond_width=args.mapmaker_precond_width,
                 pixels="pixels",
+                pcg_variant=args.mapmaker_pcg_variant,
             )
 
             mapmaker.exec(tele_data, time_comm)
@@ -10,6 +10,7 @@ to toast_ground_sim.py
 """
 
 import argparse
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 import dateutil.parser
 import os
@@ -30,6 +31,26 @@ from .timing import function_timer
 
 XAXIS, YAXIS, ZAXIS = np.eye(3)
 
+# Spacing of the PyEphem evaluations of the Sun and the Moon [s]
+EPHEM_STEP = 600.0
+
+# Length of the tabulated ephemeris blocks [s] and the number of blocks kept
+EPHEM_CHUNK = 86400.0
+EPHEM_NCHUNK = 4
+
+# Number of samples in the refraction table
+EPHEM_NREFRACTION = 3601
+
+# Largest accepted difference between the vectorized and the PyEphem
+# coordinates [radians].  Beyond this the ephemeris calls PyEphem directly.
+EPHEM_TOLERANCE = 1e-4
+
+# Number of time steps evaluated at once when tracking a patch
+TRACK_BLOCK = 60
+
+# Vectorized ephemerides, one per site
+_ephemerides = dict()
+
 
 class TooClose(Exception):
     pass
@@ -69,6 +90,9 @@ class Patch(object):
     dec_amplitude = None
     dec_period = 10
     corners = []
+    # Horizontal corner coordinates from the last call to corner_coordinates()
+    _corner_az = None
+    _corner_el = None
     preferred_el = None
 
     def __init__(
@@ -175,6 +199,7 @@ class Patch(object):
             offset = new_offset - old_offset
             for corner in self.corners:
                 corner._ra += offset
+            self._corner_az, self._corner_el = None, None
         if self.dec_amplitude:
             # Oscillate DEC
             halfperiod = self.dec_period // 2
@@ -187,6 +212,7 @@ class Patch(object):
             offset = new_offset - old_offset
             for corner in self.corners:
                 corner._dec += offset
+            self._corner_az, self._corner_el = None, None
         return
 
     @function_timer
@@ -195,8 +221,7 @@ class Patch(object):
         if self._area is None:
             npix = 12 * nside ** 2
             hitmap = np.zeros(npix)
-            for corner in self.corners:
-                corner.compute(observer)
+            self.corner_coordinates(observer)
             for pix in range(npix):
                 lon, lat = hp.pix2ang(nside, pix, lonlat=True)
                 center = ephem.FixedBody()
@@ -216,21 +241,25 @@ class Patch(object):
         """Return the corner coordinates in horizontal frame.
 
         PyEphem measures the azimuth East (clockwise) from North.
+        If observer is given, the coordinates are evaluated with the
+        vectorized site ephemeris and stored.  Otherwise the stored
+        coordinates are returned.
         """
-        azs = []
-        els = []
-        az0 = None
-        for corner in self.corners:
-            if observer is not None:
-                corner.compute(observer)
-            if unwind:
-                if az0 is None:
-                    az0 = corner.az
-                azs.append(unwind_angle(az0, corner.az))
-            else:
-                azs.append(corner.az)
-            els.append(corner.alt)
-        return np.array(azs), np.array(els)
+        if observer is not None:
+            ephemeris = get_ephemeris(observer)
+            self._corner_az, self._corner_el = ephemeris.fixed_azel(
+                self.corners, DJDtoUNIX(observer.date)
+            )
+        if self._corner_az is None:
+            # The corners were computed directly with PyEphem
+            azs = np.array([corner.az for corner in self.corners])
+            els = np.array([corner.alt for corner in self.corners])
+        else:
+            azs = self._corner_az.copy()
+            els = self._corner_el.copy()
+        if unwind:
+            azs = azs[0] + (azs - azs[0] + np.pi) % (2 * np.pi) - np.pi
+        return azs, els
 
     @function_timer
     def in_patch(self, obj):
@@ -354,27 +383,21 @@ class Patch(object):
         check_sso,
     ):
         self.update(observer)
-        patch_el_max = -1000
-        patch_el_min = 1000
-        in_view = False
-        for i, corner in enumerate(self.corners):
-            corner.compute(observer)
-            patch_el_min = min(patch_el_min, corner.alt)
-            patch_el_max = max(patch_el_max, corner.alt)
-            if corner.alt > el_min:
-                # At least one corner is visible
-                in_view = True
-            if check_sso:
-                if sun_avoidance_angle > 0:
-                    angle = np.degrees(ephem.separation(sun, corner))
-                    if angle < sun_avoidance_angle:
-                        # Patch is too close to the Sun
-                        return False, "Too close to Sun {:.2f}".format(angle)
-                if moon_avoidance_angle > 0:
-                    angle = np.degrees(ephem.separation(moon, corner))
-                    if angle < moon_avoidance_angle:
-                        # Patch is too close to the Moon
-                        return False, "Too close to Moon {:.2f}".format(angle)
+        azs, els = self.corner_coordinates(observer)
+        patch_el_min = np.amin(els)
+        patch_el_max = np.amax(els)
+        # At least one corner must be visible
+        in_view = bool(np.any(els > el_min))
+        if check_sso:
+            sun_angles = np.degrees(angular_distance(sun.az, sun.alt, azs, els))
+            moon_angles = np.degrees(angular_distance(moon.az, moon.alt, azs, els))
+            for sun_angle, moon_angle in zip(sun_angles, moon_angles):
+                if sun_avoidance_angle > 0 and sun_angle < sun_avoidance_angle:
+                    # Patch is too close to the Sun
+                    return False, "Too close to Sun {:.2f}".format(sun_angle)
+                if moon_avoidance_angle > 0 and moon_angle < moon_avoidance_angle:
+                    # Patch is too close to the Moon
+                    return False, "Too close to Moon {:.2f}".format(moon_angle)
         if not in_view:
             msg = "Below el_min = {:.2f} at el = {:.2f}..{:.2f}.".format(
                 np.degrees(el_min), np.degrees(patch_el_min), np.degrees(patch_el_max)
@@ -431,6 +454,7 @@ class SSOPatch(Patch):
         ncorner = 8
         angstep = 2 * np.pi / ncorner
         self.corners = []
+        self._corner_az, self._corner_el = None, None
         for icorner in range(ncorner):
             ang = angstep * icorner
             delta_theta = np.cos(ang) * r
@@ -638,17 +662,296 @@ def DJDtoUNIX(djd):
     return ((djd + 2415020) - 2440587.5) * 86400.0
 
 
+def angular_distance(az1, el1, az2, el2):
+    """Return the angular distance between horizontal coordinates."""
+    cosdist = np.sin(el1) * np.sin(el2) + np.cos(el1) * np.cos(el2) * np.cos(
+        az1 - az2
+    )
+    return np.arccos(np.clip(cosdist, -1, 1))
+
+
+class Ephemeris(object):
+    """Vectorized horizontal coordinates at one observing site.
+
+    PyEphem is only called on a coarse time grid: every EPHEM_STEP seconds
+    for the Sun and the Moon, and once per EPHEM_CHUNK seconds for fixed
+    positions such as patch corners.  The apparent topocentric equatorial
+    coordinates and the local sidereal time are interpolated between the
+    grid points and rotated to the horizontal frame with numpy.  Refraction
+    is interpolated from a table computed with PyEphem for the site.
+
+    The tabulated blocks are cached, so all patches, elevations and
+    rising / setting attempts share them.  Every block is verified against
+    PyEphem at the grid points and between them.  If the vectorized
+    coordinates ever disagree by more than EPHEM_TOLERANCE, the class falls
+    back to calling PyEphem for every time stamp.
+
+    Args:
+        observer (ephem.Observer):  The observing site.  A copy is stored.
+
+    """
+
+    def __init__(self, observer):
+        self._observer = observer.copy()
+        self._sin_lat = np.sin(self._observer.lat)
+        self._cos_lat = np.cos(self._observer.lat)
+        self._sun = ephem.Sun()
+        self._moon = ephem.Moon()
+        self._chunks = OrderedDict()
+        self._exact = False
+        self._init_refraction()
+        return
+
+    def _init_refraction(self):
+        """Tabulate the PyEphem refraction against the unrefracted elevation."""
+        observer = self._observer
+        observer.date = ephem.J2000
+        lst = float(observer.sidereal_time())
+        body = ephem.FixedBody()
+        el_true = []
+        el_apparent = []
+        for ra in [lst, lst + np.pi]:
+            for dec in np.linspace(-0.5, 0.5, EPHEM_NREFRACTION) * np.pi:
+                body._ra = ra % (2 * np.pi)
+                body._dec = dec
+                body.compute(observer)
+                _, el = self._to_horizontal(float(body.ra), float(body.dec), lst)
+                el_true.append(el)
+                el_apparent.append(float(body.alt))
+        el_true = np.array(el_true)
+        el_apparent = np.array(el_apparent)
+        ind = np.argsort(el_true)
+        self._refraction_el = el_true[ind]
+        self._refraction = (el_apparent - el_true)[ind]
+        return
+
+    def _to_horizontal(self, ra, dec, lst):
+        """Rotate apparent equatorial coordinates to azimuth (East of North)
+        and unrefracted elevation.
+        """
+        ha = lst - ra
+        sin_dec, cos_dec = np.sin(dec), np.cos(dec)
+        cos_ha = np.cos(ha)
+        x = -cos_dec * np.sin(ha)
+        y = sin_dec * self._cos_lat - cos_dec * cos_ha * self._sin_lat
+        z = sin_dec * self._sin_lat + cos_dec * cos_ha * self._cos_lat
+        az = np.arctan2(x, y) % (2 * np.pi)
+        el = np.arcsin(np.clip(z, -1, 1))
+        return az, el
+
+    def _refract(self, el):
+        return el + np.interp(el, self._refraction_el, self._refraction)
+
+    def _get_chunk(self, ichunk):
+        """Tabulate the sidereal time, the Sun and the Moon for one block."""
+        if ichunk in self._chunks:
+            self._chunks.move_to_end(ichunk)
+            return self._chunks[ichunk]
+        observer = self._observer
+        nstep = int(np.ceil(EPHEM_CHUNK / EPHEM_STEP))
+        times = ichunk * EPHEM_CHUNK + np.arange(nstep + 1) * EPHEM_STEP
+        lst = np.zeros(nstep + 1)
+        radec = np.zeros([4, nstep + 1])
+        azel = np.zeros([4, nstep + 1])
+        for i, t in enumerate(times):
+            observer.date = to_DJD(t)
+            lst[i] = observer.sidereal_time()
+            for j, body in enumerate([self._sun, self._moon]):
+                body.compute(observer)
+                radec[2 * j, i] = body.ra
+                radec[2 * j + 1, i] = body.dec
+                azel[2 * j, i] = body.az
+                azel[2 * j + 1, i] = body.alt
+        chunk = {
+            "times": times,
+            "lst": np.unwrap(lst),
+            "sun": (np.unwrap(radec[0]), radec[1]),
+            "moon": (np.unwrap(radec[2]), radec[3]),
+            "fixed": dict(),
+        }
+        # Verify the vectorized transform against PyEphem
+        for j in range(2):
+            az, el = self._to_horizontal(radec[2 * j], radec[2 * j + 1], lst)
+            el = self._refract(el)
+            self._check(az, el, azel[2 * j], azel[2 * j + 1])
+        # The transform is exact at the grid points.  Also verify the
+        # interpolation halfway between two of them.
+        tmid = times[nstep // 2] + 0.5 * EPHEM_STEP
+        observer.date = to_DJD(tmid)
+        lst_mid = np.interp(tmid, times, chunk["lst"])
+        for name, body in [("sun", self._sun), ("moon", self._moon)]:
+            body.compute(observer)
+            ra, dec = chunk[name]
+            az, el = self._to_horizontal(
+                np.interp(tmid, times, ra), np.interp(tmid, times, dec), lst_mid
+            )
+            self._check(az, self._refract(el), body.az, body.alt)
+        self._chunks[ichunk] = chunk
+        if len(self._chunks) > EPHEM_NCHUNK:
+            self._chunks.popitem(last=False)
+        return chunk
+
+    def _check(self, az1, el1, az2, el2):
+        dist = angular_distance(az1, el1, az2, el2)
+        if np.amax(dist) > EPHEM_TOLERANCE:
+            log = Logger.get()
+            log.warning(
+                "Vectorized ephemeris differs from PyEphem by {:.2f} arc sec. "
+                "Using PyEphem directly.".format(np.degrees(np.amax(dist)) * 3600)
+            )
+            self._exact = True
+        return
+
+    def _split(self, times):
+        """Iterate over the blocks spanned by the time stamps."""
+        ichunks = np.floor(times / EPHEM_CHUNK).astype(np.int64)
+        for ichunk in np.unique(ichunks):
+            yield ichunk, ichunks == ichunk
+
+    def _exact_azel(self, bodies, times):
+        observer = self._observer
+        az = np.zeros([len(bodies), times.size])
+        el = np.zeros([len(bodies), times.size])
+        for i, t in enumerate(times):
+            observer.date = to_DJD(t)
+            for j, body in enumerate(bodies):
+                body.compute(observer)
+                az[j, i] = body.az
+                el[j, i] = body.alt
+        return az, el
+
+    def _solar_system_azel(self, name, times):
+        scalar = np.ndim(times) == 0
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        az = np.zeros(times.size)
+        el = np.zeros(times.size)
+        for ichunk, ind in self._split(times):
+            chunk = self._get_chunk(ichunk)
+            ra, dec = chunk[name]
+            t = times[ind]
+            az[ind], el[ind] = self._to_horizontal(
+                np.interp(t, chunk["times"], ra),
+                np.interp(t, chunk["times"], dec),
+                np.interp(t, chunk["times"], chunk["lst"]),
+            )
+        el = self._refract(el)
+        if self._exact:
+            body = self._sun if name == "sun" else self._moon
+            az, el = self._exact_azel([body], times)
+            az, el = az[0], el[0]
+        if scalar:
+            return az[0], el[0]
+        return az, el
+
+    def sun_azel(self, times):
+        """Return the azimuth and elevation of the Sun.
+
+        Args:
+            times (float or array):  UNIX time stamps.
+
+        Returns:
+            (tuple):  Azimuth and elevation in radians.
+
+        """
+        return self._solar_system_azel("sun", times)
+
+    def moon_azel(self, times):
+        """Return the azimuth and elevation of the Moon.
+
+        Args:
+            times (float or array):  UNIX time stamps.
+
+        Returns:
+            (tuple):  Azimuth and elevation in radians.
+
+        """
+        return self._solar_system_azel("moon", times)
+
+    def fixed_azel(self, bodies, times):
+        """Return the azimuth and elevation of fixed positions.
+
+        Args:
+            bodies (list):  ephem.FixedBody objects, e.g. patch corners.
+                They are not modified.
+            times (float or array):  UNIX time stamps.
+
+        Returns:
+            (tuple):  Azimuth and elevation in radians, with one row per
+                body and one column per time stamp.
+
+        """
+        scalar = np.ndim(times) == 0
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        nbody = len(bodies)
+        az = np.zeros([nbody, times.size])
+        el = np.zeros([nbody, times.size])
+        observer = self._observer
+        for ichunk, ind in self._split(times):
+            chunk = self._get_chunk(ichunk)
+            t = times[ind]
+            lst = np.interp(t, chunk["times"], chunk["lst"])
+            tnodes = chunk["times"][[0, -1]]
+            for ibody, body in enumerate(bodies):
+                key = (float(body._ra), float(body._dec), float(body._epoch))
+                if key not in chunk["fixed"]:
+                    # The apparent position of a fixed body hardly changes
+                    # during a block.  Evaluate it at both ends.
+                    fixed = ephem.FixedBody()
+                    fixed._ra, fixed._dec, fixed._epoch = key
+                    radec = np.zeros([2, 2])
+                    for i, tnode in enumerate(tnodes):
+                        observer.date = to_DJD(tnode)
+                        fixed.compute(observer)
+                        radec[:, i] = fixed.ra, fixed.dec
+                    radec[0] = np.unwrap(radec[0])
+                    chunk["fixed"][key] = radec
+                    # Verify the interpolation in the middle of the block
+                    tmid = np.mean(tnodes)
+                    observer.date = to_DJD(tmid)
+                    fixed.compute(observer)
+                    az_mid, el_mid = self._to_horizontal(
+                        np.mean(radec[0]),
+                        np.mean(radec[1]),
+                        np.interp(tmid, chunk["times"], chunk["lst"]),
+                    )
+                    self._check(az_mid, self._refract(el_mid), fixed.az, fixed.alt)
+                radec = chunk["fixed"][key]
+                az[ibody, ind], el[ibody, ind] = self._to_horizontal(
+                    np.interp(t, tnodes, radec[0]),
+                    np.interp(t, tnodes, radec[1]),
+                    lst,
+                )
+        el = self._refract(el)
+        if self._exact:
+            az, el = self._exact_azel(bodies, times)
+        if scalar:
+            return az[:, 0], el[:, 0]
+        return az, el
+
+
+def get_ephemeris(observer):
+    """Return the cached vectorized ephemeris for the observing site."""
+    key = (
+        float(observer.lat),
+        float(observer.lon),
+        float(observer.elevation),
+        float(observer.pressure),
+        float(observer.temp),
+    )
+    if key not in _ephemerides:
+        _ephemerides[key] = Ephemeris(observer)
+    return _ephemerides[key]
+
+
 def patch_is_rising(patch):
     try:
         # Horizontal patch definition
         rising = patch.rising
     except:
-        rising = True
-        for corner in patch.corners:
-            if corner.alt > 0 and corner.az > np.pi:
-                # The patch is setting
-                rising = False
-                break
+        # Use the corner coordinates, assuming they were already computed
+        azs, els = patch.corner_coordinates()
+        # The patch is setting if any corner above the horizon is setting
+        rising = not np.any(np.logical_and(els > 0, azs > np.pi))
     return rising
 
 
@@ -1122,17 +1425,27 @@ def get_constant_elevation_pole(
     return el
 
 
-def check_sun_el(t, observer, sun, sun_el_max, args, not_visible):
+def check_sun_el(t, observer, sun_el_max, patch, rising, not_visible, sun_el=None):
+    """Check if the Sun is above sun_el_max at time t.
+
+    Args:
+        sun_el (float):  Precomputed solar elevation at t.  If None,
+            it is evaluated from the site ephemeris.
+
+    Returns:
+        (bool):  True if the Sun is too high.
+
+    """
     log = Logger.get()
-    observer.date = to_DJD(t)
     if sun_el_max < np.pi / 2:
-        sun.compute(observer)
-        if sun.alt > sun_el_max:
+        if sun_el is None:
+            _, sun_el = get_ephemeris(observer).sun_azel(t)
+        if sun_el > sun_el_max:
             not_visible.append(
                 (
                     patch.name,
                     "Sun too high {:.2f} rising = {}"
-                    "".format(np.degrees(sun.alt), rising),
+                    "".format(np.degrees(sun_el), rising),
                 )
             )
             log.debug("NOT VISIBLE: {}".format(not_visible[-1]))
@@ -1161,7 +1474,7 @@ def scan_patch(
         # No corners.  Simply scan for the requested time
         if rising and not patch.rising:
             return False, azmins, azmaxs, aztimes, t
-        if check_sun_el(t, observer, sun, sun_el_max, args, not_visible):
+        if check_sun_el(t, observer, sun_el_max, patch, rising, not_visible):
             return False, azmins, azmaxs, aztimes, t
         azmins = [patch.az_min]
         azmaxs = [patch.az_max]
@@ -1174,6 +1487,8 @@ def scan_patch(
     tstep = 60
     to_cross = np.ones(len(patch.corners), dtype=bool)
     scan_started = False
+    ephemeris = get_ephemeris(observer)
+    istep = TRACK_BLOCK
     while True:
         if tstop > stop_timestamp or tstop - t > 86400:
             not_visible.append(
@@ -1181,9 +1496,24 @@ def scan_patch(
             )
             log.debug("NOT VISIBLE: {}".format(not_visible[-1]))
             break
-        if check_sun_el(tstop, observer, sun, sun_el_max, args, not_visible):
+        if istep == TRACK_BLOCK:
+            # Evaluate the Sun and the corners for the next block of steps
+            times = tstop + np.arange(TRACK_BLOCK) * tstep
+            _, sun_els = ephemeris.sun_azel(times)
+            corner_azs, corner_els = ephemeris.fixed_azel(patch.corners, times)
+            istep = 0
+        if check_sun_el(
+            tstop,
+            observer,
+            sun_el_max,
+            patch,
+            rising,
+            not_visible,
+            sun_el=sun_els[istep],
+        ):
             break
-        azs, els = patch.corner_coordinates(observer)
+        azs = corner_azs[:, istep]
+        els = corner_els[:, istep]
         has_extent = current_extent(
             azmins,
             azmaxs,
@@ -1228,7 +1558,9 @@ def scan_patch(
             success = False
             break
         tstop += tstep
+        istep += 1
 
+    observer.date = to_DJD(tstop)
     return success, azmins, azmaxs, aztimes, tstop
 
 
@@ -1268,6 +1600,8 @@ def scan_patch_pole(
     tstop = t
     tstep = 60
     azmins, azmaxs, aztimes = [], [], []
+    ephemeris = get_ephemeris(observer)
+    istep = TRACK_BLOCK
     while True:
         if tstop - t > args.pole_ces_time_s - 1:
             # Succesfully scanned the maximum time
@@ -1283,15 +1617,20 @@ def scan_patch_pole(
             not_visible.append((patch.name, "Ran out of time"))
             log.debug("NOT VISIBLE: {}".format(not_visible[-1]))
             break
-        observer.date = to_DJD(tstop)
-        sun.compute(observer)
-        if sun.alt > sun_el_max:
+        if istep == TRACK_BLOCK:
+            # Evaluate the Sun and the corners for the next block of steps
+            times = tstop + np.arange(TRACK_BLOCK) * tstep
+            _, sun_els = ephemeris.sun_azel(times)
+            corner_azs, corner_els = ephemeris.fixed_azel(patch.corners, times)
+            istep = 0
+        if sun_els[istep] > sun_el_max:
             not_visible.append(
-                (patch.name, "Sun too high {:.2f}".format(sun.alt / degree))
+                (patch.name, "Sun too high {:.2f}".format(sun_els[istep] / degree))
             )
             log.debug("NOT VISIBLE: {}".format(not_visible[-1]))
             break
-        azs, els = patch.corner_coordinates(observer)
+        azs = corner_azs[:, istep]
+        els = corner_els[:, istep]
         if np.amax(els) + fp_radius < el:
             not_visible.append((patch.name, "Patch below {:.2f}".format(el / degree)))
             log.debug("NOT VISIBLE: {}".format(not_visible[-1]))
@@ -1301,6 +1640,8 @@ def scan_patch_pole(
             azmins, azmaxs, aztimes, patch.corners, radius, el, azs, els, tstop
         )
         tstop += tstep
+        istep += 1
+    observer.date = to_DJD(tstop)
     return success, azmins, azmaxs, aztimes, tstop
 
 
@@ -1369,25 +1710,24 @@ def current_extent(
     line between the corners.
 
     """
-    azs_cross = []
-    for i in range(len(corners)):
-        j = (i + 1) % len(corners)
-        for el0 in [el - fp_radius, el, el + fp_radius]:
-            if (els[i] - el0) * (els[j] - el0) < 0:
-                # The corners are on opposite sides of the elevation line
-                az1 = azs[i]
-                az2 = azs[j]
-                el1 = els[i] - el0
-                el2 = els[j] - el0
-                az2 = unwind_angle(az1, az2)
-                az_cross = (az1 + el1 * (az2 - az1) / (el1 - el2)) % (2 * np.pi)
-                azs_cross.append(az_cross)
-            if fp_radius == 0:
-                break
-    if len(azs_cross) == 0:
+    if fp_radius == 0:
+        el0 = np.array([el])
+    else:
+        el0 = np.array([el - fp_radius, el, el + fp_radius])
+    # Pair each corner with the next one and unwind the azimuths
+    # of the next corners to match
+    az1 = np.tile(azs, [el0.size, 1])
+    az2 = np.roll(az1, -1, axis=1)
+    az2 += 2 * np.pi * np.round((az1 - az2) / (2 * np.pi))
+    el1 = els - el0[:, np.newaxis]
+    el2 = np.roll(el1, -1, axis=1)
+    # Find the corners that are on opposite sides of the elevation lines
+    cross = el1 * el2 < 0
+    if not np.any(cross):
         return False
+    az1, az2, el1, el2 = az1[cross], az2[cross], el1[cross], el2[cross]
+    azs_cross = (az1 + el1 * (az2 - az1) / (el1 - el2)) % (2 * np.pi)
 
-    azs_cross = np.array(azs_cross)
     if rising:
         good = azs_cross < np.pi
     else:
@@ -1949,6 +2289,8 @@ def build_schedule(args, start_timestamp, stop_timestamp, patches, observer, sun
     # Operational days
     ods = set()
 
+    ephemeris = get_ephemeris(observer)
+
     t = start_timestamp
     last_successful = t
     while True:
@@ -1978,16 +2320,17 @@ def build_schedule(args, start_timestamp, stop_timestamp, patches, observer, sun
 
         log.debug("t = {}".format(to_UTC(t)))
         # Determine which patches are visible
-        observer.date = to_DJD(t)
-        sun.compute(observer)
-        if sun.alt > sun_el_max:
+        _, sun_el = ephemeris.sun_azel(t)
+        if sun_el > sun_el_max:
             log.debug(
                 "Sun elevation is {:.2f} > {:.2f}. Moving on.".format(
-                    sun.alt / degree, sun_el_max / degree
+                    sun_el / degree, sun_el_max / degree
                 )
             )
             t = advance_time(t, args.time_step_s)
             continue
+        observer.date = to_DJD(t)
+        sun.compute(observer)
         moon.compute(observer)
 
         visible, not_visible = get_visible(args, observer, sun, moon, patches, el_min)
@@ -14,7 +14,7 @@ import healpy as hp
 
 from ..tod import AnalyticNoise, OpSimNoise
 from ..todmap import TODSatellite, OpPointingHpix, OpAccumDiag
-from ..todmap.todmap_math import cov_accum_diag
+from .._libtoast import cov_accum_diag, cov_accum_diag_flagged
 from ..map import DistPixels, covariance_invert, covariance_rcond, covariance_multiply
 
 from ._helpers import (
@@ -214,6 +214,82 @@ class CovarianceTest(MPITestCase):
 
         return
 
+    def test_accum_flagged(self):
+        nsm = 2
+        npix = 3
+        nnz = 4
+        block = int(nnz * (nnz + 1) / 2)
+        scale = 2.0
+        nsamp = 4 * nsm * npix
+
+        def create(nnz, dtype):
+            # Only the second submap is stored locally
+            return DistPixels(
+                None,
+                comm=self.data.comm.comm_world,
+                npix=nsm * npix,
+                nnz=nnz,
+                dtype=dtype,
+                npix_submap=npix,
+                local_submaps=np.array([1], dtype=np.int64),
+            )
+
+        fake = create(nnz, np.float64)
+        check = fake.duplicate()
+        hits = create(1, np.int64)
+        checkhits = hits.duplicate()
+        invn = create(block, np.float64)
+        checkinvn = invn.duplicate()
+
+        # Single precision pointing, including invalid pixels
+        pixels = (np.arange(nsamp) % (nsm * npix)).astype(np.int32)
+        pixels[::7] = -1
+        weights = np.random.uniform(size=(nsamp, nnz)).astype(np.float32)
+        common = np.zeros(nsamp, dtype=np.uint8)
+        common[::5] = 1
+        det = np.zeros(nsamp, dtype=np.uint8)
+        det[::3] = 2
+        signal = np.random.normal(size=nsamp)
+
+        cov_accum_diag_flagged(
+            1,
+            npix,
+            nnz,
+            pixels,
+            weights,
+            common,
+            np.uint8(1),
+            det,
+            np.uint8(2),
+            fake.glob2loc,
+            scale,
+            signal,
+            invn.flatdata,
+            hits.flatdata,
+            fake.flatdata,
+        )
+
+        wt = weights.astype(np.float64)
+        for i in range(nsamp):
+            if pixels[i] < 0 or common[i] != 0 or det[i] != 0:
+                continue
+            if pixels[i] // npix != 1:
+                continue
+            pix = pixels[i] % npix
+            checkhits.data[0, pix, 0] += 1
+            off = 0
+            for j in range(nnz):
+                check.data[0, pix, j] += scale * signal[i] * wt[i, j]
+                for k in range(j, nnz):
+                    checkinvn.data[0, pix, off] += scale * wt[i, j] * wt[i, k]
+                    off += 1
+
+        nt.assert_equal(hits.data, checkhits.data)
+        nt.assert_almost_equal(fake.data, check.data)
+        nt.assert_almost_equal(invn.data, checkinvn.data)
+
+        return
+
     def test_invert(self):
         nsm = 2
         npix = 3
@@ -322,6 +398,35 @@ class CovarianceTest(MPITestCase):
 
         return
 
+    def test_allreduce(self):
+        # make a simple pointing matrix
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode="IQU")
+        pointing.exec(self.data)
+
+        # accumulate the same inverse covariance and hits twice
+
+        maps = []
+        for i in range(2):
+            invnpp = DistPixels(self.data, nnz=6, dtype=np.float64)
+            invnpp.data.fill(0.0)
+            hits = DistPixels(self.data, nnz=1, dtype=np.int64)
+            hits.data.fill(0)
+            build_invnpp = OpAccumDiag(invnpp=invnpp, hits=hits)
+            build_invnpp.exec(self.data)
+            maps.append((invnpp, hits))
+
+        # reduce with both methods and compare
+
+        maps[0][0].allreduce(sparse=True)
+        maps[0][1].allreduce(sparse=True)
+        maps[1][0].allreduce(sparse=False)
+        maps[1][1].allreduce(sparse=False)
+
+        nt.assert_almost_equal(maps[0][0].data, maps[1][0].data)
+        nt.assert_equal(maps[0][1].data, maps[1][1].data)
+
+        return
+
     def test_distpix_init(self):
         # make a simple pointing matrix
         pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode="IQU")
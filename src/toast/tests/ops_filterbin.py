@@ -30,6 +30,7 @@ from ..todmap import (
     OpFilterBin,
     OpSimScan,
 )
+from ..todmap.filterbin import ObsMatrixFile, reduce_csr_slices
 
 from .. import qarray as qa
 
@@ -451,3 +452,109 @@ class OpFilterBinTest(MPITestCase):
             np.testing.assert_array_almost_equal(outmap, outmap_test)
 
         return
+
+    def test_filterbin_cache(self):
+
+        # Round trip a small matrix through the file format
+        fname = os.path.join(self.outdir, "test_matrix.obm")
+        matrix = scipy.sparse.random(50, 50, density=0.1, format="csr")
+        if self.rank == 0:
+            ObsMatrixFile.write(fname, matrix, {"nside": 1})
+            obm = ObsMatrixFile(fname)
+            self.assertEqual(obm.metadata, {"nside": 1})
+            np.testing.assert_array_equal(obm.matrix().toarray(), matrix.toarray())
+            np.testing.assert_array_equal(
+                obm.rows(10, 20).toarray(), matrix[10:20].toarray()
+            )
+            rows = np.array([1, 7, 33])
+            np.testing.assert_array_equal(
+                obm.take_rows(rows).toarray(), matrix[rows].toarray()
+            )
+
+        inmapfile = os.path.join(self.outdir, "input_map3.fits")
+        make_input_map(self.lmax, self.sim_nside, inmapfile)
+
+        name = "testtod4"
+
+        pointing = OpPointingHpix(
+            nside=self.map_nside, nest=True, mode=self.pointingmode
+        )
+        pointing.exec(self.data)
+
+        distmap = DistPixels(self.data, nnz=self.nnz, dtype=np.float32)
+        distmap.read_healpix_fits(inmapfile)
+        scansim = OpSimScan(input_map=distmap, out=name)
+        scansim.exec(self.data)
+
+        cache_dir = os.path.join(self.outdir, "obs_matrix_cache")
+        obs_matrices = []
+        # The first pass accumulates and caches, the second one loads
+        for outprefix in "toast_cache1_", "toast_cache2_":
+            filterbin = OpFilterBin(
+                nside=self.map_nside,
+                nnz=self.nnz,
+                name=name,
+                outdir=self.outdir,
+                outprefix=outprefix,
+                write_obs_matrix=True,
+                ground_filter_order=3,
+                poly_filter_order=20,
+                common_flag_mask=255,
+                cache_dir=cache_dir,
+            )
+            filterbin.exec(self.data, self.comm)
+            for obs in self.data.obs:
+                for det in obs["tod"].local_dets:
+                    fname = os.path.join(cache_dir, obs["name"], det + ".obm")
+                    self.assertTrue(os.path.isfile(fname))
+            if self.comm is not None:
+                self.comm.barrier()
+            if self.rank == 0:
+                rootname = os.path.join(self.outdir, outprefix + "obs_matrix")
+                combine_observation_matrix(rootname)
+                obs_matrices.append(scipy.sparse.load_npz(rootname + ".npz"))
+
+        if self.rank == 0:
+            # The cached observation matrix reproduces the filtering
+            np.testing.assert_array_almost_equal(
+                obs_matrices[0].toarray(), obs_matrices[1].toarray()
+            )
+            fname = os.path.join(self.outdir, "toast_cache1_filtered.fits.gz")
+            outmap = hp.read_map(fname, None, nest=True)
+            inmap = hp.read_map(inmapfile, None, nest=True)
+            outmap_test = obs_matrices[0].dot(inmap.ravel()).reshape([self.nnz, -1])
+            np.testing.assert_array_almost_equal(outmap, outmap_test)
+
+        return
+
+    def test_reduce_csr_slices(self):
+        rank = 0
+        ntask = 1
+        if self.comm is not None:
+            rank = self.comm.rank
+            ntask = self.comm.size
+        nrow = 1000
+        # Mostly disjoint sparsity patterns with some overlap
+        local = scipy.sparse.random(
+            nrow, nrow, density=0.01, format="csr", random_state=rank
+        )
+        local = local + scipy.sparse.eye(nrow, format="csr")
+        if self.comm is None:
+            expected = local
+        else:
+            expected = sum(self.comm.allgather(local))
+
+        nslice = 7
+        owned = []
+        for islice, row_start, row_stop, matrix in reduce_csr_slices(
+            self.comm, lambda start, stop: local[start:stop], nrow, nrow, nslice
+        ):
+            self.assertEqual(islice % ntask, rank)
+            np.testing.assert_array_almost_equal(
+                matrix.toarray(), expected[row_start:row_stop].toarray()
+            )
+            owned.append(islice)
+        if self.comm is not None:
+            owned = sum(self.comm.allgather(owned), [])
+        self.assertEqual(sorted(owned), list(range(nslice)))
+        return
@@ -45,6 +45,7 @@ class OpGroundFilterTest(MPITestCase):
             fmin=1.0e-5,
             fknee=np.linspace(0.0, 0.1, num=self.ndet),
         )
+        self.dquat = dquat
 
         # Samples per observation
         self.totsamp = 100000
@@ -160,3 +161,75 @@ class OpGroundFilterTest(MPITestCase):
                     )
                 del y
         return
+
+    def test_filter_flags(self):
+        # Detectors with different flag patterns are grouped by their
+        # sample mask.  Compare against fitting every detector separately,
+        # both with the data distributed by detector and by time.
+        order = 3
+        blocklen = 1000
+        for detranks in [self.data.comm.group_size, 1]:
+            tod = TODGround(
+                self.data.comm.comm_group,
+                self.dquat,
+                self.totsamp,
+                detranks=detranks,
+                firsttime=0.0,
+                rate=self.rate,
+                azmin=45,
+                azmax=55,
+                el=45,
+            )
+            ob = self.data.obs[0]
+            ob["tod"] = tod
+
+            op = OpSimNoise()
+            op.exec(self.data)
+
+            offset, nsamp = tod.local_samples
+            block = (offset + np.arange(nsamp)) // blocklen
+            az = tod.read_boresight_az()
+            signals = {}
+            goods = {}
+            for det in tod.local_dets:
+                idet = tod.detectors.index(det)
+                y = tod.cache.reference("noise_{}".format(det))
+                y += np.sin(az)
+                signals[det] = y.copy()
+                del y
+                # Every third detector shares the same flags
+                flags = np.zeros(nsamp, dtype=np.uint8)
+                flags[block % (idet % 3 + 2) == 0] = 1
+                tod.cache.put("test_flags_{}".format(det), flags, replace=True)
+                goods[det] = flags == 0
+
+            op = OpGroundFilter(
+                name="noise",
+                flag_name="test_flags",
+                common_flag_mask=0,
+                filter_order=order,
+                trend_order=1,
+                detrend=True,
+            )
+            templates, _, _ = op.build_templates(tod, ob)
+            op.exec(self.data)
+
+            comm = tod.grid_comm_row
+            for det in tod.local_dets:
+                good = goods[det]
+                signal = signals[det]
+                good_templates = templates[:, good]
+                invcov = np.dot(good_templates, good_templates.T)
+                proj = np.dot(good_templates, signal[good])
+                if comm is not None:
+                    invcov = comm.allreduce(invcov)
+                    proj = comm.allreduce(proj)
+                coeff = np.linalg.solve(invcov, proj)
+                expected = signal - np.dot(coeff, templates)
+                expected[np.logical_not(good)] = 0
+                y = tod.cache.reference("noise_{}".format(det))
+                np.testing.assert_allclose(
+                    y, expected, rtol=1e-6, atol=1e-6 * np.std(signal)
+                )
+                del y
+        return
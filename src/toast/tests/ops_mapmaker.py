@@ -15,7 +15,8 @@ import numpy as np
 from ..timing import gather_timers, GlobalTimers
 from ..timing import dump as dump_timing
 from ..tod import AnalyticNoise, OpSimNoise, Interval, OpCacheCopy, OpCacheInit
-from ..map import DistPixels
+from ..map import DistPixels, covariance_invert
+from ..map.pixels import LOCAL_PIXELS_TAG
 from ..todmap import (
     TODHpixSpiral,
     OpSimGradient,
@@ -23,8 +24,9 @@ from ..todmap import (
     OpMadam,
     OpMapMaker,
     OpSimScan,
+    OpAccumDiag,
 )
-from ..todmap.mapmaker import TemplateMatrix, OffsetTemplate, Signal
+from ..todmap.mapmaker import TemplateMatrix, OffsetTemplate, ProjectionMatrix, Signal
 from .. import qarray as qa
 
 from ._helpers import create_outdir, create_distdata, boresight_focalplane
@@ -483,3 +485,228 @@ class OpMapMakerTest(MPITestCase):
         self.assertFalse(failed)
 
         return
+
+    def test_mapmaker_pipelined(self):
+
+        name = "testtod3"
+
+        # make a simple pointing matrix
+        pointing = OpPointingHpix(
+            nside=self.map_nside, nest=True, mode=self.pointingmode
+        )
+        pointing.exec(self.data)
+
+        # Scan the signal from a map
+        distmap = DistPixels(self.data, nnz=self.nnz, dtype=np.float32)
+        distmap.read_healpix_fits(self.inmapfile)
+
+        scansim = OpSimScan(input_map=distmap, out=name)
+        scansim.exec(self.data)
+
+        # Add simulated noise
+        opnoise = OpSimNoise(realization=0, out=name)
+        opnoise.exec(self.data)
+
+        # Copy the signal for the second solver variant
+        name_copy = name + "_copy"
+        cachecopy = OpCacheCopy(name, name_copy)
+        cachecopy.exec(self.data)
+
+        for variant, signal_name in [
+            ("standard", name),
+            ("pipelined", name_copy),
+        ]:
+            mapmaker = OpMapMaker(
+                nside=self.map_nside,
+                nnz=self.nnz,
+                name=signal_name,
+                outdir=self.outdir,
+                outprefix="toast_{}_".format(variant),
+                baseline_length=1,
+                maskfile=self.maskfile_binary,
+                subharmonic_order=None,
+                iter_max=100,
+                use_noise_prior=True,
+                precond_width=30,
+                pcg_variant=variant,
+            )
+            mapmaker.exec(self.data)
+
+        # Compare
+
+        failed = False
+        if self.rank == 0:
+            m0 = hp.read_map(
+                os.path.join(self.outdir, "toast_standard_destriped.fits"), None
+            )
+            m1 = hp.read_map(
+                os.path.join(self.outdir, "toast_pipelined_destriped.fits"), None
+            )
+            good = m0[0] != hp.UNSEEN
+            for i in range(self.nnz):
+                if not np.allclose(m0[i][good], m1[i][good], rtol=1e-4, atol=1e-6):
+                    print("Standard and pipelined PCG do not agree.")
+                    failed = True
+        if self.comm is not None:
+            failed = self.comm.bcast(failed, root=0)
+        self.assertFalse(failed)
+
+        return
+
+    def test_mapmaker_block(self):
+
+        names = ["testtod4", "testtod5"]
+
+        # make a simple pointing matrix
+        pointing = OpPointingHpix(
+            nside=self.map_nside, nest=True, mode=self.pointingmode
+        )
+        pointing.exec(self.data)
+
+        # Scan the signal from a map
+        distmap = DistPixels(self.data, nnz=self.nnz, dtype=np.float32)
+        distmap.read_healpix_fits(self.inmapfile)
+
+        for realization, name in enumerate(names):
+            scansim = OpSimScan(input_map=distmap, out=name)
+            scansim.exec(self.data)
+            # Add an independent noise realization to each signal
+            opnoise = OpSimNoise(realization=realization, out=name)
+            opnoise.exec(self.data)
+            # Copy the signal for the reference solve
+            cachecopy = OpCacheCopy(name, name + "_copy")
+            cachecopy.exec(self.data)
+
+        # Solve the signals one at a time
+
+        for name in names:
+            mapmaker = OpMapMaker(
+                nside=self.map_nside,
+                nnz=self.nnz,
+                name=name + "_copy",
+                outdir=self.outdir,
+                outprefix="toast_single_{}_".format(name),
+                baseline_length=1,
+                iter_max=100,
+                use_noise_prior=True,
+                precond_width=30,
+            )
+            mapmaker.exec(self.data)
+
+        # Solve all signals in one batch
+
+        mapmaker = OpMapMaker(
+            nside=self.map_nside,
+            nnz=self.nnz,
+            name=names,
+            outdir=self.outdir,
+            outprefix="toast_block_",
+            baseline_length=1,
+            iter_max=100,
+            use_noise_prior=True,
+            precond_width=30,
+        )
+        mapmaker.exec(self.data)
+
+        # Compare
+
+        failed = False
+        if self.rank == 0:
+            for name in names:
+                m0 = hp.read_map(
+                    os.path.join(
+                        self.outdir, "toast_single_{}_destriped.fits".format(name)
+                    ),
+                    None,
+                )
+                m1 = hp.read_map(
+                    os.path.join(
+                        self.outdir, "toast_block_{}_destriped.fits".format(name)
+                    ),
+                    None,
+                )
+                for i in range(self.nnz):
+                    if not np.allclose(m0[i], m1[i], rtol=1e-4, atol=1e-6):
+                        print("Single and block PCG do not agree for {}.".format(name))
+                        failed = True
+        if self.comm is not None:
+            failed = self.comm.bcast(failed, root=0)
+        self.assertFalse(failed)
+
+        return
+
+    def test_projection_matrix(self):
+
+        name = "testtod6"
+
+        pointing = OpPointingHpix(
+            nside=self.map_nside, nest=True, mode=self.pointingmode
+        )
+        pointing.exec(self.data)
+
+        distmap = DistPixels(self.data, nnz=self.nnz, dtype=np.float32)
+        distmap.read_healpix_fits(self.inmapfile)
+        scansim = OpSimScan(input_map=distmap, out=name)
+        scansim.exec(self.data)
+        opnoise = OpSimNoise(realization=0, out=name)
+        opnoise.exec(self.data)
+
+        # Flag a few samples to exercise the separate binning pixels
+        for obs in self.data.obs:
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                flags = tod.local_flags(det)
+                flags[::7] = 1
+                del flags
+
+        detweights = [{det: 1.0 for det in obs["tod"].local_dets}]
+        invnpp = DistPixels(self.data, nnz=6, dtype=np.float64)
+        invnpp.data.fill(0)
+        accum = OpAccumDiag(detweights=detweights[0], invnpp=invnpp)
+        accum.exec(self.data)
+        invnpp.allreduce()
+        covariance_invert(invnpp, 1e-3)
+
+        signal = Signal(self.data, name=name)
+        projection = ProjectionMatrix(
+            self.data, self.comm, detweights, self.nnz, invnpp
+        )
+
+        # Reference: bin with OpAccumDiag and scan with OpSimScan
+        projection.bin_map(name)
+        reference = signal.copy()
+        scanned = Signal(self.data, temporary=True, init_val=0)
+        projection.scan_map(scanned.name)
+        reference -= scanned
+
+        # The second application uses the cached pixel translation
+        for _ in range(2):
+            projected = projection.apply(signal)
+            for obs in self.data.obs:
+                tod = obs["tod"]
+                for det in tod.local_dets:
+                    np.testing.assert_allclose(
+                        tod.local_signal(det, projected.name),
+                        tod.local_signal(det, reference.name),
+                        rtol=1e-8,
+                        atol=1e-10,
+                    )
+        self.assertEqual(
+            len(projection._flag_cache),
+            sum(len(obs["tod"].local_dets) for obs in self.data.obs),
+        )
+
+        # Releasing the cache discards the memoized local pixels
+        localname = "pixels_{}" + LOCAL_PIXELS_TAG + projection.dist_map.local_key
+        for obs in self.data.obs:
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                self.assertTrue(tod.cache.exists(localname.format(det)))
+        projection.clear_pixel_cache()
+        self.assertEqual(len(projection._flag_cache), 0)
+        for obs in self.data.obs:
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                self.assertFalse(tod.cache.exists(localname.format(det)))
+
+        return
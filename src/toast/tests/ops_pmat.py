@@ -11,7 +11,16 @@ import numpy as np
 
 from .._libtoast import pointing_matrix_healpix
 from ..healpix import HealpixPixels
+from ..map import DistPixels
+from ..map.pixels import LOCAL_PIXELS_TAG, clear_local_pixels
 from ..todmap import TODHpixSpiral, OpPointingHpix
+from ..todmap.pointing import (
+    pointing_blocks,
+    local_pointing_blocks,
+    compress_pixels,
+    decompress_pixels,
+    decompress_pixel_block,
+)
 from .. import qarray as qa
 
 from ._helpers import create_outdir, create_distdata, boresight_focalplane
@@ -283,3 +292,158 @@ class OpPointingHpixTest(MPITestCase):
         if rank == 0:
             handle.close()
         return
+
+    def test_hpix_lazy(self):
+        # Expand the pointing into the cache
+        op = OpPointingHpix(nside=16, nest=True, mode="IQU")
+        op.exec(self.data)
+
+        tod = self.data.obs[0]["tod"]
+        cached = {}
+        for det in tod.local_dets:
+            cached[det] = (
+                tod.cache.reference("pixels_{}".format(det)).copy(),
+                tod.cache.reference("weights_{}".format(det)).copy(),
+            )
+
+        # Lazy expansion must reproduce the cached pointing without storing it
+        op = OpPointingHpix(
+            pixels="lazypixels",
+            weights="lazyweights",
+            nside=16,
+            nest=True,
+            mode="IQU",
+            lazy=True,
+        )
+        op.exec(self.data)
+
+        obs = self.data.obs[0]
+        for det in tod.local_dets:
+            self.assertFalse(tod.cache.exists("lazypixels_{}".format(det)))
+            blocks = [
+                (bslice, pixels.copy(), weights.copy())
+                for bslice, pixels, weights in pointing_blocks(
+                    obs, det, pixels="lazypixels", weights="lazyweights"
+                )
+            ]
+            for bslice, pixels, weights in blocks:
+                np.testing.assert_equal(pixels, cached[det][0][bslice])
+                np.testing.assert_almost_equal(weights, cached[det][1][bslice])
+        np.testing.assert_equal(
+            self.data["lazypixels_local_submaps"], self.data["pixels_local_submaps"]
+        )
+
+        # Single precision expansion
+        op = OpPointingHpix(
+            pixels="sppixels",
+            weights="spweights",
+            nside=16,
+            nest=True,
+            mode="IQU",
+            single_precision=True,
+        )
+        op.exec(self.data)
+        for det in tod.local_dets:
+            pixels = tod.cache.reference("sppixels_{}".format(det))
+            weights = tod.cache.reference("spweights_{}".format(det))
+            self.assertEqual(pixels.dtype, np.int32)
+            self.assertEqual(weights.dtype, np.float32)
+            np.testing.assert_equal(pixels, cached[det][0])
+            np.testing.assert_almost_equal(weights, cached[det][1], decimal=5)
+        return
+
+    def test_hpix_compressed(self):
+        # Round trip through the codec, including flagged samples and
+        # blocks that do not divide the sample count
+        np.random.seed(12345)
+        pixels = np.cumsum(np.random.randint(-3, 4, size=1000)) + 100000
+        pixels[100:120] = -1
+        pixels[500] = 12 * 1024 ** 2 - 1
+        index, packed = compress_pixels(pixels, 64)
+        np.testing.assert_equal(decompress_pixels(index, packed), pixels)
+        bslice, block = decompress_pixel_block(index, packed, 3)
+        np.testing.assert_equal(block, pixels[bslice])
+        self.assertLess(packed.nbytes, pixels.nbytes // 4)
+
+        # Compressed pointing in the cache must match the plain pointing
+        op = OpPointingHpix(nside=16, nest=True, mode="IQU")
+        op.exec(self.data)
+        op = OpPointingHpix(
+            pixels="zpixels",
+            weights="zweights",
+            nside=16,
+            nest=True,
+            mode="IQU",
+            compress_pixels=True,
+        )
+        op.exec(self.data)
+
+        obs = self.data.obs[0]
+        tod = obs["tod"]
+        for det in tod.local_dets:
+            self.assertFalse(tod.cache.exists("zpixels_{}".format(det)))
+            reference = tod.cache.reference("pixels_{}".format(det))
+            for bslice, pixels, weights in pointing_blocks(
+                obs, det, pixels="zpixels", weights="zweights"
+            ):
+                np.testing.assert_equal(pixels, reference[bslice])
+        np.testing.assert_equal(
+            self.data["zpixels_local_submaps"], self.data["pixels_local_submaps"]
+        )
+        return
+
+    def test_local_pixels_memo(self):
+        obs = self.data.obs[0]
+        tod = obs["tod"]
+        op = OpPointingHpix(nside=16, nest=True, mode="IQU", nside_submap=4)
+        op.exec(self.data)
+        distmap = DistPixels(self.data, nnz=3)
+        localname = "pixels_{}" + LOCAL_PIXELS_TAG + distmap.local_key
+
+        for det in tod.local_dets:
+            pixels = tod.cache.reference("pixels_{}".format(det))
+            ref_sm, ref_lpix = distmap.global_to_local(pixels)
+            # Memoization is opt-in
+            for bslice, sm, lpix, weights in local_pointing_blocks(obs, det, distmap):
+                np.testing.assert_equal(sm, ref_sm[bslice])
+                np.testing.assert_equal(lpix, ref_lpix[bslice])
+            self.assertFalse(tod.cache.exists(localname.format(det)))
+            # The first pass memoizes, the second one reuses the translation
+            for _ in range(2):
+                blocks = list(local_pointing_blocks(obs, det, distmap, memoize=True))
+                self.assertEqual(len(blocks), 1)
+                bslice, sm, lpix, weights = blocks[0]
+                self.assertEqual(sm.dtype, np.int64)
+                self.assertEqual(lpix.dtype, np.int64)
+                np.testing.assert_equal(sm, ref_sm)
+                np.testing.assert_equal(lpix, ref_lpix)
+                self.assertTrue(tod.cache.exists(localname.format(det)))
+            # Small distributions are stored compactly
+            memo = tod.cache.reference(localname.format(det))
+            self.assertEqual(memo.dtype, np.int32)
+            del memo
+            del pixels
+
+        # Clearing one distribution leaves the others alone
+        det = tod.local_dets[0]
+        clear_local_pixels(tod.cache, "pixels_{}".format(det), "x" * 16)
+        self.assertTrue(tod.cache.exists(localname.format(det)))
+        clear_local_pixels(tod.cache, "pixels_{}".format(det), distmap.local_key)
+        self.assertFalse(tod.cache.exists(localname.format(det)))
+
+        # Recomputing the pointing must discard the memoized translation
+        op = OpPointingHpix(nside=32, nest=True, mode="IQU", nside_submap=4)
+        op.exec(self.data)
+        for det in tod.local_dets:
+            self.assertFalse(tod.cache.exists(localname.format(det)))
+        distmap = DistPixels(self.data, nnz=3)
+        for det in tod.local_dets:
+            pixels = tod.cache.reference("pixels_{}".format(det))
+            sm, lpix = distmap.cached_global_to_local(
+                tod.cache, "pixels_{}".format(det)
+            )
+            ref_sm, ref_lpix = distmap.global_to_local(pixels)
+            np.testing.assert_equal(sm, ref_sm)
+            np.testing.assert_equal(lpix, ref_lpix)
+            del pixels
+        return
@@ -191,6 +191,91 @@ class OpPolyFilterTest(MPITestCase):
                 del y
         return
 
+    def test_2D_filter_flags(self):
+        # generate timestreams
+        op = OpSimNoise()
+        op.exec(self.data)
+
+        # Replace the noise with time stamps and flag every detector
+        # with a different pattern
+        blocklen = 100
+        ndet = self.ndet
+        for ob in self.data.obs:
+            tod = ob["tod"]
+            offset, nsamp = tod.local_samples
+            t = tod.read_times()
+            block = (offset + np.arange(nsamp)) // blocklen
+            tod.cache.put("test_common", np.zeros(nsamp, dtype=np.uint8))
+            for det in tod.local_dets:
+                idet = tod.detectors.index(det)
+                y = tod.cache.reference("noise_{}".format(det))
+                y[:] = t
+                del y
+                flags = np.zeros(nsamp, dtype=np.uint8)
+                flags[block % (idet + 2) == 0] = 1
+                tod.cache.put("test_flags_{}".format(det), flags)
+
+        # Filter timestreams.  The constant mode can be fitted to every
+        # sample with at least one unflagged detector.
+        op = OpPolyFilter2D(
+            name="noise",
+            order=0,
+            common_flag_name="test_common",
+            flag_name="test_flags",
+        )
+        op.exec(self.data)
+
+        # Samples that are flagged for all detectors must be left
+        # untouched and flagged.  Everything else is filtered out.
+
+        for ob in self.data.obs:
+            tod = ob["tod"]
+            offset, nsamp = tod.local_samples
+            t = tod.read_times()
+            block = (offset + np.arange(nsamp)) // blocklen
+            all_flagged = np.ones(nsamp, dtype=bool)
+            for idet in range(ndet):
+                all_flagged &= block % (idet + 2) == 0
+            common = tod.local_common_flags("test_common")
+            np.testing.assert_array_equal(common & 1 != 0, all_flagged)
+            for det in tod.local_dets:
+                y = tod.cache.reference("noise_{}".format(det))
+                np.testing.assert_array_equal(y[all_flagged], t[all_flagged])
+                good = np.logical_not(all_flagged)
+                np.testing.assert_allclose(
+                    y[good], 0, atol=1e-6 * np.amax(np.abs(t))
+                )
+                del y
+        return
+
+    def test_2D_inverses(self):
+        # Compare the batched and cached inverse template covariances
+        # against inverting every sample separately
+        np.random.seed(12345)
+        ndet = 8
+        nmode = 3
+        nsample = 500
+        templates = np.random.randn(ndet, nmode)
+        masks = np.random.rand(nsample, ndet) < 0.8
+        # Too few detectors to constrain all modes, make these singular
+        masks[np.sum(masks, axis=1) < nmode] = False
+        masks[:10] = False
+
+        op = OpPolyFilter2D()
+        cache = {}
+        for mask_block in masks[: nsample // 2], masks[nsample // 2 :]:
+            covs = op._get_inverses(mask_block, templates, cache)
+            for mask, cov in zip(mask_block, covs):
+                invcov = np.dot(templates[mask].T, templates[mask])
+                if np.any(mask):
+                    expected = np.linalg.inv(invcov)
+                else:
+                    expected = np.zeros([nmode, nmode])
+                np.testing.assert_allclose(cov, expected, rtol=1e-10, atol=1e-10)
+        patterns = np.unique(masks, axis=0)
+        self.assertEqual(len(cache), len(patterns))
+        return
+
     def test_common_filter(self):
         # generate timestreams
         op = OpSimNoise()
@@ -21,6 +21,10 @@ from ..todmap import (
     atm_available_utils,
 )
 
+from ..todmap.atm import AtmSim, atm_shells
+
+from ..pipeline_tools.atm import _atm_tables, _atm_spectra, atm_table_spectra
+
 from ..weather import Weather
 
 from ._helpers import (
@@ -291,3 +295,225 @@ class OpsSimAtmosphereTest(MPITestCase):
                 nt.assert_allclose(ref1[:], ref2, rtol=1e-7)
 
         return
+
+    def test_observe_many(self):
+        # Observing several detectors at once must agree with observing
+        # them one by one.
+        azmin, azmax = np.radians(40), np.radians(50)
+        elmin, elmax = np.radians(45), np.radians(55)
+        tmin, tmax = 0, 100
+        sim = AtmSim(
+            azmin,
+            azmax,
+            elmin,
+            elmax,
+            tmin,
+            tmax,
+            0.01,
+            0.001,
+            10,
+            10,
+            10,
+            0,
+            0,
+            0,
+            2000,
+            0,
+            280,
+            0,
+            40000.0,
+            2000.0,
+            100.0,
+            100.0,
+            100.0,
+            10000,
+            self.comm,
+            0,
+            0,
+            0,
+            0,
+            None,
+            0,
+            10000,
+        )
+        sim.simulate()
+
+        ndet = 4
+        nsamp = 1000
+        times = np.linspace(tmin, tmax, nsamp)
+        phase = np.linspace(0, 2 * np.pi, nsamp)
+        az = np.vstack(
+            [np.radians(45 + 3 * np.sin(phase + idet)) for idet in range(ndet)]
+        )
+        el = np.vstack(
+            [np.radians(50 + 0.1 * idet) * np.ones(nsamp) for idet in range(ndet)]
+        )
+        good = np.ones([ndet, nsamp], dtype=bool)
+        good[1, 100:200] = False
+
+        atmdata = np.zeros([ndet, nsamp])
+        err = sim.observe_many(times, az, el, atmdata, good, -1.0)
+        self.assertEqual(err, 0)
+
+        for idet in range(ndet):
+            ind = good[idet]
+            ref = np.zeros(np.sum(ind))
+            err = sim.observe(times[ind], az[idet][ind], el[idet][ind], ref, -1.0)
+            self.assertEqual(err, 0)
+            nt.assert_allclose(atmdata[idet][ind], ref, rtol=1e-12)
+            # Samples that are not good are left untouched
+            self.assertTrue(np.all(atmdata[idet][np.logical_not(ind)] == 0))
+        return
+
+    def test_atm_cache_reuse(self):
+        # Identical simulation parameters share one cached realization,
+        # and the cache is trimmed to the requested size.
+        cachedir = os.path.join(self.outdir, "atm_cache_reuse")
+        if self.comm is None or self.comm.rank == 0:
+            try:
+                shutil.rmtree(cachedir)
+            except OSError:
+                pass
+        if self.comm is not None:
+            self.comm.barrier()
+
+        def make_sim(key1, cache_size=None):
+            return AtmSim(
+                np.radians(40),
+                np.radians(50),
+                np.radians(45),
+                np.radians(55),
+                0,
+                100,
+                0.01,
+                0.001,
+                10,
+                10,
+                10,
+                0,
+                0,
+                0,
+                2000,
+                0,
+                280,
+                0,
+                40000.0,
+                2000.0,
+                100.0,
+                100.0,
+                100.0,
+                10000,
+                self.comm,
+                key1,
+                0,
+                0,
+                0,
+                cachedir,
+                0,
+                10000,
+                cache_size=cache_size,
+            )
+
+        hits, misses = AtmSim.cache_stats()
+
+        sim = make_sim(0)
+        sim.simulate(use_cache=True)
+        self.assertFalse(sim.cache_hit)
+        self.assertTrue(os.path.isfile(sim.cache_file()))
+
+        cached = make_sim(0)
+        self.assertEqual(cached.cache_name(), sim.cache_name())
+        self.assertNotEqual(cached.cache_name(smooth=True), sim.cache_name())
+        cached.simulate(use_cache=True)
+        self.assertTrue(cached.cache_hit)
+        nt.assert_equal(cached._realization.data, sim._realization.data)
+        nt.assert_equal(cached._full_index.data, sim._full_index.data)
+        nt.assert_equal(cached._compressed_index.data, sim._compressed_index.data)
+
+        self.assertEqual(AtmSim.cache_stats(), (hits + 1, misses + 1))
+
+        # A different RNG key is a different realization.  With a tiny cache
+        # only the most recent realization is kept.
+        other = make_sim(1, cache_size=1)
+        self.assertNotEqual(other.cache_name(), sim.cache_name())
+        other.simulate(use_cache=True)
+        self.assertFalse(other.cache_hit)
+        self.assertTrue(os.path.isfile(other.cache_file()))
+        self.assertFalse(os.path.isfile(sim.cache_file()))
+        return
+
+    def test_atm_shells(self):
+        # The default schedule reproduces the historical shells, without the
+        # innermost shell that is thinner than one volume element.
+        shells = atm_shells(100.0, 100.0, 100.0)
+        self.assertEqual([x[0] for x in shells], [1, 2])
+        ishell, rmin, rmax, xstep, ystep, zstep = shells[0]
+        self.assertEqual((rmin, rmax), (100, 1000))
+        nt.assert_allclose([xstep, ystep, zstep], 100 * np.sqrt(10))
+        ishell, rmin, rmax, xstep, ystep, zstep = shells[1]
+        self.assertEqual((rmin, rmax), (1000, 10000))
+        nt.assert_allclose([xstep, ystep, zstep], 1000)
+
+        # Constant angular resolution, clipped at rmax.  The shells are
+        # adjacent.
+        shells = atm_shells(10.0, 10.0, 10.0, rmax=5000, step_exponent=1)
+        self.assertEqual([x[0] for x in shells], [0, 1, 2])
+        for (_, _, rmax, _, _, _), (_, rmin, _, _, _, _) in zip(
+            shells[:-1], shells[1:]
+        ):
+            self.assertEqual(rmax, rmin)
+        self.assertEqual(shells[0][1], 0)
+        self.assertEqual(shells[-1][2], 5000)
+        for ishell, rmin, rmax, xstep, ystep, zstep in shells:
+            nt.assert_allclose(xstep, 10 * 10 ** ishell)
+        return
+
+    def test_atm_table(self):
+        if not atm_available_utils:
+            print("libaatm is not available, skipping atmosphere table test")
+            return
+        # Frequencies covering the oxygen lines and the 183GHz water line.
+        # The site ID is not used by any simulated observation.
+        site_id = -1
+        altitude = 5200.0
+        freqs = np.linspace(20, 300, 29)
+        key = (site_id, altitude)
+
+        # Weather between the table nodes.  Trilinear interpolation is second
+        # order in the node spacing, and the 0.1mm PWV step dominates the
+        # error of the saturated water lines.
+        weather = (268.4, 55300.0, 0.83)
+        absorption, loading = atm_table_spectra(
+            self.comm, site_id, altitude, *weather, freqs
+        )
+        self.assertEqual(len(_atm_tables[key]), 8)
+        ref_absorption, ref_loading = _atm_spectra(
+            self.comm, altitude, *weather, freqs
+        )
+        nt.assert_allclose(absorption, ref_absorption, rtol=1e-2, atol=3e-3)
+        nt.assert_allclose(loading, ref_loading, rtol=1e-2, atol=1.0)
+
+        # Weather on a node reuses the table and is exact
+        weather = (270.0, 56000.0, 0.8)
+        absorption, loading = atm_table_spectra(
+            self.comm, site_id, altitude, *weather, freqs
+        )
+        self.assertEqual(len(_atm_tables[key]), 8)
+        ref_absorption, ref_loading = _atm_spectra(
+            self.comm, altitude, *weather, freqs
+        )
+        nt.assert_allclose(absorption, ref_absorption, rtol=1e-10)
+        nt.assert_allclose(loading, ref_loading, rtol=1e-10)
+
+        # Other bands at the site share the same nodes
+        atm_table_spectra(
+            self.comm, site_id, altitude, *weather, np.linspace(70, 110, 41)
+        )
+        self.assertEqual(len(_atm_tables[key]), 8)
+        with self.assertRaises(RuntimeError):
+            atm_table_spectra(
+                self.comm, site_id, altitude, *weather, np.linspace(0, 2000, 11)
+            )
+
+        del _atm_tables[key]
+        return
@@ -8,12 +8,18 @@ import numpy as np
 
 from .mpi import MPITestCase
 
+from ..mpi import MPIShared
+
+from ..map import DistPixels
+
 from ..todmap import OpPointingHpix, TODHpixSpiral, pysm
 
+from ..todmap.sim_det_pysm import OpSimPySM, extract_detector_parameters
+
 from ._helpers import create_outdir, create_distdata, uniform_chunks
 
 if pysm is not None:
-    from ..todmap import PySMSky, OpSimPySM
+    from ..todmap import PySMSky
 
 from ..dist import distribute_uniform
 
@@ -251,3 +257,84 @@ class OpSimPySMTestSmooth(MPITestCase):
                 rescanned_tod[:3], expected, decimal=0 if self.comm is None else 1
             )
         return
+
+
+class OpSimPySMDataTest(MPITestCase):
+    """Tests of the OpSimPySM data distribution that do not need PySM."""
+
+    def setUp(self):
+        self.rank = 0
+        self.nproc = 1
+        if self.comm is not None:
+            self.rank = self.comm.rank
+            self.nproc = self.comm.size
+        # The constructor requires PySM, so the operator is assembled here
+        self.op = OpSimPySM.__new__(OpSimPySM)
+        self.op.comm = self.comm
+
+    def test_group_detectors(self):
+        # Two bandpasses and two beams, every process has some detectors
+        focalplane = {}
+        for idet in range(12):
+            focalplane["det{:02}".format(idet)] = {
+                "bandcenter_ghz": [90.0, 150.0][idet % 2],
+                "bandwidth_ghz": [27.0, 45.0][idet % 2],
+                "fwhm": [10.0, 20.0][(idet // 2) % 2],
+            }
+        self.op.focalplanes = [focalplane]
+        dets = sorted(focalplane)
+        groups = self.op._group_detectors(set(dets[self.rank :: self.nproc]))
+
+        self.assertEqual(len(groups), 4)
+        grouped = []
+        for bandpass, fwhm_deg, group_dets in groups:
+            grouped.extend(group_dets)
+            params = set(
+                extract_detector_parameters(det, [focalplane]) for det in group_dets
+            )
+            self.assertEqual(len(params), 1)
+            bandcenter, bandwidth, fwhm = params.pop()
+            self.assertEqual(fwhm_deg, fwhm)
+            np.testing.assert_allclose(
+                bandpass[0][[0, -1]],
+                [bandcenter - bandwidth / 2, bandcenter + bandwidth / 2],
+            )
+        self.assertEqual(sorted(grouped), dets)
+
+        # Every process synthesizes the same groups in the same order
+        if self.comm is not None:
+            summary = [(fwhm_deg, group_dets) for _, fwhm_deg, group_dets in groups]
+            for other in self.comm.allgather(summary):
+                self.assertEqual(other, summary)
+        return
+
+    def test_fill_distmap(self):
+        # The last of 8 submaps of 100 pixels is only partly filled
+        npix = 768
+        npix_submap = 100
+        nsubmap = 8
+        local_submaps = set(range(self.rank % (nsubmap - 1), nsubmap - 1, self.nproc))
+        local_submaps.add(nsubmap - 1)
+        data = create_distdata(self.comm, obs_per_group=1)
+        data["pixels_npix"] = npix
+        data["pixels_npix_submap"] = npix_submap
+        data["pixels_nsubmap"] = nsubmap
+        data["pixels_local_submaps"] = np.array(sorted(local_submaps))
+
+        np.random.seed(12345)
+        full_map = np.random.randn(3, npix)
+        if self.rank != 0:
+            full_map = None
+
+        reference = DistPixels(data, nnz=3, dtype=np.float32)
+        reference.broadcast_healpix_map(full_map, comm_bytes=2 * npix_submap * 3 * 4)
+
+        self.op.npix = npix
+        self.op.distmap = DistPixels(data, nnz=3, dtype=np.float32)
+        # Values left over from a previous detector group are overwritten
+        self.op.distmap.data[:] = 1
+        with MPIShared((3, npix), np.float64, self.comm) as shared:
+            shared.set(full_map, (0, 0), fromrank=0)
+            self.op._fill_distmap(shared)
+        np.testing.assert_array_equal(self.op.distmap.data, reference.data)
+        return
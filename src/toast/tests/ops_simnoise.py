@@ -600,3 +600,68 @@ class OpSimNoiseTest(MPITestCase):
 
         # np.testing.assert_almost_equal(np.std(total), 0)
         return
+
+    def test_psd_cache(self):
+        # The memoized PSDs must match the interpolation of the noise
+        # simulation.
+        nse = self.data.obs[0]["noise"]
+        samples = 1000
+        fftlen = 2048
+        for det in nse.detectors:
+            _, freq, interp_psd = sim_noise_timestream(
+                0,
+                0,
+                0,
+                0,
+                nse.index(det),
+                self.rate,
+                0,
+                samples,
+                self.oversample,
+                nse.freq(det),
+                nse.psd(det),
+                py=True,
+            )
+            psd = nse.fft_psd(det, fftlen, self.rate)
+            np.testing.assert_array_equal(freq, np.fft.rfftfreq(fftlen, 1 / self.rate))
+            np.testing.assert_allclose(psd, interp_psd, rtol=1e-12)
+            # Repeated calls reuse the cached array
+            self.assertTrue(nse.fft_psd(det, fftlen, self.rate) is psd)
+            invpsd = nse.fft_invpsd(det, fftlen, self.rate)
+            np.testing.assert_allclose(invpsd[1:] * psd[1:], 1.0, rtol=1e-12)
+            self.assertEqual(invpsd[0], 0)
+
+        psds = nse.fft_psds(nse.detectors, fftlen, self.rate)
+        self.assertEqual(psds.shape, (len(nse.detectors), fftlen // 2 + 1))
+
+        # Interpolation onto an arbitrary grid reproduces the tabulated PSD
+        for det in nse.detectors:
+            freq = nse.freq(det)
+            np.testing.assert_allclose(
+                nse.interpolate_psd(det, freq), nse.psd(det), rtol=1e-10
+            )
+
+        nse.clear_cache()
+        return
+
+    def test_sim_batched(self):
+        # The batched simulation must reproduce the noise simulated one key
+        # at a time.
+        for data in [self.data, self.data_corr]:
+            op = OpSimNoise(out="noise_single", realization=0, batch=1)
+            op.exec(data)
+            op = OpSimNoise(out="noise_batch", realization=0, batch=3)
+            op.exec(data)
+            for ob in data.obs:
+                tod = ob["tod"]
+                for det in tod.local_dets:
+                    single = tod.cache.reference("noise_single_{}".format(det))
+                    batch = tod.cache.reference("noise_batch_{}".format(det))
+                    np.testing.assert_allclose(
+                        batch, single, rtol=1e-8, atol=1e-8 * np.std(single)
+                    )
+                    del single
+                    del batch
+                tod.cache.clear("noise_single_.*")
+                tod.cache.clear("noise_batch_.*")
+        return
@@ -11,7 +11,7 @@ import numpy as np
 from ..tod import AnalyticNoise, OpSimNoise
 from ..todmap import TODHpixSpiral
 
-from ..fod import autocov_psd
+from ..fod import autocov_psd, lagged_sums, OpNoiseEstim, load_noise_model
 
 from ._helpers import (
     create_outdir,
@@ -100,11 +100,14 @@ class PSDTest(MPITestCase):
             fknee=np.linspace(0.0, 0.1, num=self.ndet),
         )
 
+        self.dquat = dquat
+
         # Total samples in one observation
         self.totsamp = 10000
 
         # Chunks - one per process
         chunks = uniform_chunks(self.totsamp, nchunk=self.data.comm.group_size)
+        self.chunks = chunks
 
         # Populate the observations (one per group)
 
@@ -234,3 +237,98 @@ class PSDTest(MPITestCase):
                 del noisetod
 
         return
+
+    def test_lagged_sums(self):
+        np.random.seed(12345)
+        nsamp = 100000
+        lagmax = 2000
+        x = np.random.randn(nsamp)
+        y = np.random.randn(nsamp)
+        good = np.random.rand(nsamp) > 0.1
+        good[1000:5000] = False
+
+        for sig2 in [None, y]:
+            sums1, hits1 = lagged_sums(x, sig2, good, lagmax, method="direct")
+            sums2, hits2 = lagged_sums(x, sig2, good, lagmax, method="fft")
+            np.testing.assert_array_equal(hits1, hits2)
+            np.testing.assert_allclose(sums1, sums2, rtol=1e-8, atol=1e-8 * nsamp)
+        return
+
+    def test_noise_estim_detsplit(self):
+        # Replace the TOD with one that is distributed by detector
+        for ob in self.data.obs:
+            ob["tod"] = TODHpixSpiral(
+                self.data.comm.comm_group,
+                self.dquat,
+                self.totsamp,
+                detranks=self.data.comm.group_size,
+                firsttime=0.0,
+                rate=self.rate,
+                nside=512,
+                sampsizes=self.chunks,
+            )
+
+        op = OpSimNoise()
+        op.exec(self.data)
+
+        op = OpNoiseEstim(
+            signal="noise",
+            out=self.outdir,
+            nbin_psd=50,
+            lagmax=100,
+            stationary_period=self.totsamp / self.rate,
+            nocross=False,
+            nsum=1,
+            fits_per_pair=True,
+        )
+        op.exec(self.data)
+
+        if self.comm is not None:
+            self.comm.barrier()
+
+        # Every detector pair must have been estimated exactly once
+        for ob in self.data.obs:
+            tod = ob["tod"]
+            if self.data.comm.group_rank != 0:
+                continue
+            dets = tod.detectors
+            for idet1, det1 in enumerate(dets):
+                for det2 in dets[idet1:]:
+                    if det1 == det2:
+                        fname = "noise_{}_{}.fits".format(ob["name"], det1)
+                    else:
+                        fname = "noise_{}_{}_{}.fits".format(ob["name"], det1, det2)
+                    self.assertTrue(os.path.isfile(os.path.join(self.outdir, fname)))
+        return
+
+    def test_noise_estim_model(self):
+        op = OpSimNoise()
+        op.exec(self.data)
+
+        op = OpNoiseEstim(
+            signal="noise",
+            out=self.outdir,
+            nbin_psd=50,
+            lagmax=100,
+            stationary_period=0.1 * self.totsamp / self.rate,
+            nocross=False,
+            nsum=1,
+        )
+        op.exec(self.data)
+
+        if self.comm is not None:
+            self.comm.barrier()
+
+        # The consolidated file must hold a noise model for every detector
+        for ob in self.data.obs:
+            tod = ob["tod"]
+            fname = os.path.join(self.outdir, "noise_{}.h5".format(ob["name"]))
+            self.assertTrue(os.path.isfile(fname))
+            nse = load_noise_model(fname)
+            self.assertEqual(nse.detectors, sorted(tod.detectors))
+            for det in tod.detectors:
+                np.testing.assert_almost_equal(nse.rate(det), self.rate)
+                psd = nse.psd(det)
+                self.assertTrue(np.all(np.isfinite(psd)))
+                self.assertTrue(np.median(psd) > 0)
+        return
@@ -58,13 +58,12 @@ from . import binned as testbinned
 from . import sim_focalplane as testsimfocalplane
 from . import tod_satellite as testtodsat
 
-from ..todmap import pysm
-
-if pysm is not None:
-    from . import ops_sim_pysm as testopspysm
+from . import ops_sim_pysm as testopspysm
 
 from . import ops_sim_atm as testopsatm
 
+from . import schedule as testschedule
+
 from ..tod import tidas_available
 
 # if tidas_available:
@@ -145,10 +144,13 @@ def test(name=None, verbosity=2):
         suite.addTest(loader.loadTestsFromModule(testmapground))
         suite.addTest(loader.loadTestsFromModule(testbinned))
         suite.addTest(loader.loadTestsFromModule(testopsatm))
+        suite.addTest(loader.loadTestsFromModule(testschedule))
         # These tests segfault locally.  Re-enable once we are doing bandpass
         # integration on on the fly.
         # if pysm is not None:
         #     suite.addTest(loader.loadTestsFromModule(testopspysm))
+        # The data distribution tests do not run PySM
+        suite.addTest(loader.loadTestsFromTestCase(testopspysm.OpSimPySMDataTest))
 
         if tidas_available:
             suite.addTest(loader.loadTestsFromModule(testtidas))
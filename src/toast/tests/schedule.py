@@ -0,0 +1,156 @@
+# Copyright (c) 2015-2020 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+from .mpi import MPITestCase
+
+import numpy as np
+
+import ephem
+
+from ..schedule import Ephemeris, angular_distance, current_extent, to_DJD, unwind_angle
+
+
+def current_extent_loop(
+    azmins, azmaxs, aztimes, corners, fp_radius, el, azs, els, rising, t
+):
+    """Reference implementation of current_extent, one corner at a time."""
+    azs_cross = []
+    for i in range(len(corners)):
+        j = (i + 1) % len(corners)
+        for el0 in [el - fp_radius, el, el + fp_radius]:
+            if (els[i] - el0) * (els[j] - el0) < 0:
+                # The corners are on opposite sides of the elevation line
+                az1 = azs[i]
+                az2 = azs[j]
+                el1 = els[i] - el0
+                el2 = els[j] - el0
+                az2 = unwind_angle(az1, az2)
+                az_cross = (az1 + el1 * (az2 - az1) / (el1 - el2)) % (2 * np.pi)
+                azs_cross.append(az_cross)
+            if fp_radius == 0:
+                break
+    if len(azs_cross) == 0:
+        return False
+
+    azs_cross = np.array(azs_cross)
+    if rising:
+        good = azs_cross < np.pi
+    else:
+        good = azs_cross > np.pi
+    ngood = np.sum(good)
+    if ngood == 0:
+        return False
+    elif ngood > 1:
+        azs_cross = azs_cross[good]
+
+    # Unwind the crossing azimuths to minimize the scatter
+    azs_cross = np.sort(azs_cross)
+    if azs_cross.size > 1:
+        ptp0 = azs_cross[-1] - azs_cross[0]
+        ptps = azs_cross[:-1] + 2 * np.pi - azs_cross[1:]
+        ptps = np.hstack([ptp0, ptps])
+        i = np.argmin(ptps)
+        azs_cross[:i] += 2 * np.pi
+        np.roll(azs_cross, i)
+
+    if len(azs_cross) > 1:
+        azmin = azs_cross[0] % (2 * np.pi)
+        azmax = azs_cross[-1] % (2 * np.pi)
+        if azmax - azmin > np.pi:
+            # Patch crosses the zero meridian
+            azmin, azmax = azmax, azmin
+        azmins.append(azmin)
+        azmaxs.append(azmax)
+        aztimes.append(t)
+        return True
+    return False
+
+
+class ScheduleTest(MPITestCase):
+    def setUp(self):
+        self.observer = ephem.Observer()
+        self.observer.lon = "-67:47:10"
+        self.observer.lat = "-22:57:30"
+        self.observer.elevation = 5200
+        self.observer.epoch = "2000"
+        self.observer.temp = 0
+        self.observer.pressure = 0
+        # Two days of time stamps that are not on the ephemeris grid
+        np.random.seed(12345)
+        self.start = 1577836800.0
+        self.times = self.start + np.sort(np.random.rand(200)) * 2 * 86400
+        return
+
+    def exact_azel(self, body, times):
+        observer = self.observer.copy()
+        az = np.zeros(times.size)
+        el = np.zeros(times.size)
+        for i, t in enumerate(times):
+            observer.date = to_DJD(t)
+            body.compute(observer)
+            az[i] = body.az
+            el[i] = body.alt
+        return az, el
+
+    def test_ephemeris(self):
+        ephemeris = Ephemeris(self.observer)
+        # The vectorized coordinates agree with PyEphem to a few arc seconds
+        tol = np.radians(3 / 3600)
+
+        az, el = ephemeris.sun_azel(self.times)
+        az0, el0 = self.exact_azel(ephem.Sun(), self.times)
+        self.assertLess(np.amax(angular_distance(az, el, az0, el0)), tol)
+
+        az, el = ephemeris.moon_azel(self.times)
+        az0, el0 = self.exact_azel(ephem.Moon(), self.times)
+        self.assertLess(np.amax(angular_distance(az, el, az0, el0)), tol)
+
+        bodies = []
+        for ra, dec in [(0, -60), (80, -30), (200, 10), (300, -85)]:
+            body = ephem.FixedBody()
+            body._ra = np.radians(ra)
+            body._dec = np.radians(dec)
+            bodies.append(body)
+        az, el = ephemeris.fixed_azel(bodies, self.times)
+        for body, body_az, body_el in zip(bodies, az, el):
+            az0, el0 = self.exact_azel(body, self.times)
+            dist = angular_distance(body_az, body_el, az0, el0)
+            self.assertLess(np.amax(dist), tol)
+
+        # Scalar time stamps
+        az, el = ephemeris.sun_azel(self.times[0])
+        self.assertEqual(np.ndim(az), 0)
+        az, el = ephemeris.fixed_azel(bodies, self.times[0])
+        self.assertEqual(az.shape, (len(bodies),))
+
+        # None of the checks against PyEphem failed
+        self.assertFalse(ephemeris._exact)
+        return
+
+    def test_current_extent(self):
+        np.random.seed(67890)
+        ntest = 0
+        for _ in range(1000):
+            ncorner = np.random.randint(3, 8)
+            corners = list(range(ncorner))
+            azs = np.random.rand(ncorner) * 2 * np.pi
+            els = np.radians(np.random.rand(ncorner) * 60)
+            el = np.radians(np.random.rand() * 60)
+            fp_radius = np.radians(np.random.choice([0, 2, 5]))
+            rising = np.random.rand() < 0.5
+            results = []
+            for extent in current_extent, current_extent_loop:
+                azmins, azmaxs, aztimes = [], [], []
+                args = [azmins, azmaxs, aztimes, corners, fp_radius, el]
+                success = extent(*args, azs, els, rising, 1.0)
+                results.append((success, azmins, azmaxs, aztimes))
+            (success, azmins, azmaxs, aztimes), reference = results
+            self.assertEqual(success, reference[0])
+            np.testing.assert_allclose(azmins, reference[1], rtol=1e-12)
+            np.testing.assert_allclose(azmaxs, reference[2], rtol=1e-12)
+            self.assertEqual(aztimes, reference[3])
+            ntest += success
+        # Many configurations produce an extent
+        self.assertGreater(ntest, 100)
+        return
@@ -501,6 +501,85 @@ class TidasTest(MPITestCase):
         self.volume_verify(self.outvol)
         return
 
+    def test_prefetch(self):
+        self.volume_init(self.outvol)
+        vol = None
+        if self.comm is None:
+            vol = tds.Volume(self.outvol, tds.AccessMode.read)
+        else:
+            vol = MPIVolume(self.data.comm.comm_world, self.outvol, tds.AccessMode.read)
+
+        for ob in range(len(self.data.obs)):
+            obsname = "obs_{}_{:02d}".format(self.data.comm.group, ob)
+            tod = tt.TODTidas(
+                self.data.comm.comm_group,
+                self.data.comm.group_size,
+                vol,
+                "/{}".format(obsname),
+                distintervals="chunks",
+            )
+            # Use a budget of roughly one detector so that reads are
+            # queued behind the accessed ones.
+            dets = list(reversed(tod.local_dets))
+            tod.prefetch(detectors=dets, max_bytes=9 * tod.local_samples[1])
+            for det in dets:
+                np.testing.assert_equal(tod.local_signal(det), tod.read(detector=det))
+                np.testing.assert_equal(
+                    tod.local_flags(det), tod.read_flags(detector=det)
+                )
+            for det in dets[:1]:
+                np.testing.assert_equal(
+                    tod.local_pointing(det), tod.read_pntg(detector=det)
+                )
+            tod.prefetch_stop()
+            del tod
+        del vol
+        return
+
+    def test_read_failure(self):
+        self.volume_init(self.outvol)
+        vol = None
+        if self.comm is None:
+            vol = tds.Volume(self.outvol, tds.AccessMode.read)
+        else:
+            vol = MPIVolume(self.data.comm.comm_world, self.outvol, tds.AccessMode.read)
+
+        def failing_helper(*args, **kwargs):
+            raise RuntimeError("Simulated read failure")
+
+        for ob in range(len(self.data.obs)):
+            obsname = "obs_{}_{:02d}".format(self.data.comm.group, ob)
+            tod = tt.TODTidas(
+                self.data.comm.comm_group,
+                self.data.comm.group_size,
+                vol,
+                "/{}".format(obsname),
+                distintervals="chunks",
+            )
+            nsamp = tod.local_samples[1]
+            # A failing read must release the block handles and the lock
+            tod._read_cache_helper = failing_helper
+            with self.assertRaises(RuntimeError):
+                tod.read_boresight(local_start=0, n=nsamp)
+            self.assertFalse(tod._io_lock.locked())
+            del tod._read_cache_helper
+            # The same failure on a background thread surfaces on access
+            tod._read_cache_helper = failing_helper
+            tod.prefetch(detectors=[])
+            with self.assertRaises(RuntimeError):
+                tod.read_boresight(local_start=0, n=nsamp)
+            tod.prefetch_stop()
+            self.assertFalse(tod._io_lock.locked())
+            del tod._read_cache_helper
+            # Subsequent reads work
+            for det in tod.local_dets:
+                tod.read(detector=det)
+                tod.read_flags(detector=det)
+            tod.read_boresight(local_start=0, n=nsamp)
+            del tod
+        del vol
+        return
+
     def test_export(self):
         rank = 0
         if self.comm is not None:
@@ -2,8 +2,16 @@
 # All rights reserved.  Use of this source code is governed by
 # a BSD-style license that can be found in the LICENSE file.
 
+from collections import OrderedDict
+
 import numpy as np
 
+import scipy.interpolate as si
+
+
+# Maximum size in bytes of the interpolated PSDs memoized by every Noise object
+PSD_CACHE_BYTES = 256 * 2 ** 20
+
 
 class Noise(object):
     """Noise objects act as containers for noise PSDs.
@@ -24,6 +32,10 @@ class Noise(object):
             generating indepedendent and repeateable noise realizations.
             If absent, running indices will be assigned and provided.
 
+    PSDs interpolated onto the Fourier frequencies of a given FFT length and
+    sample rate are memoized, so that repeated noise simulations and noise
+    filters reuse them.
+
     Attributes:
         detectors (list): List of detector names
         keys (list): List of PSD names
@@ -70,6 +82,9 @@ class Noise(object):
             # last frequency point should be Nyquist
             self._rates[key] = 2.0 * self._freqs[key][-1]
 
+        self._psd_cache = OrderedDict()
+        self._psd_cache_bytes = 0
+
     @property
     def detectors(self):
         """(list): list of strings containing the detector names."""
@@ -149,3 +164,171 @@ class Noise(object):
 
         """
         return self._psds[key]
+
+    def interpolate_psd(self, key, freq):
+        """Interpolate the PSD corresponding to `key` onto arbitrary frequencies.
+
+        The interpolation is linear in log-log space.  The PSD is held
+        constant beyond the tabulated frequencies and is zero at zero
+        frequency.
+
+        Args:
+            key (str): Detector name or mixing matrix key.
+            freq (array): Frequencies to evaluate the PSD at.  Negative
+                frequencies evaluate to the PSD at the absolute value.
+        Returns:
+            (array): The interpolated PSD.
+
+        """
+        return self.interpolate_psds([key], freq)[0]
+
+    def interpolate_psds(self, keys, freq):
+        """Interpolate the PSDs of several keys onto arbitrary frequencies.
+
+        Args:
+            keys (list): Detector names or mixing matrix keys.
+            freq (array): Frequencies to evaluate the PSDs at.
+        Returns:
+            (array): The interpolated PSDs, one row per key.
+
+        """
+        freq = np.atleast_1d(freq)
+        result = np.zeros([len(keys), freq.size])
+        good = np.abs(freq) > 1e-10
+        logfreq = np.log(np.abs(freq[good]))
+        for row, key in zip(result, keys):
+            psdfreq = self._freqs[key]
+            psd = self._psds[key]
+            ind = psdfreq > 0
+            with np.errstate(divide="ignore"):
+                logpsd = np.log(psd[ind])
+            row[good] = np.exp(np.interp(logfreq, np.log(psdfreq[ind]), logpsd))
+        return result
+
+    def _fft_psd(self, key, fftlen, rate):
+        """Interpolate one PSD onto the real FFT frequencies.
+
+        This matches the interpolation used for the noise simulation: the
+        PSD and the frequencies are shifted to avoid zeros and the
+        logarithms are linearly interpolated and extrapolated.
+
+        """
+        freq = self._freqs[key]
+        psd = self._psds[key]
+        interp_freq = np.fft.rfftfreq(fftlen, 1 / rate)
+        psdshift = 0.01 * np.amin(psd[psd > 0.0])
+        freqshift = rate / fftlen
+        interp = si.interp1d(
+            np.log10(freq + freqshift),
+            np.log10(psd + psdshift),
+            kind="linear",
+            fill_value="extrapolate",
+        )
+        interp_psd = np.power(10.0, interp(np.log10(interp_freq + freqshift)))
+        interp_psd -= psdshift
+        # Zero out DC value
+        interp_psd[0] = 0.0
+        return interp_psd
+
+    def _fft_invpsd(self, key, fftlen, rate):
+        """Invert the PSD on the real FFT frequencies."""
+        psd = self.fft_psd(key, fftlen, rate)
+        invpsd = np.zeros_like(psd)
+        good = psd > 0
+        invpsd[good] = 1 / psd[good]
+        return invpsd
+
+    def memoize(self, name, key, fftlen, rate, compute):
+        """Return a memoized array derived from the PSD of `key`.
+
+        The arrays are cached by name, key, FFT length and sample rate.
+        The least recently used arrays are discarded when the cache grows
+        beyond PSD_CACHE_BYTES.
+
+        Args:
+            name (str): Name of the derived quantity.
+            key (str): Detector name or mixing matrix key.
+            fftlen (int): FFT length.
+            rate (float): Sample rate in Hz.
+            compute (callable): Called as compute(key, fftlen, rate) to
+                evaluate the array if it is not cached.
+        Returns:
+            (array): The read-only array.
+
+        """
+        cache_key = (name, key, int(fftlen), float(rate))
+        if cache_key in self._psd_cache:
+            self._psd_cache.move_to_end(cache_key)
+            return self._psd_cache[cache_key]
+        result = compute(key, fftlen, rate)
+        result.flags.writeable = False
+        if result.nbytes <= PSD_CACHE_BYTES:
+            self._psd_cache[cache_key] = result
+            self._psd_cache_bytes += result.nbytes
+            while self._psd_cache_bytes > PSD_CACHE_BYTES:
+                _, old = self._psd_cache.popitem(last=False)
+                self._psd_cache_bytes -= old.nbytes
+        return result
+
+    def fft_psd(self, key, fftlen, rate):
+        """Get the PSD of `key` at the real FFT frequencies.
+
+        The result is memoized by key, FFT length and sample rate.
+
+        Args:
+            key (str): Detector name or mixing matrix key.
+            fftlen (int): FFT length.
+            rate (float): Sample rate in Hz.
+        Returns:
+            (array): Read-only PSD at np.fft.rfftfreq(fftlen, 1 / rate).
+
+        """
+        return self.memoize("psd", key, fftlen, rate, self._fft_psd)
+
+    def fft_invpsd(self, key, fftlen, rate):
+        """Get the inverse PSD of `key` at the real FFT frequencies.
+
+        Frequencies with zero PSD have zero inverse PSD.  The result is
+        memoized by key, FFT length and sample rate.
+
+        Args:
+            key (str): Detector name or mixing matrix key.
+            fftlen (int): FFT length.
+            rate (float): Sample rate in Hz.
+        Returns:
+            (array): Read-only inverse PSD at np.fft.rfftfreq(fftlen, 1 / rate).
+
+        """
+        return self.memoize("invpsd", key, fftlen, rate, self._fft_invpsd)
+
+    def fft_psds(self, keys, fftlen, rate):
+        """Get the PSDs of several keys at the real FFT frequencies.
+
+        Args:
+            keys (list): Detector names or mixing matrix keys.
+            fftlen (int): FFT length.
+            rate (float): Sample rate in Hz.
+        Returns:
+            (array): The PSDs, one row per key.
+
+        """
+        return np.vstack([self.fft_psd(key, fftlen, rate) for key in keys])
+
+    def fft_invpsds(self, keys, fftlen, rate):
+        """Get the inverse PSDs of several keys at the real FFT frequencies.
+
+        Args:
+            keys (list): Detector names or mixing matrix keys.
+            fftlen (int): FFT length.
+            rate (float): Sample rate in Hz.
+        Returns:
+            (array): The inverse PSDs, one row per key.
+
+        """
+        return np.vstack([self.fft_invpsd(key, fftlen, rate) for key in keys])
+
+    def clear_cache(self):
+        """Discard all memoized PSDs."""
+        self._psd_cache.clear()
+        self._psd_cache_bytes = 0
+        return
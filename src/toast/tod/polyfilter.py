@@ -265,15 +265,36 @@ class OpPolyFilter2D(Operator):
                     break
 
             yrot = qa.rotation(YAXIS, np.pi / 2)
+            local_dets = []
             for det in tod.local_dets:
                 if det not in detector_index:
                     continue
+                local_dets.append(det)
                 idet = detector_index[det]
                 det_quat = focalplane[det]["quat"]
                 vec = qa.rotate(det_quat, ZAXIS)
                 theta, phi = hp.vec2dir(qa.rotate(yrot, vec))
                 theta -= np.pi / 2
                 detector_templates[idet] = theta ** xorders * phi ** yorders
+            local_index = np.array(
+                [detector_index[det] for det in local_dets], dtype=np.int64
+            )
+
+            # The templates and their normalization do not change between
+            # buffers, so they are collected only once per observation.
+
+            t1 = time()
+            if comm is not None:
+                comm.Allreduce(MPI.IN_PLACE, detector_templates, op=MPI.SUM)
+            norms = np.sum(detector_templates ** 2, axis=0)
+            good = norms != 0
+            norms[good] = norms[good] ** -0.5
+            templates = detector_templates * norms  # ndet x nmode
+            local_templates = templates[local_index]  # nlocal x nmode
+            t_get_norm += time() - t1
+
+            # Inverse template covariances for each observed mask pattern
+            inverse_cache = {}
 
             if self._intervals in obs:
                 intervals = obs[self._intervals]
@@ -294,99 +315,65 @@ class OpPolyFilter2D(Operator):
                     ind = slice(istart, istop)
                     nsample = istop - istart
 
-                    templates = np.zeros([ndet, nmode])
-                    masks = np.zeros([ndet, nsample], dtype=bool)
-                    proj = np.zeros([nmode, nsample])
-                    norms = np.zeros(nmode)
-
                     t1 = time()
 
-                    for det in tod.local_dets:
-                        if det not in detector_index:
-                            continue
-                        idet = detector_index[det]
+                    # Stack the local signals and masks into
+                    # (nlocal x nsample) matrices
 
-                        ref = tod.local_signal(det, self._name)[ind]
+                    masks = np.zeros([ndet, nsample], dtype=bool)
+                    signals = np.zeros([len(local_dets), nsample])
+                    common_flags = common_ref[ind] & self._common_flag_mask
+                    for ilocal, det in enumerate(local_dets):
                         flag_ref = tod.local_flags(det, self._flag_name)[ind]
+                        mask = (common_flags | (flag_ref & self._flag_mask)) == 0
+                        masks[local_index[ilocal]] = mask
+                        signals[ilocal] = tod.local_signal(det, self._name)[ind]
+                        signals[ilocal, np.logical_not(mask)] = 0
+                        del flag_ref
 
-                        flg = common_ref[ind] & self._common_flag_mask
-                        flg |= flag_ref & self._flag_mask
-                        mask = flg == 0
-
-                        # We might want to remove the interval mean if the
-                        # data were not already 1D-filtered
-                        # ref -= np.mean(ref[mask])
-
-                        template = detector_templates[idet]
-                        templates[idet] = template
-                        masks[idet] = mask
-                        proj += np.outer(template, ref * mask)
-                        norms += template ** 2
+                    # We might want to remove the interval mean if the
+                    # data were not already 1D-filtered
 
-                        del ref
-                        del flag_ref
+                    proj = np.dot(local_templates.T, signals)  # nmode x nsample
+                    del signals
 
                     t_template += time() - t1
 
                     t1 = time()
                     if comm is not None:
-                        comm.Barrier()
-                        comm.Allreduce(MPI.IN_PLACE, templates, op=MPI.SUM)
                         comm.Allreduce(MPI.IN_PLACE, masks, op=MPI.LOR)
                         comm.Allreduce(MPI.IN_PLACE, proj, op=MPI.SUM)
-                        comm.Allreduce(MPI.IN_PLACE, norms, op=MPI.SUM)
-
-                    good = norms != 0
-                    norms[good] = norms[good] ** -0.5
-                    t_get_norm += time() - t1
-
-                    t1 = time()
-                    templates = templates.T.copy()  # nmode x ndet
-                    for mode, norm in enumerate(norms):
-                        if norm:
-                            templates[mode] *= norm
-                            proj[mode] *= norm
                     t_apply_norm += time() - t1
 
                     t1 = time()
-                    proj = proj.T.copy()  # nsample x nmode
                     coeff = np.zeros([nsample, nmode])
-                    masks = np.transpose(masks)  # nsample x ndet
-                    for isample in range(nsample):
-                        if isample % comm_size != comm_rank:
-                            continue
-                        mask = masks[isample]
-                        templatesT = mask * templates  # nmode * ndet
-                        invcov = np.dot(templatesT, templates.T)
-                        try:
-                            cov = np.linalg.inv(invcov)
-                            coeff[isample] = np.dot(cov, proj[isample])
-                        except np.linalg.LinAlgError:
-                            coeff[isample] = 0
+                    my_samples = np.arange(comm_rank, nsample, comm_size)
+                    if my_samples.size > 0:
+                        covs = self._get_inverses(
+                            masks[:, my_samples].T, templates, inverse_cache
+                        )
+                        coeff[my_samples] = np.einsum(
+                            "smn,ns->sm", covs, proj[:, my_samples]
+                        )
+                        del covs
                     if comm is not None:
                         comm.Allreduce(MPI.IN_PLACE, coeff, op=MPI.SUM)
                     t_solve += time() - t1
 
                     t1 = time()
 
-                    for isample in range(nsample):
-                        if np.all(coeff[isample] == 0):
-                            common_ref[istart + isample] |= self._poly_flag_mask
-
-                    templates = templates.T.copy()  # ndet x nmode x nsample
-                    coeff = coeff.T.copy()  # nmode x nsample
+                    failed = np.all(coeff == 0, axis=1)
+                    common_ref[istart:istop][failed] |= self._poly_flag_mask
 
-                    for det in tod.local_dets:
-                        if det not in detector_index:
-                            continue
-                        idet = detector_index[det]
+                    cleaned = np.dot(local_templates, coeff.T)  # nlocal x nsample
+                    for ilocal, det in enumerate(local_dets):
                         ref = tod.local_signal(det, self._name)[ind]
-                        for mode in range(nmode):
-                            ref -= coeff[mode] * templates[idet, mode]
+                        ref -= cleaned[ilocal]
+                        del ref
+                    del cleaned
 
                     t_clean += time() - t1
 
-                    del templates
                     istart = istop
 
             del common_ref
@@ -411,6 +398,46 @@ class OpPolyFilter2D(Operator):
 
         return
 
+    def _get_inverses(self, masks, templates, cache):
+        """Return the inverse template covariance for every sample.
+
+        Samples that share a mask pattern share the inverse, which is
+        computed only once and cached for the rest of the observation.
+        Singular patterns map to a zero matrix so the corresponding
+        samples get zero coefficients.
+
+        Args:
+            masks (array):  (nsample x ndet) detector masks.
+            templates (array):  (ndet x nmode) normalized templates.
+            cache (dict):  Inverse covariances keyed by mask pattern.
+
+        Returns:
+            (array):  (nsample x nmode x nmode) inverse covariances.
+
+        """
+        nmode = templates.shape[1]
+        patterns, pattern_index = np.unique(masks, axis=0, return_inverse=True)
+        keys = [pattern.tobytes() for pattern in patterns]
+        new = [i for i, key in enumerate(keys) if key not in cache]
+        if len(new) > 0:
+            # Batched normal matrices for all new mask patterns
+            invcovs = np.einsum(
+                "pd,dm,dn->pmn", patterns[new].astype(np.float64), templates, templates
+            )
+            try:
+                covs = np.linalg.inv(invcovs)
+            except np.linalg.LinAlgError:
+                covs = np.zeros_like(invcovs)
+                for i, invcov in enumerate(invcovs):
+                    try:
+                        covs[i] = np.linalg.inv(invcov)
+                    except np.linalg.LinAlgError:
+                        pass
+            for i, cov in zip(new, covs):
+                cache[keys[i]] = cov
+        covs = np.array([cache[key] for key in keys]).reshape([-1, nmode, nmode])
+        return covs[pattern_index.ravel()]
+
 
 class OpPolyFilter(Operator):
     """Operator which applies polynomial filtering to the TOD.
@@ -8,8 +8,17 @@ from ..timing import function_timer
 
 from ..fft import FFTPlanReal1DStore
 
+from ..rng import random_multi
+
 from .tod_math import sim_noise_timestream
 
+
+# Default number of noise keys simulated together
+NOISE_BATCH = 64
+
+# Upper limit on the FFT and random number buffers of one batch in bytes
+NOISE_BATCH_BYTES = 2 ** 30
+
 from ..op import Operator
 
 
@@ -31,11 +40,21 @@ class OpSimNoise(Operator):
             index.
         component (int): the component index to use for this noise simulation.
         noise (str): PSD key in the observation dictionary.
+        rate (float): Sample rate.  Default is the median sample rate of
+            every chunk.
+        batch (int): Number of noise keys to simulate together.  If one,
+            every key is simulated separately with sim_noise_timestream.
 
     """
 
     def __init__(
-        self, out="noise", realization=0, component=0, noise="noise", rate=None
+        self,
+        out="noise",
+        realization=0,
+        component=0,
+        noise="noise",
+        rate=None,
+        batch=NOISE_BATCH,
     ):
         # Call the parent class constructor.
         super().__init__()
@@ -46,6 +65,7 @@ class OpSimNoise(Operator):
         self._component = component
         self._noisekey = noise
         self._rate = rate
+        self._batch = batch
 
     @function_timer
     def exec(self, data):
@@ -157,46 +177,180 @@ class OpSimNoise(Operator):
         else:
             rate = self._rate
 
-        for key in nse.keys:
-            # Check if noise matching this PSD key is needed
-            weight = 0.0
-            for det in tod.local_dets:
-                weight += np.abs(nse.weight(det, key))
-            if weight == 0:
-                continue
-
-            # Simulate the noise matching this key
-            nsedata = sim_noise_timestream(
-                self._realization,
-                telescope,
-                self._component,
-                obsindx,
-                nse.index(key),
+        if self._batch > 1:
+            self._simulate_batched(
+                tod,
+                nse,
                 rate,
                 chunk_first + global_offset,
                 chunk_samp,
-                self._oversample,
-                nse.freq(key),
-                nse.psd(key),
+                local_offset,
+                obsindx,
+                telescope,
             )
-
-            # Add the noise to all detectors that have nonzero weights
-            for det in tod.local_dets:
-                weight = nse.weight(det, key)
+        else:
+            for key in nse.keys:
+                # Check if noise matching this PSD key is needed
+                weight = 0.0
+                for det in tod.local_dets:
+                    weight += np.abs(nse.weight(det, key))
                 if weight == 0:
                     continue
-                cachename = "{}_{}".format(self._out, det)
-                if tod.cache.exists(cachename):
-                    ref = tod.cache.reference(cachename)
-                else:
-                    ref = tod.cache.create(
-                        cachename, np.float64, (tod.local_samples[1],)
-                    )
-                ref[local_offset : local_offset + chunk_samp] += weight * nsedata
-                del ref
+
+                # Simulate the noise matching this key
+                nsedata = sim_noise_timestream(
+                    self._realization,
+                    telescope,
+                    self._component,
+                    obsindx,
+                    nse.index(key),
+                    rate,
+                    chunk_first + global_offset,
+                    chunk_samp,
+                    self._oversample,
+                    nse.freq(key),
+                    nse.psd(key),
+                )
+
+                # Add the noise to all detectors that have nonzero weights
+                for det in tod.local_dets:
+                    weight = nse.weight(det, key)
+                    if weight == 0:
+                        continue
+                    ref = self._get_output(tod, det)
+                    ref[local_offset : local_offset + chunk_samp] += weight * nsedata
+                    del ref
 
         # Release the work space allocated in the FFT plan store.
         store = FFTPlanReal1DStore.get()
         store.clear()
 
         return chunk_samp
+
+    def _get_output(self, tod, det):
+        """Return the output cache object of one detector, creating it if needed."""
+        cachename = "{}_{}".format(self._out, det)
+        if tod.cache.exists(cachename):
+            ref = tod.cache.reference(cachename)
+        else:
+            ref = tod.cache.create(cachename, np.float64, (tod.local_samples[1],))
+        return ref
+
+    def _sim_scale(self, nse, key, fftlen, rate):
+        """Fourier domain scaling of unit variance noise for one PSD key.
+
+        This reproduces the PSD interpolation in sim_noise_timestream and
+        returns the scaling in FFTW half-complex order.
+
+        """
+        freq = nse.freq(key)
+        psd = nse.psd(key)
+        npsd = fftlen // 2 + 1
+        norm = rate * float(npsd - 1)
+        increment = rate / (fftlen - 1)
+
+        if freq[0] > increment:
+            raise RuntimeError(
+                "input PSD has lowest frequency {}Hz, which does not allow "
+                "interpolation to {}Hz".format(freq[0], increment)
+            )
+        if np.amin(psd) < 0:
+            raise RuntimeError("input PSD values should be >= zero")
+        nyquist = 0.5 * rate
+        if np.abs((freq[-1] - nyquist) / nyquist) > 0.01:
+            raise RuntimeError(
+                "last frequency element does not match Nyquist "
+                "frequency for given sample rate: {} != {}".format(freq[-1], nyquist)
+            )
+
+        # Logarithmic interpolation of the Fourier amplitudes.  In order to
+        # avoid zero values, we shift them by a fixed amount in frequency
+        # and amplitude.
+
+        psdshift = 0.01 * np.amin(psd[psd != 0])
+        freqshift = increment
+        logfreq = np.log10(freq + freqshift)
+        logpsd = np.log10(np.sqrt(psd * norm) + psdshift)
+        loginterp_freq = np.log10(increment * np.arange(npsd) + freqshift)
+        ibin = np.minimum(
+            np.searchsorted(logfreq[1:], loginterp_freq, side="left"), freq.size - 2
+        )
+        r = (loginterp_freq - logfreq[ibin]) / (logfreq[ibin + 1] - logfreq[ibin])
+        amplitude = logpsd[ibin] + r * (logpsd[ibin + 1] - logpsd[ibin])
+        amplitude = np.power(10, amplitude) - psdshift
+
+        # Zero out DC value
+        amplitude[0] = 0
+
+        return np.hstack([amplitude, amplitude[npsd - 2 : 0 : -1]])
+
+    def _simulate_batched(
+        self, tod, nse, rate, firstsamp, samples, local_offset, obsindx, telescope
+    ):
+        """Simulate the noise of all keys in batches and mix it into detectors.
+
+        The random streams of each batch are drawn together and transformed
+        with a single batched FFT plan.  Each batch is mixed straight into
+        the outputs of the detectors with nonzero weights, so no detector
+        timestreams are buffered.
+
+        """
+        dets = tod.local_dets
+        mix = np.array([[nse.weight(det, key) for key in nse.keys] for det in dets])
+        mix = mix.reshape([len(dets), len(nse.keys)])
+        needed = np.any(mix != 0, axis=0)
+        active = np.any(mix != 0, axis=1)
+        keys = [key for key, need in zip(nse.keys, needed) if need]
+        mix = mix[active][:, needed]
+
+        fftlen = 2
+        while fftlen <= (self._oversample * samples):
+            fftlen *= 2
+        offset = (fftlen - samples) // 2
+        # Random numbers, Fourier and time domain buffers and the trimmed
+        # timestream for every key
+        batch = max(1, min(self._batch, NOISE_BATCH_BYTES // (32 * fftlen)))
+
+        key1 = self._realization * 4294967296 + telescope * 65536 + self._component
+        counter2 = firstsamp * self._oversample
+
+        def sim_scale(key, fftlen, rate):
+            return self._sim_scale(nse, key, fftlen, rate)
+
+        store = FFTPlanReal1DStore.get()
+        refs = [
+            self._get_output(tod, det)
+            for det, is_active in zip(dets, active)
+            if is_active
+        ]
+        for first in range(0, len(keys), batch):
+            batch_keys = keys[first : first + batch]
+            nbatch = len(batch_keys)
+            rngdata = random_multi(
+                [fftlen] * nbatch,
+                [(key1, obsindx * 4294967296 + nse.index(x)) for x in batch_keys],
+                [(0, counter2)] * nbatch,
+                sampler="gaussian",
+            )
+            plan = store.backward(fftlen, nbatch)
+            for i, key in enumerate(batch_keys):
+                scale = nse.memoize("sim_scale", key, fftlen, rate, sim_scale)
+                plan.fdata(i)[:] = np.asarray(rngdata[i]) * scale
+            del rngdata
+            plan.exec()
+            keydata = np.vstack(
+                [plan.tdata(i)[offset : offset + samples] for i in range(nbatch)]
+            )
+            # subtract the DC level
+            keydata -= np.mean(keydata, axis=1)[:, np.newaxis]
+            for weights, ref in zip(mix[:, first : first + nbatch], refs):
+                nonzero = np.flatnonzero(weights)
+                if nonzero.size == 0:
+                    continue
+                ref[local_offset : local_offset + samples] += weights[nonzero].dot(
+                    keydata[nonzero]
+                )
+            del keydata
+
+        del refs
+        return
@@ -6,6 +6,11 @@ from ..mpi import MPI
 
 import os
 import re
+import threading
+
+from contextlib import contextmanager
+
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -44,6 +49,9 @@ STR_FPGROUP = "focalplane"
 STR_CACHEGROUP = "cache"
 STR_OBSGROUP = "observation"
 
+# Default memory budget for data that is prefetched but not yet accessed
+PREFETCH_BYTES = 2 ** 28
+
 
 class TODTidas(TOD):
     """This class provides an interface to a single TIDAS data block.
@@ -62,6 +70,10 @@ class TODTidas(TOD):
     and objects in the TOD.cache.  More specialized uses for specific
     experiments should be implemented in their own classes.
 
+    Detector data can be read ahead of use with `prefetch()`, which loads
+    the boresight, signal and flags into the cache on background threads
+    while the calling operator works on the data already loaded.
+
     Args:
         mpicomm (mpi4py.MPI.Comm): the MPI communicator over which this
             observation data is distributed.
@@ -99,6 +111,15 @@ class TODTidas(TOD):
         detbreaks=None,
         distintervals=None,
     ):
+        # All access to the TIDAS handles is serialized with this lock so
+        # that background prefetching can share them.
+        self._io_lock = threading.Lock()
+        self._prefetch_pool = None
+        self._prefetch_queue = []
+        self._prefetch_pending = {}
+        self._prefetch_bytes = 0
+        self._prefetch_budget = PREFETCH_BYTES
+
         if not available:
             raise RuntimeError("tidas is not available")
         rank = 0
@@ -279,6 +300,10 @@ class TODTidas(TOD):
         return
 
     def __del__(self):
+        try:
+            self.prefetch_stop()
+        except:
+            pass
         self._close()
         try:
             del self._vol
@@ -288,16 +313,28 @@ class TODTidas(TOD):
 
     def _open(self):
         """Open block and group handles."""
-        if self._block is not None:
+        self._io_lock.acquire()
+        if self._block is not None or self._dgrp is not None:
+            self._io_lock.release()
             raise RuntimeError("block is already open!")
-        if self._dgrp is not None:
-            raise RuntimeError("data group is already open!")
-        self._block = tdsutils.find_obs(self._vol, self._blockparent, self._blockname)
-        self._dgrp = self._block.group_get(self._dgrpname)
+        try:
+            self._block = tdsutils.find_obs(
+                self._vol, self._blockparent, self._blockname
+            )
+            self._dgrp = self._block.group_get(self._dgrpname)
+        except:
+            self._block = None
+            self._dgrp = None
+            self._io_lock.release()
+            raise
         return
 
     def _close(self):
         """Close block and group handles."""
+        try:
+            opened = self._block is not None
+        except AttributeError:
+            opened = False
         try:
             del self._dgrp
             self._dgrp = None
@@ -308,8 +345,157 @@ class TODTidas(TOD):
             self._block = None
         except:
             pass
+        if opened:
+            self._io_lock.release()
+        return
+
+    @contextmanager
+    def _opened(self):
+        """Hold the block and group handles open inside a with block.
+
+        The handles are closed and the I/O lock is released even if the
+        enclosed read or write raises.
+        """
+        self._open()
+        try:
+            yield
+        finally:
+            self._close()
+
+    def prefetch(
+        self, detectors=None, boresight=True, flags=True, max_bytes=None, nthread=1
+    ):
+        """Read detector data ahead of use on background threads.
+
+        The data are read in the order of the given detectors and stored in
+        the cache under the default names used by `local_signal()`,
+        `local_flags()` and the boresight pointing.  At most `max_bytes` of
+        prefetched data that has not been accessed yet are held at any
+        time.  Accessing a prefetched object waits for its read to finish
+        and lets the next queued objects be read.
+
+        Calling this method again replaces any previous prefetch order.
+
+        Args:
+            detectors (list):  Detector order of the next operator.  Defaults
+                to all local detectors.
+            boresight (bool):  Also read the boresight pointing.
+            flags (bool):  Also read the detector flags.
+            max_bytes (int):  Memory budget.  Defaults to PREFETCH_BYTES.
+            nthread (int):  Number of reader threads.
+
+        Returns:
+            None
+
+        """
+        self.prefetch_stop()
+        if detectors is None:
+            detectors = self.local_dets
+        if max_bytes is None:
+            max_bytes = PREFETCH_BYTES
+        self._prefetch_budget = max_bytes
+        nsamp = self.local_samples[1]
+        if nsamp <= 0:
+            return
+
+        queue = []
+        if boresight:
+            name = "{}_{}".format(STR_BORE, STR_QUAT)
+            if not self.cache.exists(name):
+                queue.append((name, self._prefetch_boresight, (name,), 32 * nsamp))
+        for det in detectors:
+            if det not in self.local_dets:
+                continue
+            name = "{}_{}".format(self.SIGNAL_NAME, det)
+            if not self.cache.exists(name):
+                queue.append((name, self._get, (det, 0, nsamp), 8 * nsamp))
+            if flags:
+                name = "{}_{}".format(self.FLAG_NAME, det)
+                if not self.cache.exists(name):
+                    queue.append((name, self._get_flags, (det, 0, nsamp), nsamp))
+        if len(queue) == 0:
+            return
+
+        self._prefetch_queue = queue
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=nthread)
+        self._prefetch_submit()
+        return
+
+    def prefetch_stop(self):
+        """Cancel queued reads and wait for the ones in progress."""
+        self._prefetch_queue = []
+        pending = self._prefetch_pending
+        self._prefetch_pending = {}
+        self._prefetch_bytes = 0
+        for future, _ in pending.values():
+            future.result()
+        if self._prefetch_pool is not None:
+            self._prefetch_pool.shutdown(wait=True)
+            self._prefetch_pool = None
+        return
+
+    def _prefetch_submit(self):
+        """Start queued reads while they fit in the memory budget."""
+        while len(self._prefetch_queue) > 0:
+            name, reader, args, nbytes = self._prefetch_queue[0]
+            if (
+                self._prefetch_bytes > 0
+                and self._prefetch_bytes + nbytes > self._prefetch_budget
+            ):
+                break
+            del self._prefetch_queue[0]
+            future = self._prefetch_pool.submit(self._prefetch_read, name, reader, args)
+            self._prefetch_pending[name] = (future, nbytes)
+            self._prefetch_bytes += nbytes
+        return
+
+    def _prefetch_read(self, name, reader, args):
+        """Read one object on a background thread and cache it."""
+        data = reader(*args)
+        if data is not None and not self.cache.exists(name):
+            self.cache.put(name, data)
         return
 
+    def _prefetch_boresight(self, name):
+        """Read and cache the boresight pointing on a background thread."""
+        with self._opened():
+            self._read_cache_helper(
+                name, ["X", "Y", "Z", "W"], 0, self.local_samples[1], True
+            )
+        return None
+
+    def _prefetch_wait(self, name):
+        """Make sure a prefetched object is complete before it is used."""
+        if name in self._prefetch_pending:
+            future, nbytes = self._prefetch_pending.pop(name)
+            self._prefetch_bytes -= nbytes
+            future.result()
+            self._prefetch_submit()
+        elif len(self._prefetch_queue) > 0:
+            # Accessed before its turn.  Read it synchronously instead.
+            self._prefetch_queue = [x for x in self._prefetch_queue if x[0] != name]
+        return
+
+    def local_signal(self, det, name=None, **kwargs):
+        """Locally stored signal, waiting for any prefetched read.
+
+        See `TOD.local_signal()`.
+
+        """
+        if name is None:
+            self._prefetch_wait("{}_{}".format(self.SIGNAL_NAME, det))
+        return super().local_signal(det, name=name, **kwargs)
+
+    def local_flags(self, det, name=None, **kwargs):
+        """Locally stored flags, waiting for any prefetched read.
+
+        See `TOD.local_flags()`.
+
+        """
+        if name is None:
+            self._prefetch_wait("{}_{}".format(self.FLAG_NAME, det))
+        return super().local_flags(det, name=name, **kwargs)
+
     @classmethod
     def create(
         cls,
@@ -579,12 +765,12 @@ class TODTidas(TOD):
     def _get_boresight(self, start, n, usecache=True):
         # Cache name
         cachebore = "{}_{}".format(STR_BORE, STR_QUAT)
+        self._prefetch_wait(cachebore)
         # Read and optionally cache the boresight pointing.
-        self._open()
-        ret = self._read_cache_helper(
-            cachebore, ["X", "Y", "Z", "W"], start, n, usecache
-        )
-        self._close()
+        with self._opened():
+            ret = self._read_cache_helper(
+                cachebore, ["X", "Y", "Z", "W"], start, n, usecache
+            )
         return ret
 
     def _put_boresight(self, start, data):
@@ -592,9 +778,8 @@ class TODTidas(TOD):
         borename = "{}_{}".format(STR_BORE, STR_QUAT)
         # Write data
         # self._writelock.lock()
-        self._open()
-        self._write_helper(data, borename, ["X", "Y", "Z", "W"], start)
-        self._close()
+        with self._opened():
+            self._write_helper(data, borename, ["X", "Y", "Z", "W"], start)
         # self._writelock.unlock()
         return
 
@@ -604,11 +789,10 @@ class TODTidas(TOD):
         # Cache name
         cachebore = "{}_{}".format(STR_BOREAZEL, STR_QUAT)
         # Read and optionally cache the boresight pointing.
-        self._open()
-        ret = self._read_cache_helper(
-            cachebore, ["X", "Y", "Z", "W"], start, n, usecache
-        )
-        self._close()
+        with self._opened():
+            ret = self._read_cache_helper(
+                cachebore, ["X", "Y", "Z", "W"], start, n, usecache
+            )
         return ret
 
     def _put_boresight_azel(self, start, data):
@@ -618,9 +802,8 @@ class TODTidas(TOD):
         borename = "{}_{}".format(STR_BOREAZEL, STR_QUAT)
         # Write data
         # self._writelock.lock()
-        self._open()
-        self._write_helper(data, borename, ["X", "Y", "Z", "W"], start)
-        self._close()
+        with self._opened():
+            self._write_helper(data, borename, ["X", "Y", "Z", "W"], start)
         # self._writelock.unlock()
         return
 
@@ -628,9 +811,8 @@ class TODTidas(TOD):
         # Compute the sample offset of our local data
         offset = self.local_samples[0] + start
         # Read from the data group and return
-        self._open()
-        ret = self._dgrp.read(detector, offset, n)
-        self._close()
+        with self._opened():
+            ret = self._dgrp.read(detector, offset, n)
         return ret
 
     def _put(self, detector, start, data):
@@ -638,9 +820,8 @@ class TODTidas(TOD):
         offset = self.local_samples[0] + start
         # Write to the data group
         # self._writelock.lock()
-        self._open()
-        self._dgrp.write(detector, offset, np.ascontiguousarray(data))
-        self._close()
+        with self._opened():
+            self._dgrp.write(detector, offset, np.ascontiguousarray(data))
         # self._writelock.unlock()
         return
 
@@ -649,9 +830,8 @@ class TODTidas(TOD):
         field = "{}_{}".format(STR_FLAG, detector)
         # Compute the sample offset of our local data
         offset = self.local_samples[0] + start
-        self._open()
-        ret = self._dgrp.read(field, offset, n)
-        self._close()
+        with self._opened():
+            ret = self._dgrp.read(field, offset, n)
         return ret
 
     def _put_flags(self, detector, start, flags):
@@ -661,9 +841,8 @@ class TODTidas(TOD):
         offset = self.local_samples[0] + start
         # Write to the data group
         # self._writelock.lock()
-        self._open()
-        self._dgrp.write(field, offset, np.ascontiguousarray(flags))
-        self._close()
+        with self._opened():
+            self._dgrp.write(field, offset, np.ascontiguousarray(flags))
         # self._writelock.unlock()
         return
 
@@ -673,9 +852,8 @@ class TODTidas(TOD):
         # Compute the sample offset of our local data
         offset = self.local_samples[0] + start
         # Read from the data group and return
-        self._open()
-        ret = self._dgrp.read(field, offset, n)
-        self._close()
+        with self._opened():
+            ret = self._dgrp.read(field, offset, n)
         return ret
 
     def _put_common_flags(self, start, flags):
@@ -685,18 +863,16 @@ class TODTidas(TOD):
         offset = self.local_samples[0] + start
         # Write to the data group
         # self._writelock.lock()
-        self._open()
-        self._dgrp.write(field, offset, np.ascontiguousarray(flags))
-        self._close()
+        with self._opened():
+            self._dgrp.write(field, offset, np.ascontiguousarray(flags))
         # self._writelock.unlock()
         return
 
     def _get_times(self, start, n):
         # Compute the sample offset of our local data
         offset = self.local_samples[0] + start
-        self._open()
-        ret = self._dgrp.read_times(offset, n)
-        self._close()
+        with self._opened():
+            ret = self._dgrp.read_times(offset, n)
         return ret
 
     def _put_times(self, start, stamps):
@@ -704,9 +880,8 @@ class TODTidas(TOD):
         offset = self.local_samples[0] + start
         # Write to the data group
         # self._writelock.lock()
-        self._open()
-        self._dgrp.write_times(offset, np.ascontiguousarray(stamps))
-        self._close()
+        with self._opened():
+            self._dgrp.write_times(offset, np.ascontiguousarray(stamps))
         # self._writelock.unlock()
         return
 
@@ -714,9 +889,8 @@ class TODTidas(TOD):
         # Get boresight pointing (from disk or cache)
         bore = self._get_boresight(start, n)
         # Apply detector quaternion and return
-        self._open()
-        ret = qa.mult(bore, self._detquats[detector])
-        self._close()
+        with self._opened():
+            ret = qa.mult(bore, self._detquats[detector])
         return ret
 
     def _put_pntg(self, detector, start, data):
@@ -728,31 +902,27 @@ class TODTidas(TOD):
 
     def _get_position(self, start, n, usecache=False):
         # Read and optionally cache the telescope position.
-        self._open()
-        ret = self._read_cache_helper(STR_POS, ["X", "Y", "Z"], start, n, usecache)
-        self._close()
+        with self._opened():
+            ret = self._read_cache_helper(STR_POS, ["X", "Y", "Z"], start, n, usecache)
         return ret
 
     def _put_position(self, start, pos):
         # self._writelock.lock()
-        self._open()
-        self._write_helper(pos, STR_POS, ["X", "Y", "Z"], start)
-        self._close()
+        with self._opened():
+            self._write_helper(pos, STR_POS, ["X", "Y", "Z"], start)
         # self._writelock.unlock()
         return
 
     def _get_velocity(self, start, n, usecache=False):
         # Read and optionally cache the telescope velocity.
-        self._open()
-        ret = self._read_cache_helper(STR_VEL, ["X", "Y", "Z"], start, n, usecache)
-        self._close()
+        with self._opened():
+            ret = self._read_cache_helper(STR_VEL, ["X", "Y", "Z"], start, n, usecache)
         return ret
 
     def _put_velocity(self, start, vel):
         # self._writelock.lock()
-        self._open()
-        self._write_helper(vel, STR_VEL, ["X", "Y", "Z"], start)
-        self._close()
+        with self._opened():
+            self._write_helper(vel, STR_VEL, ["X", "Y", "Z"], start)
         # self._writelock.unlock()
         return
 
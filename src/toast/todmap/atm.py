@@ -2,6 +2,7 @@
 # All rights reserved.  Use of this source code is governed by
 # a BSD-style license that can be found in the LICENSE file.
 
+import hashlib
 import os
 import numpy as np
 
@@ -18,6 +19,7 @@ from ..mpi import MPI, MPIShared
 from .._libtoast import (
     atm_sim_compute_slice,
     atm_sim_observe,
+    atm_sim_observe_many,
     atm_sim_compress_flag_hits_rank,
     atm_sim_compress_flag_extend_rank,
     atm_sim_kolmogorov_init_rank,
@@ -36,6 +38,68 @@ if available_utils is None:
     except ImportError:
         available_utils = False
 
+# Bump this whenever the layout or the contents of the cached realizations change
+ATM_CACHE_VERSION = 1
+
+# Compression filter for the cached index arrays
+ATM_CACHE_COMPRESSION = "gzip"
+
+
+def atm_shells(
+    xstep, ystep, zstep, rmax_first=100, rmax=10000, scale=10, step_exponent=0.5
+):
+    """Return the nested radial shells of a multi-resolution simulation.
+
+    The line of sight is split into shells [0, rmax_first],
+    [rmax_first, scale * rmax_first], ... up to rmax.  Every shell is an
+    independent simulation whose volume element grows with the outer radius
+    of the shell as (r / rmax_first)**step_exponent.  With step_exponent = 1
+    the elements subtend a constant angle as seen from the telescope.
+    AtmSim.observe integrates every shell over exactly its own radial range.
+    Shells that are too thin to contain a single integration step are
+    skipped.
+
+    Args:
+        xstep (float):  Size of the innermost volume element in the X direction.
+        ystep (float):  Size of the innermost volume element in the Y direction.
+        zstep (float):  Size of the innermost volume element in the Z direction.
+        rmax_first (float):  Outer radius of the innermost shell.
+        rmax (float):  Outer radius of the outermost shell.
+        scale (float):  Ratio of the outer radii of consecutive shells.
+        step_exponent (float):  Growth of the volume element with distance.
+
+    Returns:
+        (list):  Tuples of (ishell, rmin, rmax, xstep, ystep, zstep).  The
+            shell index should be used to offset the RNG counter so that a
+            shell always gets the same realization.
+
+    """
+    if rmax_first <= 0 or scale <= 1:
+        raise RuntimeError("atm_shells: need rmax_first > 0 and scale > 1")
+    shells = list()
+    ishell = 0
+    rlow = 0
+    rhigh = rmax_first
+    while rlow < rmax:
+        factor = (rhigh / rmax_first) ** step_exponent
+        shell_xstep = xstep * factor
+        # AtmSim.observe does not integrate the first volume element
+        if min(rhigh, rmax) > max(rlow, shell_xstep):
+            shells.append(
+                (
+                    ishell,
+                    rlow,
+                    min(rhigh, rmax),
+                    shell_xstep,
+                    ystep * factor,
+                    zstep * factor,
+                )
+            )
+        ishell += 1
+        rlow = rhigh
+        rhigh *= scale
+    return shells
+
 
 class AtmSim(object):
     """Class representing a single atmosphere simulation.
@@ -84,9 +148,16 @@ class AtmSim(object):
         rmin (float):  Minimum line of sight observing distance.
         rmax (float):  Maximum line of sight observing distance.
         write_debug (bool): If true, write out intermediate text files for debugging.
+        cache_size (int):  Maximum total size of the cache directory in bytes.
+            The least recently used realizations are removed when a new one
+            is saved.  None means no limit.
 
     """
 
+    # Cache statistics of this process, see cache_stats()
+    _cache_hits = 0
+    _cache_misses = 0
+
     def __init__(
         self,
         azmin,
@@ -122,6 +193,7 @@ class AtmSim(object):
         rmin,
         rmax,
         write_debug=False,
+        cache_size=None,
     ):
         self._azmin = azmin
         self._azmax = azmax
@@ -156,6 +228,7 @@ class AtmSim(object):
         self._rmin = rmin
         self._rmax = rmax
         self._write_debug = write_debug
+        self._cache_size = cache_size
 
         self._counter1 = self._counter1start
         self._counter2 = self._counter2start
@@ -260,6 +333,7 @@ class AtmSim(object):
         self._full_index = None
         self._realization = None
         self._cached = False
+        self._cache_hit = False
         self._nelem = None
 
     @function_timer
@@ -277,7 +351,7 @@ class AtmSim(object):
         if use_cache:
             if self._cachedir is None:
                 raise RuntimeError("Cannot use the cache if cachedir is not set")
-            self.load_realization()
+            self.load_realization(smooth=smooth)
 
         if self._cached:
             return 0
@@ -410,7 +484,7 @@ class AtmSim(object):
 
         self._cached = True
         if use_cache:
-            self.save_realization()
+            self.save_realization(smooth=smooth)
 
         timer.stop()
         if use_cache and self._rank == 0:
@@ -508,6 +582,109 @@ class AtmSim(object):
             log.error("Observing {} samples failed with error {}".format(nsamp, status))
         return status
 
+    @function_timer
+    def observe_many(self, times, az, el, tod, good=None, fixed_r=-1):
+        """Observe the atmosphere with several detectors.
+
+        All detectors share the timestamps and are integrated in a single
+        threaded call that steps their lines of sight together.  Samples
+        that are not good are not observed and their output is left
+        untouched.
+
+        Args:
+            times (array_like):  Timestamps shared by all detectors.
+            az (array_like):  Azimuth values, one row per detector.
+            el (array_like):  Elevation values, one row per detector.
+            tod (array):  The C-contiguous float64 output buffer to fill,
+                one row per detector.
+            good (array_like):  Optional mask of the samples to observe,
+                one row per detector.
+            fixed_r (float):  If greater than zero, use this single radial value.
+
+        Returns:
+            (int):  A status value (zero == good).
+
+        """
+        if not self._cached:
+            raise RuntimeError("There is no cached observation to observe")
+
+        log = Logger.get()
+        timer = Timer()
+        timer.start()
+
+        times = np.ascontiguousarray(times, dtype=np.float64)
+        shape = (tod.shape[0], times.size)
+        if tod.shape != shape:
+            raise RuntimeError(
+                "Output buffer has shape {}, expected {}".format(tod.shape, shape)
+            )
+        if tod.dtype != np.float64 or not tod.flags["C_CONTIGUOUS"]:
+            raise RuntimeError("Output buffer must be C-contiguous float64")
+        az = np.ascontiguousarray(az, dtype=np.float64).reshape(-1)
+        el = np.ascontiguousarray(el, dtype=np.float64).reshape(-1)
+        if good is None:
+            good = np.ones(shape, dtype=np.uint8)
+        good = np.ascontiguousarray(good, dtype=np.uint8).reshape(-1)
+
+        status = atm_sim_observe_many(
+            times,
+            az,
+            el,
+            good,
+            tod.reshape(-1),
+            self._T0,
+            self._azmin,
+            self._azmax,
+            self._elmin,
+            self._elmax,
+            self._tmin,
+            self._tmax,
+            self._rmin,
+            self._rmax,
+            fixed_r,
+            self._zatm,
+            self._zmax,
+            self._wx,
+            self._wy,
+            self._wz,
+            self._xstep,
+            self._ystep,
+            self._zstep,
+            self._xstart,
+            self._delta_x,
+            self._ystart,
+            self._delta_y,
+            self._zstart,
+            self._delta_z,
+            self._maxdist,
+            self._nx,
+            self._ny,
+            self._nz,
+            self._xstride,
+            self._ystride,
+            self._zstride,
+            self._compressed_index.data,
+            self._full_index.data,
+            self._realization.data,
+        )
+
+        timer.stop()
+
+        if self._rank == 0:
+            log.debug(
+                "Observed {} x {} samples in {} s".format(
+                    shape[0], shape[1], timer.seconds()
+                )
+            )
+
+        if status != 0:
+            log.error(
+                "Observing {} x {} samples failed with error {}".format(
+                    shape[0], shape[1], status
+                )
+            )
+        return status
+
     def _get_slice(self, ind_start, ind_stop):
         """Identify a manageable slice of compressed indices to simulate next."""
         log = Logger.get()
@@ -975,8 +1152,117 @@ class AtmSim(object):
             ]
         )
 
+    def _cache_keys(self):
+        """Helper function to return the simulation inputs that define a
+        realization.  All of these are hashed into the cache file name.
+        """
+        return list(
+            [
+                ("azmin", float),
+                ("azmax", float),
+                ("elmin", float),
+                ("elmax", float),
+                ("tmin", float),
+                ("tmax", float),
+                ("lmin_center", float),
+                ("lmin_sigma", float),
+                ("lmax_center", float),
+                ("lmax_sigma", float),
+                ("w_center", float),
+                ("w_sigma", float),
+                ("wdir_center", float),
+                ("wdir_sigma", float),
+                ("z0_center", float),
+                ("z0_sigma", float),
+                ("T0_center", float),
+                ("T0_sigma", float),
+                ("zatm", float),
+                ("zmax", float),
+                ("xstep", float),
+                ("ystep", float),
+                ("zstep", float),
+                ("nelem_sim_max", int),
+                ("key1", int),
+                ("key2", int),
+                ("counter1start", int),
+                ("counter2start", int),
+                ("rmin", float),
+                ("rmax", float),
+                ("corrlim", float),
+            ]
+        )
+
+    def cache_name(self, smooth=False):
+        """Return the content-addressed name of this realization.
+
+        The name is a hash over all simulation parameters and RNG keys, so
+        any two simulations with the same name produce the same realization
+        regardless of the process layout or the observation they belong to.
+
+        Args:
+            smooth (bool):  The smoothing flag passed to simulate().
+
+        Returns:
+            (str):  The hexadecimal digest.
+
+        """
+        digest = hashlib.sha1()
+        digest.update("version={}\n".format(ATM_CACHE_VERSION).encode())
+        for k, tp in self._cache_keys():
+            value = tp(getattr(self, "_{}".format(k)))
+            digest.update("{}={!r}\n".format(k, value).encode())
+        digest.update("smooth={!r}\n".format(bool(smooth)).encode())
+        return digest.hexdigest()
+
+    def cache_file(self, smooth=False):
+        """Return the path of this realization in the cache directory.
+
+        Files are sharded into sub-directories by the first two characters
+        of the name to keep the directories small.
+
+        Args:
+            smooth (bool):  The smoothing flag passed to simulate().
+
+        Returns:
+            (str):  The file path or None if there is no cache directory.
+
+        """
+        if self._cachedir is None:
+            return None
+        rname = self.cache_name(smooth=smooth)
+        return os.path.join(self._cachedir, rname[:2], "{}.h5".format(rname))
+
+    @property
+    def cache_hit(self):
+        """True if the realization was loaded from the cache."""
+        return self._cache_hit
+
+    @classmethod
+    def cache_stats(cls):
+        """Return the number of cache hits and misses in this process.
+
+        Returns:
+            (tuple):  The number of hits and misses of load_realization().
+
+        """
+        return cls._cache_hits, cls._cache_misses
+
     @function_timer
-    def save_realization(self):
+    def save_realization(self, smooth=False):
+        """Write the realization into the cache directory.
+
+        The index arrays are compressed.  The realization itself is written
+        as one contiguous, uncompressed dataset so that it can be memory
+        mapped when loading.  Afterwards the cache is trimmed to the
+        requested size.
+
+        Args:
+            smooth (bool):  The smoothing flag passed to simulate().
+
+        Returns:
+            None
+
+        """
         if (
             (self._realization is None)
             or (self._full_index is None)
@@ -988,11 +1274,10 @@ class AtmSim(object):
 
             log = Logger.get()
 
-            rname = "{}_{}_{}_{}".format(
-                self._key1, self._key2, self._counter1start, self._counter2start
-            )
-            outfile = os.path.join(self._cachedir, "{}.h5".format(rname))
-            tmpfile = "{}.tmp".format(outfile)
+            rname = self.cache_name(smooth=smooth)
+            outfile = self.cache_file(smooth=smooth)
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+            tmpfile = "{}.{}.tmp".format(outfile, os.getpid())
 
             hf = h5py.File(tmpfile, "w")
 
@@ -1000,17 +1285,27 @@ class AtmSim(object):
             meta = hf.attrs
             for k, tp in self._meta_keys():
                 meta.create(k, getattr(self, "_{}".format(k)))
+            meta.create("cache_version", ATM_CACHE_VERSION)
+            meta.create("cache_name", rname)
 
             log.debug("Saved metadata for {}".format(rname))
 
             realiz = hf.create_dataset("realization", data=self._realization.data)
             log.debug("Saved realization for {}".format(rname))
 
-            full = hf.create_dataset("full_index", data=self._full_index.data)
+            full = hf.create_dataset(
+                "full_index",
+                data=self._full_index.data,
+                compression=ATM_CACHE_COMPRESSION,
+                shuffle=True,
+            )
             log.debug("Saved full index for {}".format(rname))
 
             comp = hf.create_dataset(
-                "compressed_index", data=self._compressed_index.data
+                "compressed_index",
+                data=self._compressed_index.data,
+                compression=ATM_CACHE_COMPRESSION,
+                shuffle=True,
             )
             log.debug("Saved compressed index for {}".format(rname))
             hf.flush()
@@ -1019,26 +1314,74 @@ class AtmSim(object):
             # Move file into place
             os.rename(tmpfile, outfile)
 
+            if self._cache_size is not None:
+                self._evict_cache(outfile)
+
         if self._comm is not None:
             self._comm.barrier()
         return
 
+    def _evict_cache(self, keep):
+        """Remove the least recently used realizations until the total size
+        of the cache directory is below the limit.  The file `keep` is never
+        removed.
+        """
+        log = Logger.get()
+        entries = list()
+        total = 0
+        for root, dirs, files in os.walk(self._cachedir):
+            for fname in files:
+                if not fname.endswith(".h5"):
+                    continue
+                path = os.path.join(root, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # Removed by another process group
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self._cache_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            log.debug("Evicted {} from the atmosphere cache".format(path))
+        return
+
     @function_timer
-    def load_realization(self):
-        rname = None
-        cachefile = None
+    def load_realization(self, smooth=False):
+        """Load the realization from the cache directory, if it exists.
+
+        The metadata are read by one process and broadcast.  The arrays are
+        read by one process on every node, directly into the node-local
+        shared memory, so no data is sent between nodes.  The realization is
+        memory mapped from the file whenever its layout allows it.
+
+        Args:
+            smooth (bool):  The smoothing flag passed to simulate().
+
+        Returns:
+            None
+
+        """
+        rname = self.cache_name(smooth=smooth)
+        cachefile = self.cache_file(smooth=smooth)
         found = False
         if self._rank == 0:
-            rname = "{}_{}_{}_{}".format(
-                self._key1, self._key2, self._counter1start, self._counter2start
-            )
-            cachefile = os.path.join(self._cachedir, "{}.h5".format(rname))
             if os.path.isfile(cachefile):
                 found = True
         if self._comm is not None:
             found = self._comm.bcast(found, root=0)
 
         if not found:
+            AtmSim._cache_misses += 1
             return
 
         if self._realization is not None:
@@ -1048,18 +1391,20 @@ class AtmSim(object):
         if self._compressed_index is not None:
             del self._compressed_index
 
+        log = Logger.get()
+
         mdata = dict()
-        hf = None
         if self._rank == 0:
-            log = Logger.get()
-
             try:
-                hf = h5py.File(cachefile, "r")
-                # Read metadata
-                meta = hf.attrs
-                for k, tp in self._meta_keys():
-                    # Copy the metadata value into a dictionary, casting to correct type
-                    mdata[k] = tp(meta[k])
+                with h5py.File(cachefile, "r") as hf:
+                    # Read metadata
+                    meta = hf.attrs
+                    if meta["cache_version"] != ATM_CACHE_VERSION:
+                        raise RuntimeError("Incompatible cache version")
+                    for k, tp in self._meta_keys():
+                        # Copy the metadata value into a dictionary, casting to
+                        # correct type
+                        mdata[k] = tp(meta[k])
                 log.debug("Loaded metadata for {}".format(rname))
             except Exception as e:
                 print(
@@ -1074,6 +1419,7 @@ class AtmSim(object):
             mdata = self._comm.bcast(mdata, root=0)
 
         if mdata is None:
+            AtmSim._cache_misses += 1
             return
 
         # Copy the metadata into class instance member variables
@@ -1085,30 +1431,64 @@ class AtmSim(object):
         self._compressed_index = MPIShared((self._nn,), np.int64, self._comm)
         self._full_index = MPIShared((self._nelem,), np.int64, self._comm)
 
-        # Read and set shared memory
-        buffer = None
-        if self._rank == 0:
-            buffer = np.zeros(self._nelem, dtype=np.float64)
-            hf["realization"].read_direct(buffer)
-            log.debug("Loaded realization for {}".format(rname))
-        self._realization.set(buffer, (0,), fromrank=0)
+        # One process per node fills the node-local shared memory
+        noderank = 0
+        nodecomm = self._realization.nodecomm
+        if nodecomm is not None:
+            noderank = nodecomm.rank
 
-        if self._rank == 0:
-            buffer = np.zeros(self._nelem, dtype=np.int64)
-            hf["full_index"].read_direct(buffer)
-            log.debug("Loaded full index for {}".format(rname))
-        self._full_index.set(buffer, (0,), fromrank=0)
+        failed = False
+        if noderank == 0:
+            try:
+                with h5py.File(cachefile, "r") as hf:
+                    dset = hf["realization"]
+                    offset = dset.id.get_offset()
+                    if offset is None:
+                        dset.read_direct(self._realization.data)
+                    else:
+                        mapped = np.memmap(
+                            cachefile,
+                            dtype=dset.dtype,
+                            mode="r",
+                            offset=offset,
+                            shape=dset.shape,
+                        )
+                        self._realization.data[:] = mapped
+                        del mapped
+                    hf["full_index"].read_direct(self._full_index.data)
+                    hf["compressed_index"].read_direct(self._compressed_index.data)
+            except Exception as e:
+                print(
+                    f"ERROR: failed to read cached atmosphere realization"
+                    f" from {cachefile}: {e}. Will simulate again.",
+                    flush=True,
+                )
+                failed = True
+        if self._comm is not None:
+            failed = self._comm.allreduce(failed, op=MPI.LOR)
 
-        if self._rank == 0:
-            buffer = np.zeros(self._nn, dtype=np.int64)
-            hf["compressed_index"].read_direct(buffer)
-            log.debug("Loaded compressed index for {}".format(rname))
-        self._compressed_index.set(buffer, (0,), fromrank=0)
+        if failed:
+            del self._realization
+            del self._full_index
+            del self._compressed_index
+            self._realization = None
+            self._full_index = None
+            self._compressed_index = None
+            AtmSim._cache_misses += 1
+            return
 
-        if self._comm is not None:
-            self._comm.barrier()
+        if self._rank == 0:
+            log.debug("Loaded realization for {}".format(rname))
+            # Refresh the modification time so that eviction treats the
+            # cache as least recently used rather than least recently written.
+            try:
+                os.utime(cachefile)
+            except OSError:
+                pass
 
         self._cached = True
+        self._cache_hit = True
+        AtmSim._cache_hits += 1
         return
 
     @function_timer
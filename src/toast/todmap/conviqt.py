@@ -2,6 +2,7 @@
 # All rights reserved.  Use of this source code is governed by
 # a BSD-style license that can be found in the LICENSE file.
 
+from collections import OrderedDict
 import warnings
 
 from ..mpi import use_mpi
@@ -22,6 +23,9 @@ if use_mpi:
     except ImportError:
         pass
 
+# Default number of loaded sky and beam expansions kept in memory
+ALM_CACHE_SIZE = 4
+
 
 class OpSimConviqt(Operator):
     """Operator which uses libconviqt to generate beam-convolved timestreams.
@@ -58,6 +62,9 @@ class OpSimConviqt(Operator):
         out (str): the name of the cache object (<name>_<detector>) to
             use for output of the detector timestream.
         mc (int): Monte Carlo index used in synthesizing the input file names.
+        cache_size (int): Number of loaded sky and beam expansions to keep
+            in memory.  Detectors sharing the same files are processed
+            consecutively so that each file is only read once.
 
     """
 
@@ -85,6 +92,7 @@ class OpSimConviqt(Operator):
         normalize_beam=False,
         verbosity=0,
         mc=None,
+        cache_size=ALM_CACHE_SIZE,
     ):
         # Call the parent class constructor
         super().__init__()
@@ -110,6 +118,8 @@ class OpSimConviqt(Operator):
         self._normalize_beam = normalize_beam
         self._verbosity = verbosity
         self._mc = mc
+        self._cache_size = cache_size
+        self._alm_cache = OrderedDict()
 
         self._out = out
 
@@ -154,22 +164,14 @@ class OpSimConviqt(Operator):
 
         self._check_for_hwp(data)
 
-        detectors = self._get_detectors(data)
+        detectors = self._group_detectors(self._get_detectors(data))
 
         for det in detectors:
             verbose = self._comm.rank == 0 and self._verbosity > 0
 
-            try:
-                sky_file = self._sky_file[det]
-            except TypeError:
-                sky_file = self._sky_file.format(detector=det, mc=self._mc)
-            sky = self.get_sky(sky_file, det, verbose)
-
-            try:
-                beam_file = self._beam_file[det]
-            except TypeError:
-                beam_file = self._beam_file.format(detector=det, mc=self._mc)
+            sky = self.get_sky(self._get_sky_file(det), det, verbose)
 
+            (beam_file,) = self._get_beam_files(det)
             beam = self.get_beam(beam_file, det, verbose)
 
             detector = self.get_detector(det)
@@ -188,6 +190,52 @@ class OpSimConviqt(Operator):
             if verbose:
                 timer.report_clear("conviqt process detector {}".format(det))
 
+        self._alm_cache.clear()
+
+        return
+
+    def _get_sky_file(self, det):
+        """Return the sky file name of one detector."""
+        try:
+            return self._sky_file[det]
+        except TypeError:
+            return self._sky_file.format(detector=det, mc=self._mc)
+
+    def _get_beam_file(self, det):
+        """Return the beam file name of one detector."""
+        try:
+            return self._beam_file[det]
+        except TypeError:
+            return self._beam_file.format(detector=det, mc=self._mc)
+
+    def _get_beam_files(self, det):
+        """Return the names of all beam files used by one detector."""
+        return (self._get_beam_file(det),)
+
+    def _group_detectors(self, detectors):
+        """Order the detectors so that detectors sharing the same sky and
+        beam files are processed consecutively.  The order is identical on
+        all processes in `self._comm`.
+        """
+        return sorted(
+            detectors,
+            key=lambda det: (self._get_sky_file(det), self._get_beam_files(det), det),
+        )
+
+    def _cache_get(self, key):
+        """Return a cached sky or beam object and mark it as recently used."""
+        if key not in self._alm_cache:
+            return None
+        self._alm_cache.move_to_end(key)
+        return self._alm_cache[key]
+
+    def _cache_put(self, key, value):
+        """Add a sky or beam object to the cache and discard the least
+        recently used objects beyond the cache size.
+        """
+        self._alm_cache[key] = value
+        while len(self._alm_cache) > self._cache_size:
+            self._alm_cache.popitem(last=False)
         return
 
     def _get_detectors(self, data):
@@ -259,6 +307,10 @@ class OpSimConviqt(Operator):
         return epsilon
 
     def get_sky(self, skyfile, det, verbose):
+        key = ("sky", skyfile, self._lmax)
+        sky = self._cache_get(key)
+        if sky is not None:
+            return sky
         timer = Timer()
         timer.start()
         sky = conviqt.Sky(self._lmax, self._pol, skyfile, self._fwhm, self._comm)
@@ -266,16 +318,22 @@ class OpSimConviqt(Operator):
             sky.remove_monopole()
         if self._remove_dipole:
             sky.remove_dipole()
+        self._cache_put(key, sky)
         if verbose:
             timer.report_clear("initialize sky for detector {}".format(det))
         return sky
 
     def get_beam(self, beamfile, det, verbose):
+        key = ("beam", beamfile, self._lmax, self._beammmax)
+        beam = self._cache_get(key)
+        if beam is not None:
+            return beam
         timer = Timer()
         timer.start()
         beam = conviqt.Beam(self._lmax, self._beammmax, self._pol, beamfile, self._comm)
         if self._normalize_beam:
             beam.normalize()
+        self._cache_put(key, beam)
         if verbose:
             timer.report_clear("initialize beam for detector {}".format(det))
         return beam
@@ -476,6 +534,9 @@ class OpSimWeightedConviqt(OpSimConviqt):
         out (str): the name of the cache object (<name>_<detector>) to
             use for output of the detector timestream.
         mc (int): Monte Carlo index used in synthesizing the input file names.
+        cache_size (int): Number of loaded sky and beam expansions to keep
+            in memory.  Detectors sharing the same files are processed
+            consecutively so that each file is only read once.
 
     """
 
@@ -503,6 +564,7 @@ class OpSimWeightedConviqt(OpSimConviqt):
         normalize_beam=False,
         verbosity=0,
         mc=None,
+        cache_size=ALM_CACHE_SIZE,
     ):
         # Call the parent class constructor
         super(OpSimConviqt, self).__init__()
@@ -528,6 +590,8 @@ class OpSimWeightedConviqt(OpSimConviqt):
         self._normalize_beam = normalize_beam
         self._verbosity = verbosity
         self._mc = mc
+        self._cache_size = cache_size
+        self._alm_cache = OrderedDict()
 
         self._out = out
 
@@ -548,24 +612,14 @@ class OpSimWeightedConviqt(OpSimConviqt):
         timer = Timer()
         timer.start()
 
-        detectors = self._get_detectors(data)
+        detectors = self._group_detectors(self._get_detectors(data))
 
         for det in detectors:
             verbose = self._comm.rank == 0 and self._verbosity > 0
 
-            try:
-                sky_file = self._sky_file[det]
-            except TypeError:
-                sky_file = self._sky_file.format(detector=det, mc=self._mc)
-            sky = self.get_sky(sky_file, det, verbose)
+            sky = self.get_sky(self._get_sky_file(det), det, verbose)
 
-            try:
-                beam_file = self._beam_file[det]
-            except TypeError:
-                beam_file = self._beam_file.format(detector=det, mc=self._mc)
-                beam_file_i00 = beam_file.replace(".fits", "_I000.fits")
-                beam_file_0i0 = beam_file.replace(".fits", "_0I00.fits")
-                beam_file_00i = beam_file.replace(".fits", "_00I0.fits")
+            beam_file_i00, beam_file_0i0, beam_file_00i = self._get_beam_files(det)
 
             beamI00 = self.get_beam(beam_file_i00, det, verbose)
             beam0I0 = self.get_beam(beam_file_0i0, det, verbose)
@@ -602,4 +656,15 @@ class OpSimWeightedConviqt(OpSimConviqt):
             if verbose:
                 timer.report_clear("conviqt process detector {}".format(det))
 
+        self._alm_cache.clear()
+
         return
+
+    def _get_beam_files(self, det):
+        """Return the names of the I, Q and U beam files of one detector."""
+        beam_file = self._get_beam_file(det)
+        return (
+            beam_file.replace(".fits", "_I000.fits"),
+            beam_file.replace(".fits", "_0I00.fits"),
+            beam_file.replace(".fits", "_00I0.fits"),
+        )
@@ -4,6 +4,8 @@
 
 from ..mpi import MPI
 
+import hashlib
+import json
 import os
 import re
 from time import time
@@ -24,6 +26,292 @@ from ..op import Operator
 from ..utils import Logger
 from ..timing import function_timer
 
+# Observation matrix files start with the magic string and the header length
+OBS_MATRIX_MAGIC = b"TOASTOBM"
+OBS_MATRIX_VERSION = 1
+# Arrays in the observation matrix files are aligned to this many bytes
+OBS_MATRIX_ALIGN = 64
+
+
+# Minimum number of row slices the observation matrix is collected in
+OBS_MATRIX_NSLICE = 128
+
+
+def _align(offset):
+    return (offset + OBS_MATRIX_ALIGN - 1) // OBS_MATRIX_ALIGN * OBS_MATRIX_ALIGN
+
+
+def _merge_csr(pieces, shape):
+    """Sum CSR matrices given as (data, indices, indptr) tuples.
+
+    All index structures are concatenated and merged in a single pass,
+    which is efficient when the sparsity patterns are mostly disjoint.
+    """
+    if len(pieces) == 1:
+        return scipy.sparse.csr_matrix(pieces[0], shape=shape)
+    nrow = shape[0]
+    rows = []
+    for data, indices, indptr in pieces:
+        rows.append(np.repeat(np.arange(nrow, dtype=np.int64), np.diff(indptr)))
+    rows = np.hstack(rows)
+    cols = np.hstack([indices for _, indices, _ in pieces])
+    data = np.hstack([data for data, _, _ in pieces])
+    # tocsr() sums the duplicate entries
+    return scipy.sparse.coo_matrix((data, (rows, cols)), shape=shape).tocsr()
+
+
+def reduce_csr_slices(comm, get_slice, nrow, ncol, nslice):
+    """Sum a distributed sparse matrix one row slice at a time.
+
+    The rows are split into `nslice` slices that are assigned round robin
+    to the processes.  In each round every process extracts its local part
+    of one slice per process and posts non-blocking sends of the CSR arrays
+    to the slice owners, which merge all contributions at once.  No process
+    ever holds more than one round of slices.
+
+    This function is collective over `comm` and must be iterated to the end
+    on every process.
+
+    Args:
+        comm (mpi4py.MPI.Comm):  The communicator or None.
+        get_slice (callable):  get_slice(row_start, row_stop) returns the
+            local (row_stop - row_start) x ncol rows as a CSR matrix.
+        nrow (int):  Number of rows in the matrix.
+        ncol (int):  Number of columns in the matrix.
+        nslice (int):  Number of row slices.
+
+    Yields:
+        (tuple):  (islice, row_start, row_stop, matrix) for every non-empty
+            slice owned by this process.
+
+    """
+    if comm is None:
+        rank, ntask = 0, 1
+    else:
+        rank, ntask = comm.rank, comm.size
+    nrow_slice = -(-nrow // nslice)
+    bounds = [
+        (row_start, min(row_start + nrow_slice, nrow))
+        for row_start in range(0, nrow, nrow_slice)
+    ]
+    for first in range(0, len(bounds), ntask):
+        round_bounds = bounds[first : first + ntask]
+        local = []
+        send_counts = np.zeros(ntask, dtype=np.int64)
+        for owner, (row_start, row_stop) in enumerate(round_bounds):
+            matrix = scipy.sparse.csr_matrix(get_slice(row_start, row_stop))
+            local.append(
+                (
+                    matrix.data.astype(np.float64, copy=False),
+                    matrix.indices.astype(np.int64, copy=False),
+                    matrix.indptr.astype(np.int64, copy=False),
+                )
+            )
+            send_counts[owner] = matrix.nnz
+            del matrix
+        if comm is None:
+            recv_counts = send_counts
+        else:
+            recv_counts = np.zeros(ntask, dtype=np.int64)
+            comm.Alltoall(send_counts, recv_counts)
+
+        requests = []
+        for owner, arrays in enumerate(local):
+            if owner == rank or send_counts[owner] == 0:
+                continue
+            for tag, array in enumerate(arrays):
+                requests.append(comm.Isend(array, dest=owner, tag=tag))
+        pieces = []
+        if rank < len(round_bounds):
+            row_start, row_stop = round_bounds[rank]
+            for source in range(ntask):
+                if recv_counts[source] == 0:
+                    continue
+                if source == rank:
+                    pieces.append(local[rank])
+                    continue
+                piece = (
+                    np.empty(recv_counts[source], dtype=np.float64),
+                    np.empty(recv_counts[source], dtype=np.int64),
+                    np.empty(row_stop - row_start + 1, dtype=np.int64),
+                )
+                for tag, array in enumerate(piece):
+                    requests.append(comm.Irecv(array, source=source, tag=tag))
+                pieces.append(piece)
+        if len(requests) > 0:
+            MPI.Request.Waitall(requests)
+        del local
+
+        if len(pieces) > 0:
+            islice = first + rank
+            shape = (row_stop - row_start, ncol)
+            yield islice, row_start, row_stop, _merge_csr(pieces, shape)
+        del pieces
+    return
+
+
+class ObsMatrixFile(object):
+    """A sparse CSR matrix stored in a single memory-mappable file.
+
+    The file holds a short JSON header with the matrix shape, the array
+    layout and user metadata, followed by the aligned CSR arrays.  The
+    arrays are memory-mapped on access, so opening a file to check
+    its metadata is cheap and row slices can be streamed without reading
+    the entire matrix.
+
+    Args:
+        fname (str):  Path to an existing observation matrix file.
+    """
+
+    def __init__(self, fname):
+        self._fname = fname
+        with open(fname, "rb") as f:
+            magic = f.read(len(OBS_MATRIX_MAGIC))
+            if magic != OBS_MATRIX_MAGIC:
+                raise RuntimeError("{} is not an observation matrix".format(fname))
+            nheader = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            header = json.loads(f.read(nheader).decode("utf-8"))
+        if header["version"] != OBS_MATRIX_VERSION:
+            raise RuntimeError(
+                "Unsupported observation matrix version {} in {}".format(
+                    header["version"], fname
+                )
+            )
+        self._shape = tuple(header["shape"])
+        self._metadata = header["metadata"]
+        self._layout = header["arrays"]
+        self._base = _align(len(OBS_MATRIX_MAGIC) + 8 + nheader)
+
+    @staticmethod
+    def write(fname, matrix, metadata):
+        """Write a sparse matrix and its metadata.
+
+        The file is written under a temporary name and renamed so that
+        concurrent readers never see a partial file.
+
+        Args:
+            fname (str):  Output path.
+            matrix (scipy.sparse matrix):  The matrix to write.
+            metadata (dict):  JSON-serializable metadata.
+
+        Returns:
+            None
+
+        """
+        matrix = scipy.sparse.csr_matrix(matrix)
+        if max(matrix.shape[1], matrix.nnz) < 2 ** 31:
+            idx_dtype = np.int32
+        else:
+            idx_dtype = np.int64
+        arrays = [
+            ("data", matrix.data.astype(np.float64, copy=False)),
+            ("indices", matrix.indices.astype(idx_dtype, copy=False)),
+            ("indptr", matrix.indptr.astype(idx_dtype, copy=False)),
+        ]
+        layout = {}
+        offset = 0
+        for name, array in arrays:
+            layout[name] = [array.dtype.str, array.size, offset]
+            offset = _align(offset + array.nbytes)
+        header = json.dumps(
+            {
+                "version": OBS_MATRIX_VERSION,
+                "shape": list(matrix.shape),
+                "metadata": metadata,
+                "arrays": layout,
+            }
+        ).encode("utf-8")
+        base = _align(len(OBS_MATRIX_MAGIC) + 8 + len(header))
+        tmpname = "{}.tmp.{}".format(fname, os.getpid())
+        with open(tmpname, "wb") as f:
+            f.write(OBS_MATRIX_MAGIC)
+            f.write(np.array([len(header)], dtype="<u8").tobytes())
+            f.write(header)
+            for name, array in arrays:
+                f.seek(base + layout[name][2])
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(tmpname, fname)
+        return
+
+    @property
+    def shape(self):
+        """(tuple): The shape of the matrix."""
+        return self._shape
+
+    @property
+    def metadata(self):
+        """(dict): The metadata stored with the matrix."""
+        return self._metadata
+
+    def _get_arrays(self):
+        # The maps are not kept open between calls so that a large number
+        # of files does not exhaust the file descriptors
+        arrays = {}
+        for name, (dtype, size, offset) in self._layout.items():
+            if size == 0:
+                arrays[name] = np.zeros(0, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    self._fname,
+                    dtype=dtype,
+                    mode="r",
+                    offset=self._base + offset,
+                    shape=(size,),
+                )
+        return arrays
+
+    @property
+    def nnz(self):
+        """(int): The number of stored values."""
+        return self._layout["data"][1]
+
+    def matrix(self):
+        """Return the full matrix backed by the memory map."""
+        arrays = self._get_arrays()
+        return scipy.sparse.csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]),
+            shape=self._shape,
+            copy=False,
+        )
+
+    def rows(self, row_start, row_stop):
+        """Read a contiguous slice of rows into memory.
+
+        Args:
+            row_start (int):  First row of the slice.
+            row_stop (int):  One past the last row of the slice.
+
+        Returns:
+            (scipy.sparse.csr_matrix):  The (row_stop - row_start) x ncol
+                slice.
+
+        """
+        arrays = self._get_arrays()
+        row_stop = min(row_stop, self._shape[0])
+        indptr = np.array(arrays["indptr"][row_start : row_stop + 1], dtype=np.int64)
+        first, last = indptr[0], indptr[-1]
+        indptr -= first
+        return scipy.sparse.csr_matrix(
+            (
+                np.array(arrays["data"][first:last]),
+                np.array(arrays["indices"][first:last]),
+                indptr,
+            ),
+            shape=(row_stop - row_start, self._shape[1]),
+        )
+
+    def take_rows(self, rows):
+        """Read an arbitrary set of rows into memory.
+
+        Args:
+            rows (array):  Sorted row indices.
+
+        Returns:
+            (scipy.sparse.csr_matrix):  The len(rows) x ncol matrix.
+
+        """
+        return self.matrix()[rows]
+
 
 class OpFilterBin(Operator):
     """OpFilterBin buids a template matrix and projects out
@@ -63,6 +351,13 @@ class OpFilterBin(Operator):
         deproject_pattern (str):  Regular expression to test detector
             names with.  Only matching detectors will be deprojected.
             Used to identify differenced TOD.
+        cache_dir (str):  Directory for per-detector observation matrices.
+            Matrices are stored in single memory-mappable files together
+            with the pixelization and a hash of the template configuration
+            and input data.  Reruns with matching metadata load them
+            instead of accumulating again, and the global observation
+            matrix is streamed from these files one slice at a time
+            instead of being assembled in memory.
     """
 
     def __init__(
@@ -295,6 +590,42 @@ class OpFilterBin(Operator):
         )
         return sparse_matrix
 
+    def _obs_matrix_metadata(self, pixels, weights, good, templates):
+        """Metadata that identifies a per-detector observation matrix."""
+        config = hashlib.sha1(
+            repr(
+                (
+                    self._ground_filter_order,
+                    self._split_ground_template,
+                    self._poly_filter_order,
+                    self._deproject_map,
+                    self._deproject_nnz,
+                    self._deproject_pattern.pattern,
+                    self._intervals,
+                )
+            ).encode("utf-8")
+        )
+        inputs = hashlib.sha1(np.ascontiguousarray(good).tobytes())
+        inputs.update(np.ascontiguousarray(pixels[good]).tobytes())
+        inputs.update(np.ascontiguousarray(weights[good]).tobytes())
+        inputs.update(np.ascontiguousarray(templates).tobytes())
+        return {
+            "nside": self._nside,
+            "nnz": self._nnz,
+            "config": config.hexdigest(),
+            "inputs": inputs.hexdigest(),
+        }
+
+    def _load_cached_obs_matrix(self, fname, metadata):
+        """Open a cached observation matrix if it matches the metadata."""
+        try:
+            obs_matrix_file = ObsMatrixFile(fname)
+        except (OSError, RuntimeError, ValueError):
+            return None
+        if obs_matrix_file.metadata != metadata:
+            return None
+        return obs_matrix_file
+
     @function_timer
     def _accumulate_observation_matrix(
         self,
@@ -307,33 +638,23 @@ class OpFilterBin(Operator):
         template_covariance,
         detweight,
     ):
-        if self.obs_matrix is None:
+        if not self._write_obs_matrix:
             return
         fname_cache = None
-        local_obs_matrix = None
+        metadata = None
+        obs_matrix_file = None
         if self._cache_dir is not None:
-            fname_cache = os.path.join(self._cache_dir, obs_name, f"{det_name}")
-            try:
-                t1 = time()
-                if self._cache_dir is not None:
-                    os.makedirs(fname_cache, exist_ok=True)
-                mm_data = np.load(fname_cache + ".data.npy")
-                mm_indices = np.load(fname_cache + ".indices.npy")
-                mm_indptr = np.load(fname_cache + ".indptr.npy")
-                local_obs_matrix = scipy.sparse.csr_matrix(
-                    (mm_data, mm_indices, mm_indptr),
-                    self.obs_matrix.shape,
+            fname_cache = os.path.join(self._cache_dir, obs_name, f"{det_name}.obm")
+            metadata = self._obs_matrix_metadata(pixels, weights, good, templates)
+            obs_matrix_file = self._load_cached_obs_matrix(fname_cache, metadata)
+            if obs_matrix_file is not None and self.grank == 0:
+                print(
+                    f"{self.group:4} : OpFilterBin:     found cached matrix "
+                    f"{fname_cache}",
+                    flush=True,
                 )
-                if self.grank == 0:
-                    print(
-                        f"{self.group:4} : OpFilterBin:     loaded cached matrix from "
-                        f"{fname_cache}* in {time() - t1:.3f}s",
-                        flush=True,
-                    )
-            except:
-                local_obs_matrix = None
 
-        if local_obs_matrix is None:
+        if obs_matrix_file is None:
             nsample = pixels.size
             npix = self._npix
             nnz = self._nnz
@@ -383,6 +704,7 @@ class OpFilterBin(Operator):
                     flush=True,
                 )
             local_obs_matrix = self._expand_matrix(c_obs_matrix, local_to_global)
+            del c_obs_matrix
             if self.grank == 0:
                 print(
                     "{:4} : OpFilterBin:     Expanded in {:.3f}s".format(
@@ -395,12 +717,13 @@ class OpFilterBin(Operator):
                 t1 = time()
                 if self.grank == 0 or self.verbose > 1:
                     print(
-                        f"{self.group:4} : OpFilterBin:     Caching to {fname_cache}*",
+                        f"{self.group:4} : OpFilterBin:     Caching to {fname_cache}",
                         flush=True,
                     )
-                np.save(fname_cache + ".data", local_obs_matrix)
-                np.save(fname_cache + ".indices", local_obs_matrix)
-                np.save(fname_cache + ".indptr", local_obs_matrix)
+                os.makedirs(os.path.dirname(fname_cache), exist_ok=True)
+                ObsMatrixFile.write(fname_cache, local_obs_matrix, metadata)
+                del local_obs_matrix
+                obs_matrix_file = ObsMatrixFile(fname_cache)
                 if self.grank == 0:
                     print(
                         "{:4} : OpFilterBin:     cached in {:.3f}s".format(
@@ -409,6 +732,12 @@ class OpFilterBin(Operator):
                         flush=True,
                     )
 
+        if obs_matrix_file is not None:
+            # The matrix is streamed from disk when the global matrix is
+            # collected
+            self.obs_matrix_files.append((obs_matrix_file, detweight))
+            return
+
         t1 = time()
         if self.grank == 0 or self.verbose > 1:
             print(f"{self.group:4} : OpFilterBin:     Adding to global", flush=True)
@@ -441,19 +770,21 @@ class OpFilterBin(Operator):
 
     @function_timer
     def _initialize_obs_matrix(self):
-        if self._write_obs_matrix:
+        self.obs_matrix = None
+        self.obs_matrix_files = []
+        self.noise_weights = None
+        if self._write_obs_matrix and self._cache_dir is None:
             self.obs_matrix = scipy.sparse.csr_matrix(
                 (self._npixtot, self._npixtot), dtype=np.float64
             )
-            if self.rank == 0 and self._cache_dir is not None:
-                os.makedirs(self._cache_dir, exist_ok=True)
-        else:
-            self.obs_matrix = None
         return
 
     @function_timer
     def _noiseweight_obs_matrix(self, white_noise_cov):
-        if self.obs_matrix is None:
+        """Build the sparse white noise covariance that is applied to each
+        slice of the observation matrix when it is collected.
+        """
+        if not self._write_obs_matrix:
             return
         # Apply the white noise covariance to the observation matrix
         npix = self._npix
@@ -478,127 +809,58 @@ class OpFilterBin(Operator):
                                 pix_local, icov
                             ]
                         icov += 1
-        cc = cc.tocsr()
-        self.obs_matrix = cc.dot(self.obs_matrix)
+        self.noise_weights = cc.tocsr()
         return
 
+    @function_timer
+    def _local_obs_matrix_slice(self, row_start, row_stop):
+        """Return rows of the local, noise-weighted observation matrix.
+
+        Only the rows of the unweighted matrix that couple to the slice
+        through the white noise covariance are read.
+        """
+        noise_weights = self.noise_weights[row_start:row_stop]
+        if self.obs_matrix is not None:
+            return noise_weights.dot(self.obs_matrix)
+        obs_matrix_slice = scipy.sparse.csr_matrix(
+            (noise_weights.shape[0], self._npixtot), dtype=np.float64
+        )
+        rows = np.unique(noise_weights.indices)
+        if rows.size == 0:
+            return obs_matrix_slice
+        noise_weights = noise_weights[:, rows]
+        for obs_matrix_file, detweight in self.obs_matrix_files:
+            obs_matrix_slice += noise_weights.dot(
+                obs_matrix_file.take_rows(rows) * detweight
+            )
+        return obs_matrix_slice
+
     @function_timer
     def _collect_obs_matrix(self):
-        if self.obs_matrix is None:
+        if not self._write_obs_matrix:
             return
-        # Combine the observation matrix across processes
-        # Reduce the observation matrices.  We use the buffer protocol
-        # for better performance, even though it requires more MPI calls
-        # than sending the sparse matrix objects directly
+        # Combine the observation matrix across processes.  Every process
+        # owns and writes a subset of the row slices.  We write the
+        # members of the CSR matrices separately because
+        # scipy.sparse.save_npz is so inefficient.
         nrow_tot = self._npixtot
-        nslice = 128
-        nrow_write = nrow_tot // nslice
-        for islice, row_start in enumerate(range(0, nrow_tot, nrow_write)):
-            row_stop = row_start + nrow_write
-            obs_matrix_slice = self.obs_matrix[row_start:row_stop]
-            nnz = obs_matrix_slice.nnz
-            if self.comm is not None:
-                nnz = self.comm.allreduce(nnz)
-            if nnz == 0:
-                if self.rank == 0:
-                    print(
-                        f"Slice {islice+1:5} / {nslice}: {row_start:12} - {row_stop:12} "
-                        f"is empty.  Skipping.",
-                        flush=True,
-                    )
-                continue
-            if self.rank == 0:
+        nslice = max(OBS_MATRIX_NSLICE, self.ntask)
+        for islice, row_start, row_stop, obs_matrix_slice in reduce_csr_slices(
+            self.comm, self._local_obs_matrix_slice, nrow_tot, nrow_tot, nslice
+        ):
+            t1 = time()
+            fname = os.path.join(self._outdir, self._outprefix + "obs_matrix")
+            fname += f".{row_start:012}.{row_stop:012}.{nrow_tot:012}"
+            if self.verbose > 1:
                 print(
-                    f"Collecting slice {islice+1:5} / {nslice} : {row_start:12} - "
-                    f"{row_stop:12}",
+                    f"OpFilterBin: Writing observation matrix slice "
+                    f"{islice + 1:5} / {nslice} to {fname}*",
                     flush=True,
                 )
-
-            factor = 1
-            while factor < self.ntask:
-                if self.rank == 0 or self.verbose > 1:
-                    print(
-                        "OpFilterBin: Collecting {} / {}".format(
-                            2 * factor, self.ntask
-                        ),
-                        flush=True,
-                    )
-                    t1 = time()
-                # from ..utils import memreport  # DEBUG
-                # memreport(f"factor = {factor}", self.comm)  # DEBUG
-                if self.rank % (factor * 2) == 0:
-                    # this task receives
-                    receive_from = self.rank + factor
-                    if receive_from < self.ntask:
-                        size_recv = self.comm.recv(source=receive_from, tag=factor)
-                        data_recv = np.zeros(size_recv, dtype=np.float64)
-                        self.comm.Recv(
-                            data_recv, source=receive_from, tag=factor + self.ntask
-                        )
-                        indices_recv = np.zeros(size_recv, dtype=np.int32)
-                        self.comm.Recv(
-                            indices_recv,
-                            source=receive_from,
-                            tag=factor + 2 * self.ntask,
-                        )
-                        indptr_recv = np.zeros(
-                            obs_matrix_slice.indptr.size, dtype=np.int32
-                        )
-                        self.comm.Recv(
-                            indptr_recv,
-                            source=receive_from,
-                            tag=factor + 3 * self.ntask,
-                        )
-                        obs_matrix_slice += scipy.sparse.csr_matrix(
-                            (data_recv, indices_recv, indptr_recv),
-                            obs_matrix_slice.shape,
-                        )
-                        del data_recv, indices_recv, indptr_recv
-                elif self.rank % (factor * 2) == factor:
-                    # this task sends
-                    send_to = self.rank - factor
-                    self.comm.send(obs_matrix_slice.data.size, dest=send_to, tag=factor)
-                    self.comm.Send(
-                        obs_matrix_slice.data, dest=send_to, tag=factor + self.ntask
-                    )
-                    self.comm.Send(
-                        obs_matrix_slice.indices,
-                        dest=send_to,
-                        tag=factor + 2 * self.ntask,
-                    )
-                    self.comm.Send(
-                        obs_matrix_slice.indptr,
-                        dest=send_to,
-                        tag=factor + 3 * self.ntask,
-                    )
-
-                if self.comm is not None:
-                    self.comm.Barrier()
-                if self.rank == 0:
-                    print(
-                        "OpFilterBin: Collected in {:.1f} s".format(time() - t1),
-                        flush=True,
-                    )
-                factor *= 2
-
-            # Write out the observation matrix
-            if self.rank == 0:
-                t1 = time()
-                fname = os.path.join(self._outdir, self._outprefix + "obs_matrix")
-                fname += f".{row_start:012}.{row_stop:012}.{nrow_tot:012}"
-                if self.verbose:
-                    print(
-                        f"OpFilterBin: Writing observation matrix to {fname}.npz",
-                        flush=True,
-                    )
-                if True:
-                    # Write out the members of the CSR matrix separately because
-                    # scipy.sparse.save_npz is so inefficient
-                    np.save(fname + ".data", obs_matrix_slice.data)
-                    np.save(fname + ".indices", obs_matrix_slice.indices)
-                    np.save(fname + ".indptr", obs_matrix_slice.indptr)
-                else:
-                    scipy.sparse.save_npz(fname, obs_matrix_slice)
+            np.save(fname + ".data", obs_matrix_slice.data)
+            np.save(fname + ".indices", obs_matrix_slice.indices)
+            np.save(fname + ".indptr", obs_matrix_slice.indptr)
+            if self.verbose > 1:
                 print(
                     "OpFilterBin: Wrote observation matrix to {} in {:.1f} s"
                     "".format(fname + "*", time() - t1),
@@ -607,6 +869,8 @@ class OpFilterBin(Operator):
         # After writing we are done
         del self.obs_matrix
         self.obs_matrix = None
+        self.obs_matrix_files = []
+        self.noise_weights = None
         return
 
     @function_timer
@@ -886,7 +1150,7 @@ class OpFilterBin(Operator):
                 "OpFilterBin: Binned signal in {:.1f} s".format(time() - t1), flush=True
             )
 
-        if self.obs_matrix is not None:
+        if self._write_obs_matrix:
             if self.rank == 0 or self.verbose > 1:
                 print("OpFilterBin: Noise-weighting observation matrix", flush=True)
             t1 = time()
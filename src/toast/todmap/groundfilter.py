@@ -2,13 +2,15 @@
 # All rights reserved.  Use of this source code is governed by
 # a BSD-style license that can be found in the LICENSE file.
 
+import hashlib
+
 from time import time
 
 from ..mpi import MPI
 
 import numpy as np
 
-from .._libtoast import bin_templates, add_templates, legendre
+from .._libtoast import add_templates, legendre
 
 from ..op import Operator
 
@@ -17,6 +19,10 @@ from ..utils import Logger
 from ..timing import function_timer
 
 
+# Number of detectors to fit with one matrix product
+DET_BATCH = 32
+
+
 class OpGroundFilter(Operator):
     """Operator which applies ground template filtering to constant
     elevation scans.
@@ -138,24 +144,20 @@ class OpGroundFilter(Operator):
         return templates, legendre_trend, legendre_filter
 
     @function_timer
-    def bin_templates(self, ref, templates, good, invcov, proj):
-
-        # Bin the local data
+    def get_template_covariance(self, tod, templates, good):
+        """Bin and factorize the template covariance for one sample mask.
 
-        for i in range(ntemplate):
-            temp = templates[i] * good
-            proj[i] = np.dot(temp, ref)
-            for j in range(i, ntemplate):
-                invcov[i, j] = np.dot(temp, templates[j])
-                # Symmetrize invcov
-                if i != j:
-                    invcov[j, i] = invcov[i, j]
-            del temp
+        Args:
+            tod (TOD):  The TOD being filtered.
+            templates (array):  (ntemplate x nsamp) local templates.
+            good (array):  Local good-sample mask.
 
-        return
+        Returns:
+            (tuple):  The template covariance, its inverse (None if poorly
+                conditioned) and reciprocal condition number, or None if
+                there are no good samples.
 
-    @function_timer
-    def fit_templates(self, tod, det, templates, ref, good):
+        """
         log = Logger.get()
         # communicator for processes with the same detectors
         comm = tod.grid_comm_row
@@ -165,39 +167,110 @@ class OpGroundFilter(Operator):
         if ngood == 0:
             return None
 
-        ntemplate = len(templates)
-        invcov = np.zeros([ntemplate, ntemplate])
-        proj = np.zeros(ntemplate)
-
-        bin_templates(ref, templates, good.astype(np.uint8), invcov, proj)
-
+        good_templates = templates[:, good]
+        invcov = np.dot(good_templates, good_templates.T)
+        del good_templates
         if comm is not None:
             # Reduce the binned data.  The detector signals is
             # distributed across the group communicator.
             comm.Allreduce(MPI.IN_PLACE, invcov, op=MPI.SUM)
-            comm.Allreduce(MPI.IN_PLACE, proj, op=MPI.SUM)
 
-        # Assemble the joint template
         rcond = 1 / np.linalg.cond(invcov)
-        self.rcondsum += rcond
         if rcond > 1e-6:
-            self.ngood += 1
             cov = np.linalg.inv(invcov)
-            coeff = np.dot(cov, proj)
         else:
-            self.nsingular += 1
             log.debug(
                 f"Ground template matrix is poorly conditioned, "
                 f"rcond = {rcond}, doing least squares fitting."
             )
+            cov = None
+
+        return invcov, cov, rcond
+
+    @function_timer
+    def fit_templates(self, tod, templates, refs, good, covariance=None):
+        """Fit the templates to detectors that share a sample mask.
+
+        Args:
+            tod (TOD):  The TOD being filtered.
+            templates (array):  (ntemplate x nsamp) local templates.
+            refs (list):  Local signals of the detectors.
+            good (array):  Local good-sample mask shared by the detectors.
+            covariance (tuple):  Output of `get_template_covariance` for
+                this mask.  Evaluated if not provided.
+
+        Returns:
+            (array):  (ntemplate x ndet) template coefficients or None if
+                there are no good samples.
+
+        """
+        comm = tod.grid_comm_row
+        if covariance is None:
+            covariance = self.get_template_covariance(tod, templates, good)
+        if covariance is None:
+            return None
+        invcov, cov, rcond = covariance
+
+        # Project all detectors at once
+        signals = np.vstack(refs)
+        signals[:, np.logical_not(good)] = 0
+        proj = np.dot(templates, signals.T)
+        del signals
+        if comm is not None:
+            comm.Allreduce(MPI.IN_PLACE, proj, op=MPI.SUM)
+
+        # Assemble the joint template
+        ndet = len(refs)
+        self.rcondsum += rcond * ndet
+        if cov is not None:
+            self.ngood += ndet
+            coeff = np.dot(cov, proj)
+        else:
+            self.nsingular += ndet
             # np.linalg.lstsq will find a least squares minimum
             # even if the covariance matrix is not invertible
             coeff = np.linalg.lstsq(invcov, proj, rcond=1e-30)[0]
-            if np.any(np.isnan(coeff)) or np.std(coeff) < 1e-30:
+            if np.any(np.isnan(coeff)) or np.any(np.std(coeff, axis=0) < 1e-30):
                 raise RuntimeError("lstsq FAILED")
 
         return coeff
 
+    def _group_detectors(self, tod, common_ref):
+        """Group the local detectors by their good-sample mask.
+
+        The masks are hashed locally and the hashes are gathered across
+        the processes that share the detectors, so that all of them agree
+        on the grouping.
+
+        Returns:
+            (list):  Tuples of (good, detectors) for every distinct mask.
+
+        """
+        comm = tod.grid_comm_row
+        masks = {}
+        keys = []
+        for det in tod.local_dets:
+            flag_ref = tod.local_flags(det, self._flag_name)
+            good = np.logical_and(
+                common_ref & self._common_flag_mask == 0,
+                flag_ref & self._flag_mask == 0,
+            )
+            del flag_ref
+            key = hashlib.sha1(np.packbits(good).tobytes()).hexdigest()
+            if key not in masks:
+                masks[key] = good
+            keys.append(key)
+        if comm is None:
+            global_keys = keys
+        else:
+            global_keys = list(zip(*comm.allgather(keys)))
+        groups = {}
+        for det, key, global_key in zip(tod.local_dets, keys, global_keys):
+            if global_key not in groups:
+                groups[global_key] = (masks[key], [])
+            groups[global_key][1].append(det)
+        return list(groups.values())
+
     @function_timer
     def subtract_templates(self, ref, good, coeff, legendre_trend, legendre_filter):
         # Trend
@@ -267,48 +340,68 @@ class OpGroundFilter(Operator):
                     flush=True,
                 )
 
-            for idet, det in enumerate(tod.local_dets):
-                if self.grank == 0 and self.verbose > 1:
-                    print(
-                        "{:4} : OpGroundFilter:   Processing detector # {} / {}".format(
-                            self.group, idet + 1, len(tod.local_dets)
-                        ),
-                        flush=True,
-                    )
-                ref = tod.local_signal(det, self._name)
-                flag_ref = tod.local_flags(det, self._flag_name)
-                good = np.logical_and(
-                    common_ref & self._common_flag_mask == 0,
-                    flag_ref & self._flag_mask == 0,
-                )
-                del flag_ref
+            # Detectors with identical sample masks share the template
+            # covariance and are fitted together.
 
+            groups = self._group_detectors(tod, common_ref)
+            idet = 0
+            for good, dets in groups:
                 t1 = time()
-                coeff = self.fit_templates(tod, det, templates, ref, good)
+                covariance = self.get_template_covariance(tod, templates, good)
                 if self.grank == 0 and self.verbose > 1:
                     print(
-                        "{:4} : OpGroundFilter: Fit templates in {:.1f}s".format(
-                            self.group, time() - t1
+                        "{:4} : OpGroundFilter: Built template covariance for {} "
+                        "detectors in {:.1f}s".format(
+                            self.group, len(dets), time() - t1
                         ),
                         flush=True,
                     )
-
-                if coeff is None:
+                if covariance is None:
+                    # No good samples
+                    idet += len(dets)
                     continue
-
-                t1 = time()
-                self.subtract_templates(
-                    ref, good, coeff, legendre_trend, legendre_filter
-                )
-                if self.grank == 0 and self.verbose > 1:
-                    print(
-                        "{:4} : OpGroundFilter: Subtract templates in {:.1f}s".format(
-                            self.group, time() - t1
-                        ),
-                        flush=True,
+                for ifirst in range(0, len(dets), DET_BATCH):
+                    batch = dets[ifirst : ifirst + DET_BATCH]
+                    if self.grank == 0 and self.verbose > 1:
+                        print(
+                            "{:4} : OpGroundFilter:   Processing detectors # {} - {}"
+                            " / {}".format(
+                                self.group,
+                                idet + 1,
+                                idet + len(batch),
+                                len(tod.local_dets),
+                            ),
+                            flush=True,
+                        )
+                    idet += len(batch)
+                    refs = [tod.local_signal(det, self._name) for det in batch]
+
+                    t1 = time()
+                    coeff = self.fit_templates(
+                        tod, templates, refs, good, covariance=covariance
                     )
-
-                del ref
+                    if self.grank == 0 and self.verbose > 1:
+                        print(
+                            "{:4} : OpGroundFilter: Fit templates in {:.1f}s".format(
+                                self.group, time() - t1
+                            ),
+                            flush=True,
+                        )
+
+                    t1 = time()
+                    for ref, det_coeff in zip(refs, np.ascontiguousarray(coeff.T)):
+                        self.subtract_templates(
+                            ref, good, det_coeff, legendre_trend, legendre_filter
+                        )
+                    if self.grank == 0 and self.verbose > 1:
+                        print(
+                            "{:4} : OpGroundFilter: Subtract templates in {:.1f}s".format(
+                                self.group, time() - t1
+                            ),
+                            flush=True,
+                        )
+
+                    del refs
 
             del common_ref
 
@@ -10,6 +10,7 @@ import healpy as hp
 import numpy as np
 
 from ..cache import Cache
+from ..map.pixels import clear_local_pixels
 from ..op import Operator
 from ..timing import function_timer, Timer
 from ..utils import Logger, memreport
@@ -946,6 +947,7 @@ class OpMadam(Operator):
                     pixels[np.logical_not(good)] = -1
                     cachename = "{}_{}".format(self._pixels, det)
                     tod.cache.put(cachename, pixels, replace=True)
+                    clear_local_pixels(tod.cache, cachename)
                 global_offset = offset
         self._madam_pixels = None
         self._cache.destroy("pixels")
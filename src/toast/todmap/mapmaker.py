@@ -14,11 +14,23 @@ from toast.timing import function_timer, Timer
 from toast.utils import Logger, Environment
 from .sim_det_map import OpSimScan
 from .todmap_math import OpAccumDiag, OpScanScale, OpScanMask
+from .pointing import local_pointing_blocks
 from ..tod import OpCacheClear, OpCacheCopy, OpCacheInit, OpFlagsApply, OpFlagGaps
-from ..map import covariance_apply, covariance_invert, DistPixels, covariance_rcond
+from ..map import (
+    clear_local_pixels,
+    covariance_apply,
+    covariance_invert,
+    DistPixels,
+    covariance_rcond,
+)
 from .. import qarray as qa
 
-from .._libtoast import add_offsets_to_signal, project_signal_offsets
+from .._libtoast import (
+    add_offsets_to_signal,
+    project_signal_offsets,
+    cov_accum_zmap,
+    scan_map_float64,
+)
 
 
 XAXIS, YAXIS, ZAXIS = np.eye(3)
@@ -742,25 +754,18 @@ class OffsetTemplate(TODTemplate):
     @function_timer
     def _get_offset_psd(self, noise, freq, det):
         psdfreq = noise.freq(det)
-        psd = noise.psd(det)
         rate = noise.rate(det)
         # Remove the white noise component from the PSD
-        psd = psd.copy() * np.sqrt(rate)
-        psd -= np.amin(psd[psdfreq > 1.0])
-        psd[psd < 1e-30] = 1e-30
+        white = np.amin(noise.psd(det)[psdfreq > 1.0]) * np.sqrt(rate)
 
         # The calculation of `offset_psd` is from Keihänen, E. et al:
         # "Making CMB temperature and polarization maps with Madam",
         # A&A 510:A57, 2010
-        logfreq = np.log(psdfreq)
-        logpsd = np.log(psd)
 
         def interpolate_psd(x):
-            result = np.zeros(x.size)
-            good = np.abs(x) > 1e-10
-            logx = np.log(np.abs(x[good]))
-            logresult = np.interp(logx, logfreq, logpsd)
-            result[good] = np.exp(logresult)
+            result = noise.interpolate_psd(det, x) * np.sqrt(rate) - white
+            result[result < 1e-30] = 1e-30
+            result[np.abs(x) <= 1e-10] = 0
             return result
 
         def g(x):
@@ -804,18 +809,30 @@ class OffsetTemplate(TODTemplate):
             noisefilter = noisefilter[icenter - icut : icenter + icut + 1]
             return noisefilter
 
+        # Intervals of equal length share their filters
+        noisefilter_cache = {}
+        prior_cache = {}
+
         noisefilters = []
         preconditioners = []
         for offset_slice, sigmasqs in offset_slices:
             nstep = offset_slice.stop - offset_slice.start
             filterlen = nstep * 2 + 1
             filterfreq = np.fft.rfftfreq(filterlen, self.step_length)
-            noisefilter = truncate(np.fft.irfft(interpolate(filterfreq, logfilter)))
+            if nstep not in noisefilter_cache:
+                noisefilter_cache[nstep] = truncate(
+                    np.fft.irfft(interpolate(filterfreq, logfilter))
+                )
+            noisefilter = noisefilter_cache[nstep]
             noisefilters.append(noisefilter)
             # Build the band-diagonal preconditioner
             if self.precond_width <= 1:
                 # Compute C_a prior
-                preconditioner = truncate(np.fft.irfft(interpolate(filterfreq, logpsd)))
+                if nstep not in prior_cache:
+                    prior_cache[nstep] = truncate(
+                        np.fft.irfft(interpolate(filterfreq, logpsd))
+                    )
+                preconditioner = prior_cache[nstep]
             else:
                 # Compute Cholesky decomposition prior
                 wband = min(self.precond_width, noisefilter.size // 2)
@@ -1148,13 +1165,23 @@ class TemplateAmplitudes(TOASTVector):
         return result
 
     @function_timer
-    def dot(self, other):
-        """Compute the dot product between the two amplitude vectors"""
+    def local_dot(self, other):
+        """Compute the process-local contribution to the dot product.
+
+        Shared amplitudes are only counted on the root process of their
+        communicator so that a sum over processes yields the full product.
+        """
         total = 0
         for name, values in self.amplitudes.items():
             comm = self.comms[name]
             if comm is None or comm.rank == 0:
                 total += np.dot(values, other.amplitudes[name])
+        return total
+
+    @function_timer
+    def dot(self, other):
+        """Compute the dot product between the two amplitude vectors"""
+        total = self.local_dot(other)
         if self.comm is not None:
             total = self.comm.allreduce(total, op=MPI.SUM)
         return total
@@ -1205,6 +1232,13 @@ class TemplateAmplitudes(TOASTVector):
             values *= other
         return self
 
+    @function_timer
+    def add_scaled(self, other, scale):
+        """Add the provided amplitudes multiplied by `scale` to this one"""
+        for name, values in self.amplitudes.items():
+            values += scale * other.amplitudes[name]
+        return self
+
     @function_timer
     def __itruediv__(self, other):
         """Divide the amplitudes"""
@@ -1213,6 +1247,68 @@ class TemplateAmplitudes(TOASTVector):
         return self
 
 
+class BlockTemplateAmplitudes(TOASTVector):
+    """BlockTemplateAmplitudes stacks one TemplateAmplitudes per right-hand side"""
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.comm = self.columns[0].comm
+        return
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    @function_timer
+    def dot(self, other):
+        """Compute the (k x k) matrix of dot products between the columns.
+
+        All products are reduced in a single collective call.
+        """
+        products = np.array(
+            [[left.local_dot(right) for right in other] for left in self],
+            dtype=np.float64,
+        )
+        if self.comm is not None:
+            self.comm.Allreduce(MPI.IN_PLACE, products, op=MPI.SUM)
+        return products
+
+    @function_timer
+    def combine(self, coeffs):
+        """Return the block multiplied by a (k x k) coefficient matrix"""
+        columns = []
+        for j in range(coeffs.shape[1]):
+            column = self.columns[0].copy()
+            column *= coeffs[0, j]
+            for i in range(1, len(self.columns)):
+                column.add_scaled(self.columns[i], coeffs[i, j])
+            columns.append(column)
+        return BlockTemplateAmplitudes(columns)
+
+    @function_timer
+    def copy(self):
+        return BlockTemplateAmplitudes([column.copy() for column in self])
+
+    @function_timer
+    def __iadd__(self, other):
+        """Add the provided block to this one"""
+        for column, other_column in zip(self.columns, other):
+            column += other_column
+        return self
+
+    @function_timer
+    def __isub__(self, other):
+        """Subtract the provided block from this one"""
+        for column, other_column in zip(self.columns, other):
+            column -= other_column
+        return self
+
+
 class TemplateCovariance(TOASTMatrix):
     def __init__(self):
         pass
@@ -1226,6 +1322,18 @@ class ProjectionMatrix(TOASTMatrix):
          `P` is the pointing matrix
          `N` is the noise matrix and
          `B` is the binning operator
+
+    The pointing of every detector is translated into local submap indices
+    on the first application.  If `cache_pixels` is set, the translation of
+    expanded pointing is memoized in the TOD cache and the flagged samples
+    are kept for the following PCG iterations.  The pointing must not
+    change during the lifetime of the matrix.  Call `clear_pixel_cache` if
+    it does and when the solve is done.
+
+    Args:
+        cache_pixels (bool):  Keep the local pixel translation in memory
+            between applications.  This costs two int32 numbers per sample
+            unless the pixel distribution is very large.
     """
 
     def __init__(
@@ -1237,6 +1345,7 @@ class ProjectionMatrix(TOASTMatrix):
         white_noise_cov_matrix,
         common_flag_mask=1,
         flag_mask=1,
+        cache_pixels=True,
     ):
         self.data = data
         self.comm = comm
@@ -1245,16 +1354,159 @@ class ProjectionMatrix(TOASTMatrix):
         self.white_noise_cov_matrix = white_noise_cov_matrix
         self.common_flag_mask = common_flag_mask
         self.flag_mask = flag_mask
+        # Additional maps used when projecting several signals at once
+        self.dist_maps = [self.dist_map]
+        self.cache_pixels = cache_pixels
+        self._flag_cache = {}
+
+    def clear_pixel_cache(self):
+        """Discard the cached flags and the memoized local pixels."""
+        self._flag_cache.clear()
+        key = self.dist_map.local_key
+        for obs in self.data.obs:
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                clear_local_pixels(tod.cache, "pixels_{}".format(det), key)
+        return
+
+    def local_pixels(self, iobs, det):
+        """Iterate over the pointing of one detector in local map indices.
+
+        Samples that are flagged for binning are marked with a negative
+        local pixel in a separate array so that the same submap indices
+        serve both binning and scanning.
+
+        Args:
+            iobs (int):  Index of the observation.
+            det (str):  The detector name.
+
+        Yields:
+            (tuple):  The sample slice, local submaps, binned pixels,
+                scanned pixels and weights of each pointing block.
+
+        """
+        key = (iobs, det)
+        obs = self.data.obs[iobs]
+        tod = obs["tod"]
+        if key in self._flag_cache:
+            flagged = self._flag_cache[key]
+        else:
+            flags = (tod.local_common_flags() & self.common_flag_mask) != 0
+            flags |= (tod.local_flags(det) & self.flag_mask) != 0
+            flagged = np.flatnonzero(flags)
+            del flags
+            if self.cache_pixels:
+                self._flag_cache[key] = flagged
+        for bslice, sm, scan_pix, weights in local_pointing_blocks(
+            obs, det, self.dist_map, memoize=self.cache_pixels
+        ):
+            first, last = np.searchsorted(flagged, [bslice.start, bslice.stop])
+            if last > first:
+                bin_pix = scan_pix.copy()
+                bin_pix[flagged[first:last] - bslice.start] = -1
+            else:
+                bin_pix = scan_pix
+            yield bslice, sm, bin_pix, scan_pix, weights
 
     @function_timer
     def apply(self, signal):
         """Return Z.y"""
-        self.bin_map(signal.name)
-        new_signal = signal.copy()
-        scanned_signal = Signal(self.data, temporary=True, init_val=0)
-        self.scan_map(scanned_signal.name)
-        new_signal -= scanned_signal
-        return new_signal
+        return self.apply_many([signal])[0]
+
+    @function_timer
+    def apply_many(self, signals):
+        """Return [Z.y for y in signals]
+
+        The signals are binned, multiplied with the white noise covariance
+        and scanned back directly into copies of the input signals.  No
+        intermediate timestreams are allocated.
+        """
+        while len(self.dist_maps) < len(signals):
+            self.dist_maps.append(self.dist_map.duplicate(copy=False))
+        dist_maps = self.dist_maps[: len(signals)]
+        self.bin_maps([signal.name for signal in signals], dist_maps)
+        new_signals = [signal.copy() for signal in signals]
+        self.scan_maps([signal.name for signal in new_signals], dist_maps, -1)
+        return new_signals
+
+    @function_timer
+    def bin_maps(self, names, dist_maps):
+        """Bin and apply the white noise covariance to several signals"""
+        for dist_map in dist_maps:
+            if dist_map.data is not None:
+                dist_map.data.fill(0.0)
+        nsub = self.dist_map.nsubmap
+        npix_submap = self.dist_map.npix_submap
+        nnz = self.dist_map.nnz
+        zmaps = []
+        for dist_map in dist_maps:
+            zmap = dist_map.flatdata
+            if zmap is None:
+                zmap = np.empty(shape=0, dtype=np.float64)
+            zmaps.append(zmap)
+        # FIXME: bin_maps should support separate detweights for each observation
+        detweights = self.detweights[0]
+        for iobs, obs in enumerate(self.data.obs):
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                detweight = detweights[det]
+                if detweight == 0:
+                    continue
+                signals = [tod.local_signal(det, name) for name in names]
+                blocks = self.local_pixels(iobs, det)
+                for bslice, sm, bin_pix, _, weights in blocks:
+                    weights = weights.reshape(-1).astype(np.float64, copy=False)
+                    for signal, zmap in zip(signals, zmaps):
+                        cov_accum_zmap(
+                            nsub,
+                            npix_submap,
+                            nnz,
+                            sm,
+                            bin_pix,
+                            weights,
+                            detweight,
+                            signal[bslice],
+                            zmap,
+                        )
+                del signals
+        for dist_map in dist_maps:
+            dist_map.allreduce()
+            covariance_apply(self.white_noise_cov_matrix, dist_map)
+        return
+
+    @function_timer
+    def scan_maps(self, names, dist_maps, scale=1):
+        """Add `scale` times the scanned maps to the named signals"""
+        mapdata = []
+        for dist_map in dist_maps:
+            if dist_map.flatdata is None or scale == 1:
+                mapdata.append(dist_map.flatdata)
+            else:
+                # Scaling the map is much cheaper than scaling the timestream
+                mapdata.append(scale * dist_map.flatdata)
+        for iobs, obs in enumerate(self.data.obs):
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                refs = [tod.local_signal(det, name) for name in names]
+                blocks = self.local_pixels(iobs, det)
+                for bslice, sm, _, scan_pix, weights in blocks:
+                    nnz = weights.shape[1]
+                    weights = weights.reshape(-1).astype(np.float64, copy=False)
+                    for ref, data in zip(refs, mapdata):
+                        if data is None:
+                            continue
+                        # scan_map_float64 accumulates into the timestream
+                        scan_map_float64(
+                            self.dist_map.npix_submap,
+                            nnz,
+                            sm,
+                            scan_pix,
+                            data,
+                            weights,
+                            ref[bslice],
+                        )
+                del refs
+        return
 
     @function_timer
     def bin_map(self, name):
@@ -1431,7 +1683,21 @@ class Signal(TOASTVector):
 
 
 class PCGSolver:
-    """Solves `x` in A.x = b"""
+    """Solves `x` in A.x = b
+
+    Two variants of the preconditioned conjugate gradient iteration are
+    available:
+
+    "standard" : the textbook PCG iteration.  The product A.p is reused to
+        update the residual so each iteration applies the LHS once.
+    "pipelined" : the Ghysels-Vanroose pipelined form of the
+        Chronopoulos-Gear iteration.  Both inner products of an iteration
+        are fused into a single non-blocking reduction that is overlapped
+        with the preconditioner and the LHS application.  Rounding errors
+        accumulate slightly differently from the standard variant.
+    """
+
+    variants = ("standard", "pipelined")
 
     def __init__(
         self,
@@ -1443,7 +1709,14 @@ class PCGSolver:
         niter_min=3,
         niter_max=100,
         convergence_limit=1e-12,
+        variant="standard",
     ):
+        if variant not in self.variants:
+            raise ValueError(
+                "Unknown PCG variant '{}', expected one of {}".format(
+                    variant, self.variants
+                )
+            )
         self.comm = comm
         if comm is None:
             self.rank = 0
@@ -1456,6 +1729,7 @@ class PCGSolver:
         self.niter_min = niter_min
         self.niter_max = niter_max
         self.convergence_limit = convergence_limit
+        self.variant = variant
 
         self.rhs = self.templates.apply_transpose(
             self.noise.apply(self.projection.apply(self.signal))
@@ -1472,8 +1746,67 @@ class PCGSolver:
         self.templates.add_prior(amplitudes, new_amplitudes)
         return new_amplitudes
 
+    def _start_reduction(self, pairs):
+        """Start a single non-blocking reduction of several dot products.
+
+        Args:
+            pairs (list):  List of (TemplateAmplitudes, TemplateAmplitudes)
+                tuples to compute the dot products of.
+
+        Returns:
+            (tuple):  The reduction buffer and the MPI request to wait on
+                (None without MPI).
+
+        """
+        buf = np.array(
+            [left.local_dot(right) for left, right in pairs], dtype=np.float64
+        )
+        request = None
+        if self.comm is not None:
+            request = self.comm.Iallreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+        return buf, request
+
+    @function_timer
+    def _finish_reduction(self, buf, request):
+        """Wait for a reduction started with _start_reduction()"""
+        if request is not None:
+            request.Wait()
+        return buf
+
+    def _check_convergence(self, iiter, sqsum, timer, timer0):
+        """Report the iteration and return True if the solver should stop"""
+        if self.rank == 0:
+            timer.report_clear(
+                "Iter = {:4} relative residual: {:12.4e}".format(
+                    iiter, sqsum / self._init_sqsum
+                )
+            )
+        if sqsum < self._init_sqsum * self.convergence_limit or sqsum < 1e-30:
+            if self.rank == 0:
+                timer0.report_clear("PCG converged after {} iterations".format(iiter))
+            return True
+        self._best_sqsum = min(sqsum, self._best_sqsum)
+        if iiter % 10 == 0 and iiter >= self.niter_min:
+            if self._last_best < self._best_sqsum * 2:
+                if self.rank == 0:
+                    timer0.report_clear("PCG stalled after {} iterations".format(iiter))
+                return True
+            self._last_best = self._best_sqsum
+        return False
+
     @function_timer
     def solve(self):
+        """PCG solution of A.x = b using the selected variant
+
+        Returns:
+            x : the least squares solution
+        """
+        if self.variant == "pipelined":
+            return self._solve_pipelined()
+        return self._solve_standard()
+
+    @function_timer
+    def _solve_standard(self):
         """Standard issue PCG solution of A.x = b
 
         Returns:
@@ -1495,46 +1828,27 @@ class PCGSolver:
         precond_residual = self.templates.apply_precond(residual)
         proposal = precond_residual.copy()
         sqsum = precond_residual.dot(residual)
-        init_sqsum, best_sqsum, last_best = sqsum, sqsum, sqsum
+        self._init_sqsum, self._best_sqsum, self._last_best = sqsum, sqsum, sqsum
         if self.rank == 0:
-            log.info("Initial residual: {}".format(init_sqsum))
+            log.info("Initial residual: {}".format(sqsum))
         # Iterate to convergence
         for iiter in range(self.niter_max):
             if not np.isfinite(sqsum):
                 raise RuntimeError("Residual is not finite")
+            # A.p is used both for the step length and the residual update
+            lhs_proposal = self.apply_lhs(proposal)
             alpha = sqsum
-            alpha /= proposal.dot(self.apply_lhs(proposal))
-            alpha_proposal = proposal.copy()
-            alpha_proposal *= alpha
-            guess += alpha_proposal
-            residual -= self.apply_lhs(alpha_proposal)
-            del alpha_proposal
+            alpha /= proposal.dot(lhs_proposal)
+            guess.add_scaled(proposal, alpha)
+            residual.add_scaled(lhs_proposal, -alpha)
+            del lhs_proposal
             # Prepare for next iteration
             precond_residual = self.templates.apply_precond(residual)
             beta = 1 / sqsum
             # Check for convergence
             sqsum = precond_residual.dot(residual)
-            if self.rank == 0:
-                timer.report_clear(
-                    "Iter = {:4} relative residual: {:12.4e}".format(
-                        iiter, sqsum / init_sqsum
-                    )
-                )
-            if sqsum < init_sqsum * self.convergence_limit or sqsum < 1e-30:
-                if self.rank == 0:
-                    timer0.report_clear(
-                        "PCG converged after {} iterations".format(iiter)
-                    )
+            if self._check_convergence(iiter, sqsum, timer, timer0):
                 break
-            best_sqsum = min(sqsum, best_sqsum)
-            if iiter % 10 == 0 and iiter >= self.niter_min:
-                if last_best < best_sqsum * 2:
-                    if self.rank == 0:
-                        timer0.report_clear(
-                            "PCG stalled after {} iterations".format(iiter)
-                        )
-                    break
-                last_best = best_sqsum
             # Select the next direction
             beta *= sqsum
             proposal *= beta
@@ -1542,6 +1856,195 @@ class PCGSolver:
         # log.info("{} : Solution: {}".format(self.rank, guess))  # DEBUG
         return guess
 
+    @function_timer
+    def _solve_pipelined(self):
+        """Pipelined PCG solution of A.x = b
+
+        Each iteration applies the LHS and the preconditioner once and
+        performs a single, non-blocking global reduction.
+
+        Returns:
+            x : the least squares solution
+        """
+        log = Logger.get()
+        timer0 = Timer()
+        timer0.start()
+        timer = Timer()
+        timer.start()
+        # Initial guess is zero amplitudes so the initial residual is the RHS
+        guess = self.templates.zero_amplitudes()
+        residual = self.rhs.copy()
+        # u = M^{-1}.r and w = A.u are updated by recurrences below
+        precond_residual = self.templates.apply_precond(residual)
+        lhs_residual = self.apply_lhs(precond_residual)
+        proposal = None
+        alpha = None
+        last_sqsum = None
+        for iiter in range(self.niter_max + 1):
+            buf, request = self._start_reduction(
+                [(precond_residual, residual), (precond_residual, lhs_residual)]
+            )
+            # Overlap the reduction with m = M^{-1}.w and n = A.m
+            precond_lhs = self.templates.apply_precond(lhs_residual)
+            lhs_precond_lhs = self.apply_lhs(precond_lhs)
+            sqsum, delta = self._finish_reduction(buf, request)
+            if not np.isfinite(sqsum):
+                raise RuntimeError("Residual is not finite")
+            if iiter == 0:
+                self._init_sqsum, self._best_sqsum, self._last_best = (
+                    sqsum,
+                    sqsum,
+                    sqsum,
+                )
+                if self.rank == 0:
+                    log.info("Initial residual: {}".format(sqsum))
+            elif (
+                self._check_convergence(iiter - 1, sqsum, timer, timer0)
+                or iiter == self.niter_max
+            ):
+                break
+            # Select the next direction and the auxiliary recurrences
+            if proposal is None:
+                alpha = sqsum / delta
+                proposal = precond_residual.copy()
+                lhs_proposal = lhs_residual.copy()
+                precond_lhs_proposal = precond_lhs
+                lhs_precond_lhs_proposal = lhs_precond_lhs
+            else:
+                beta = sqsum / last_sqsum
+                alpha = sqsum / (delta - beta * sqsum / alpha)
+                proposal *= beta
+                proposal += precond_residual
+                lhs_proposal *= beta
+                lhs_proposal += lhs_residual
+                precond_lhs_proposal *= beta
+                precond_lhs_proposal += precond_lhs
+                lhs_precond_lhs_proposal *= beta
+                lhs_precond_lhs_proposal += lhs_precond_lhs
+                del precond_lhs, lhs_precond_lhs
+            last_sqsum = sqsum
+            guess.add_scaled(proposal, alpha)
+            residual.add_scaled(lhs_proposal, -alpha)
+            precond_residual.add_scaled(precond_lhs_proposal, -alpha)
+            lhs_residual.add_scaled(lhs_precond_lhs_proposal, -alpha)
+        return guess
+
+
+class BlockPCGSolver(PCGSolver):
+    """Solves `X` in A.X = B for a block of right-hand sides
+
+    Each column of B corresponds to one signal.  The template, noise and
+    projection matrices are shared and every application of the LHS passes
+    over the pointing once for all columns.  The block conjugate gradient
+    iteration of O'Leary (1980) is used with least squares solves of the
+    small (k x k) systems so that linearly dependent columns do not break
+    the iteration.
+    """
+
+    def __init__(
+        self,
+        comm,
+        templates,
+        noise,
+        projection,
+        signals,
+        niter_min=3,
+        niter_max=100,
+        convergence_limit=1e-12,
+    ):
+        self.comm = comm
+        if comm is None:
+            self.rank = 0
+        else:
+            self.rank = comm.rank
+        self.templates = templates
+        self.noise = noise
+        self.projection = projection
+        self.signals = signals
+        self.niter_min = niter_min
+        self.niter_max = niter_max
+        self.convergence_limit = convergence_limit
+        self.variant = "block"
+
+        self.rhs = BlockTemplateAmplitudes(
+            [
+                self.templates.apply_transpose(self.noise.apply(projected))
+                for projected in self.projection.apply_many(self.signals)
+            ]
+        )
+        return
+
+    @function_timer
+    def apply_lhs(self, block):
+        """Return A.X"""
+        signals = [self.templates.apply(amplitudes) for amplitudes in block]
+        projected = self.projection.apply_many(signals)
+        del signals
+        columns = []
+        for amplitudes, signal in zip(block, projected):
+            new_amplitudes = self.templates.apply_transpose(
+                self.noise.apply(signal, in_place=True)
+            )
+            self.templates.add_prior(amplitudes, new_amplitudes)
+            columns.append(new_amplitudes)
+        return BlockTemplateAmplitudes(columns)
+
+    @function_timer
+    def apply_precond(self, block):
+        """Return M^{-1}.X"""
+        return BlockTemplateAmplitudes(
+            [self.templates.apply_precond(amplitudes) for amplitudes in block]
+        )
+
+    @function_timer
+    def solve(self):
+        """Block PCG solution of A.X = B
+
+        Returns:
+            X : the least squares solutions, one TemplateAmplitudes per signal
+        """
+        log = Logger.get()
+        timer0 = Timer()
+        timer0.start()
+        timer = Timer()
+        timer.start()
+        nrhs = len(self.signals)
+        # Initial guess is zero amplitudes
+        guess = BlockTemplateAmplitudes(
+            [self.templates.zero_amplitudes() for i in range(nrhs)]
+        )
+        residual = self.rhs.copy()
+        precond_residual = self.apply_precond(residual)
+        proposal = precond_residual.copy()
+        rho = precond_residual.dot(residual)
+        # Convergence is tracked with the worst relative residual
+        init_sqsums = np.diag(rho).copy()
+        init_sqsums[init_sqsums == 0] = 1
+        if self.rank == 0:
+            log.info("Initial residuals: {}".format(init_sqsums))
+        self._init_sqsum, self._best_sqsum, self._last_best = 1, 1, 1
+        for iiter in range(self.niter_max):
+            if not np.all(np.isfinite(rho)):
+                raise RuntimeError("Residual is not finite")
+            lhs_proposal = self.apply_lhs(proposal)
+            alpha = np.linalg.lstsq(proposal.dot(lhs_proposal), rho, rcond=None)[0]
+            guess += proposal.combine(alpha)
+            residual -= lhs_proposal.combine(alpha)
+            del lhs_proposal
+            # Prepare for next iteration
+            precond_residual = self.apply_precond(residual)
+            new_rho = precond_residual.dot(residual)
+            # Check for convergence
+            sqsum = np.amax(np.diag(new_rho) / init_sqsums)
+            if self._check_convergence(iiter, sqsum, timer, timer0):
+                break
+            # Select the next directions
+            beta = np.linalg.lstsq(rho, new_rho, rcond=None)[0]
+            rho = new_rho
+            proposal = proposal.combine(beta)
+            proposal += precond_residual
+        return list(guess)
+
 
 class OpMapMaker(Operator):
 
@@ -1581,6 +2084,7 @@ class OpMapMaker(Operator):
         use_noise_prior=True,
         precond_width=20,
         pixels="pixels",
+        pcg_variant="standard",
     ):
         self.nside = nside
         self.npix = 12 * self.nside ** 2
@@ -1614,6 +2118,7 @@ class OpMapMaker(Operator):
         self.use_noise_prior = use_noise_prior
         self.precond_width = precond_width
         self.pixels = pixels
+        self.pcg_variant = pcg_variant
 
     def report_timing(self):
         # gt.stop_all()
@@ -1665,45 +2170,14 @@ class OpMapMaker(Operator):
                     OrderedDict(
                         [
                             (
-                                "ProjectionMatrix.bin_map",
+                                "ProjectionMatrix.apply_many",
                                 OrderedDict(
                                     [
                                         (
-                                            "OpAccumDiag.exec",
-                                            OrderedDict(
-                                                [
-                                                    (
-                                                        "OpAccumDiag.exec.apply_flags",
-                                                        None,
-                                                    ),
-                                                    (
-                                                        "OpAccumDiag.exec.global_to_local",
-                                                        None,
-                                                    ),
-                                                    ("cov_accum_zmap", None),
-                                                ]
-                                            ),
+                                            "ProjectionMatrix.bin_maps",
+                                            OrderedDict([("covariance_apply", None)]),
                                         ),
-                                        ("covariance_apply", None),
-                                    ]
-                                ),
-                            ),
-                            (
-                                "ProjectionMatrix.scan_map",
-                                OrderedDict(
-                                    [
-                                        (
-                                            "OpSimScan.exec",
-                                            OrderedDict(
-                                                [
-                                                    (
-                                                        "OpSimScan.exec.global_to_local",
-                                                        None,
-                                                    ),
-                                                    ("OpSimScan.exec.scan_map", None),
-                                                ]
-                                            ),
-                                        )
+                                        ("ProjectionMatrix.scan_maps", None),
                                     ]
                                 ),
                             ),
@@ -1882,11 +2356,29 @@ class OpMapMaker(Operator):
             signal,
             niter_min=self.iter_min,
             niter_max=self.iter_max,
+            variant=self.pcg_variant,
         )
         if self.rank == 0:
             timer.report_clear("Initialize PCG solver")
         return solver
 
+    @function_timer
+    def get_block_solver(self, data, templates, noise, projection, signals):
+        timer = Timer()
+        timer.start()
+        solver = BlockPCGSolver(
+            self.comm,
+            templates,
+            noise,
+            projection,
+            signals,
+            niter_min=self.iter_min,
+            niter_max=self.iter_max,
+        )
+        if self.rank == 0:
+            timer.report_clear("Initialize block PCG solver")
+        return solver
+
     @function_timer
     def load_mask(self, data):
         """Load processing mask and generate appropriate flag bits"""
@@ -1944,11 +2436,17 @@ class OpMapMaker(Operator):
             self.rank = 0
         else:
             self.rank = self.comm.rank
+        # A list of names requests a batched solve over all of them
+        if isinstance(self.name, (list, tuple)):
+            names = list(self.name)
+        else:
+            names = [self.name]
         self.flag_gaps(data)
         self.get_detweights(data)
         self.initialize_binning(data)
         if self.write_binned:
-            self.bin_map(data, "binned")
+            for name in names:
+                self.bin_map(data, "binned", name=name)
         self.load_mask(data)
         self.load_weightmap(data)
 
@@ -1959,29 +2457,40 @@ class OpMapMaker(Operator):
             return
         noise = self.get_noisematrix(data)
         projection = self.get_projectionmatrix(data)
-        signal = Signal(data, name=self.name)
-        solver = self.get_solver(data, templates, noise, projection, signal)
+        signals = [Signal(data, name=name) for name in names]
         timer.start()
-        amplitudes = solver.solve()
+        if isinstance(self.name, (list, tuple)):
+            solver = self.get_block_solver(data, templates, noise, projection, signals)
+            all_amplitudes = solver.solve()
+        else:
+            solver = self.get_solver(data, templates, noise, projection, signals[0])
+            all_amplitudes = [solver.solve()]
+        # Release the pixel translation memoized for the iterations
+        projection.clear_pixel_cache()
         if self.rank == 0:
             timer.report_clear("Solve amplitudes")
 
-        # To  mitigate calibration errors, we apply the estimated gains
-        if self.gain_templatename is not None:
-            templates.calibrate_signal(signal, amplitudes)
-            if self.rank == 0:
-                timer.report_clear("Calibrate TOD")
-                templates.templates["Gain"].write_gain_fluctuation(
-                    filename="gain_amplitudes.npz", amplitudes=amplitudes
-                )
-        else:
-            # Clean TOD
-            templates.clean_signal(signal, amplitudes)
-            if self.rank == 0:
-                timer.report_clear("Clean TOD")
+        for name, signal, amplitudes in zip(names, signals, all_amplitudes):
+            # To  mitigate calibration errors, we apply the estimated gains
+            if self.gain_templatename is not None:
+                templates.calibrate_signal(signal, amplitudes)
+                if self.rank == 0:
+                    timer.report_clear("Calibrate TOD")
+                    if len(names) == 1:
+                        fname = "gain_amplitudes.npz"
+                    else:
+                        fname = "gain_amplitudes_{}.npz".format(name)
+                    templates.templates["Gain"].write_gain_fluctuation(
+                        filename=fname, amplitudes=amplitudes
+                    )
+            else:
+                # Clean TOD
+                templates.clean_signal(signal, amplitudes)
+                if self.rank == 0:
+                    timer.report_clear("Clean TOD")
 
-        if self.write_destriped:
-            self.bin_map(data, "destriped")
+            if self.write_destriped:
+                self.bin_map(data, "destriped", name=name)
 
         return
 
@@ -1997,17 +2506,24 @@ class OpMapMaker(Operator):
         return
 
     @function_timer
-    def bin_map(self, data, suffix):
+    def bin_map(self, data, suffix, name=None):
         log = Logger.get()
         timer = Timer()
 
+        if name is None:
+            name = self.name
+        prefix = self.outprefix
+        if isinstance(self.name, (list, tuple)):
+            # Batched solves write one set of maps per signal
+            prefix += "{}_".format(name)
+
         dist_map = DistPixels(data, comm=self.comm, nnz=self.nnz, dtype=np.float64)
         if dist_map.data is not None:
             dist_map.data.fill(0.0)
         # FIXME: OpAccumDiag should support separate detweights for each observation
         build_dist_map = OpAccumDiag(
             zmap=dist_map,
-            name=self.name,
+            name=name,
             detweights=self.detweights[0],
             common_flag_mask=(self.common_flag_mask | self.gap_bit),
             flag_mask=self.flag_mask,
@@ -2021,7 +2537,7 @@ class OpMapMaker(Operator):
         if self.rank == 0:
             timer.report_clear("  Apply noise covariance")
 
-        fname = os.path.join(self.outdir, self.outprefix + suffix + ".fits")
+        fname = os.path.join(self.outdir, prefix + suffix + ".fits")
         if self.zip_maps:
             fname += ".gz"
         dist_map.write_healpix_fits(fname)
@@ -12,6 +12,8 @@ from ..utils import Environment
 
 from ..healpix import HealpixPixels
 
+from ..map.pixels import clear_local_pixels
+
 from ..op import Operator
 
 from ..timing import function_timer
@@ -19,6 +21,275 @@ from ..timing import function_timer
 from .._libtoast import pointing_matrix_healpix
 
 
+def lazy_pointing_key(pixels):
+    """Return the observation key used to register lazy pointing.
+
+    Args:
+        pixels (str):  The cache prefix of the pixel numbers.
+
+    Returns:
+        (str):  The key in the observation dictionary.
+
+    """
+    return "{}_lazy_pointing".format(pixels)
+
+
+def compressed_pixels_names(pixels, det):
+    """Return the cache names of compressed pixel numbers.
+
+    Args:
+        pixels (str):  The cache prefix of the pixel numbers.
+        det (str):  The detector name.
+
+    Returns:
+        (tuple):  The names of the block index and the packed byte stream.
+
+    """
+    name = "{}_{}".format(pixels, det)
+    return "{}_zindex".format(name), "{}_zdata".format(name)
+
+
+def _zigzag_varint_encode(values):
+    """Encode signed integers as zigzag, variable-length (LEB128) bytes."""
+    values = np.asarray(values, dtype=np.int64)
+    zigzag = ((values << 1) ^ (values >> 63)).view(np.uint64)
+    nbyte = np.ones(len(zigzag), dtype=np.int64)
+    rest = zigzag >> np.uint64(7)
+    while np.any(rest):
+        nbyte += rest != 0
+        rest >>= np.uint64(7)
+    packed = np.zeros(np.sum(nbyte), dtype=np.uint8)
+    first = np.cumsum(nbyte) - nbyte
+    rest = zigzag.copy()
+    for k in range(np.amax(nbyte, initial=0)):
+        active = nbyte > k
+        byte = (rest[active] & np.uint64(0x7F)).astype(np.uint8)
+        more = (nbyte[active] > k + 1).astype(np.uint8) << np.uint8(7)
+        packed[first[active] + k] = byte | more
+        rest >>= np.uint64(7)
+    return packed
+
+
+def _zigzag_varint_decode(packed):
+    """Decode the output of _zigzag_varint_encode."""
+    last = np.flatnonzero(packed < 0x80)
+    first = np.zeros_like(last)
+    first[1:] = last[:-1] + 1
+    nbyte = last - first + 1
+    zigzag = np.zeros(len(last), dtype=np.uint64)
+    for k in range(np.amax(nbyte, initial=0)):
+        active = nbyte > k
+        byte = (packed[first[active] + k] & np.uint8(0x7F)).astype(np.uint64)
+        zigzag[active] |= byte << np.uint64(7 * k)
+    return (zigzag >> np.uint64(1)).astype(np.int64) ^ -(
+        (zigzag & np.uint64(1)).astype(np.int64)
+    )
+
+
+def compress_pixel_block(pixels):
+    """Delta encode one block of pixel numbers.
+
+    Pixel numbers along a scan change slowly, so the differences between
+    consecutive samples are small and are stored with one byte in most
+    cases.
+
+    Args:
+        pixels (array):  The pixel numbers of the block.
+
+    Returns:
+        (tuple):  The first pixel number and the packed differences.
+
+    """
+    pixels = np.asarray(pixels, dtype=np.int64)
+    return pixels[0], _zigzag_varint_encode(np.diff(pixels))
+
+
+def compress_pixels(pixels, block_length):
+    """Compress pixel numbers in independently decodable blocks.
+
+    Args:
+        pixels (array):  The pixel numbers.
+        block_length (int):  The number of samples in each block.
+
+    Returns:
+        (tuple):  The int64 block index and the uint8 packed differences.
+            See `pack_pixel_index` for the index layout.
+
+    """
+    firsts = list()
+    chunks = list()
+    for off in range(0, len(pixels), block_length):
+        first, chunk = compress_pixel_block(pixels[off : off + block_length])
+        firsts.append(first)
+        chunks.append(chunk)
+    return pack_pixel_index(len(pixels), block_length, firsts, chunks)
+
+
+def pack_pixel_index(nsamp, block_length, firsts, chunks):
+    """Concatenate compressed blocks and build the block index.
+
+    The index holds the number of samples, the block length, the number of
+    blocks, the first pixel number of every block and the offsets of every
+    block in the packed byte stream (with the total length as last entry).
+
+    Args:
+        nsamp (int):  The total number of samples.
+        block_length (int):  The number of samples in each block.
+        firsts (list):  The first pixel of each block.
+        chunks (list):  The packed differences of each block.
+
+    Returns:
+        (tuple):  The int64 block index and the uint8 packed differences.
+
+    """
+    nblock = len(chunks)
+    offsets = np.zeros(nblock + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in chunks])
+    index = np.hstack(
+        [
+            np.array([nsamp, block_length, nblock], dtype=np.int64),
+            np.array(firsts, dtype=np.int64),
+            offsets,
+        ]
+    )
+    if nblock > 0:
+        packed = np.hstack(chunks).astype(np.uint8)
+    else:
+        packed = np.zeros(0, dtype=np.uint8)
+    return index, packed
+
+
+def decompress_pixel_block(index, packed, iblock):
+    """Decode one block of compressed pixel numbers.
+
+    Args:
+        index (array):  The block index from `compress_pixels`.
+        packed (array):  The packed differences from `compress_pixels`.
+        iblock (int):  The block to decode.
+
+    Returns:
+        (tuple):  The sample slice and the int64 pixel numbers of the block.
+
+    """
+    nsamp, block_length, nblock = index[:3]
+    if iblock < 0 or iblock >= nblock:
+        raise IndexError("Pixel block {} is out of range".format(iblock))
+    first = index[3 + iblock]
+    offsets = index[3 + nblock :]
+    start = iblock * block_length
+    stop = min(start + block_length, nsamp)
+    pixels = np.empty(stop - start, dtype=np.int64)
+    pixels[0] = first
+    deltas = _zigzag_varint_decode(packed[offsets[iblock] : offsets[iblock + 1]])
+    np.cumsum(deltas, out=pixels[1:])
+    pixels[1:] += first
+    return slice(start, stop), pixels
+
+
+def decompress_pixels(index, packed):
+    """Decode all compressed pixel numbers.
+
+    Args:
+        index (array):  The block index from `compress_pixels`.
+        packed (array):  The packed differences from `compress_pixels`.
+
+    Returns:
+        (array):  The int64 pixel numbers.
+
+    """
+    pixels = np.empty(index[0], dtype=np.int64)
+    for iblock in range(index[2]):
+        bslice, block = decompress_pixel_block(index, packed, iblock)
+        pixels[bslice] = block
+    return pixels
+
+
+def pointing_blocks(obs, det, pixels="pixels", weights="weights"):
+    """Iterate over blocks of the pointing matrix of one detector.
+
+    If the pointing was expanded into the TOD cache, a single block with
+    references to the cached pixel numbers and weights is returned.  If the
+    pixel numbers were compressed, they are decoded one compressed block at
+    a time.  If the pointing was registered by a lazy OpPointingHpix, the
+    blocks are expanded on demand in tod_buffer_length chunks.  In that
+    case the arrays are scratch buffers that are overwritten by the next
+    block.
+
+    Args:
+        obs (dict):  The observation.
+        det (str):  The detector name.
+        pixels (str):  The cache prefix of the pixel numbers.
+        weights (str):  The cache prefix of the pointing weights.
+
+    Yields:
+        (tuple):  The sample slice, pixel numbers and (nsamp x nnz) weights.
+
+    """
+    tod = obs["tod"]
+    lazy = obs.get(lazy_pointing_key(pixels), None)
+    if lazy is not None:
+        yield from lazy.expand_blocks(tod, det)
+        return
+    pixelsname = "{}_{}".format(pixels, det)
+    weightsref = tod.cache.reference("{}_{}".format(weights, det))
+    if tod.cache.exists(pixelsname):
+        pixelsref = tod.cache.reference(pixelsname)
+        yield slice(0, pixelsref.size), pixelsref, weightsref
+        del pixelsref
+    else:
+        indexname, packedname = compressed_pixels_names(pixels, det)
+        index = tod.cache.reference(indexname)
+        packed = tod.cache.reference(packedname)
+        for iblock in range(index[2]):
+            bslice, block = decompress_pixel_block(index, packed, iblock)
+            yield bslice, block, weightsref[bslice]
+        del index
+        del packed
+    del weightsref
+
+
+def local_pointing_blocks(
+    obs, det, distmap, pixels="pixels", weights="weights", memoize=False
+):
+    """Iterate over blocks of the pointing matrix in local map indices.
+
+    Like `pointing_blocks` but the pixel numbers are translated into the
+    local submaps and pixels of `distmap`.  If `memoize` is set and the
+    pointing was expanded into the TOD cache, the translation is memoized
+    next to the pixel numbers until `clear_local_pixels` is called.
+
+    Args:
+        obs (dict):  The observation.
+        det (str):  The detector name.
+        distmap (DistPixels):  The map defining the pixel distribution.
+        pixels (str):  The cache prefix of the pixel numbers.
+        weights (str):  The cache prefix of the pointing weights.
+        memoize (bool):  Keep the translation of expanded pointing in the
+            TOD cache for later passes.
+
+    Yields:
+        (tuple):  The sample slice, int64 local submaps, int64 local pixels
+            and (nsamp x nnz) weights.
+
+    """
+    tod = obs["tod"]
+    pixelsname = "{}_{}".format(pixels, det)
+    lazy = obs.get(lazy_pointing_key(pixels), None)
+    if memoize and lazy is None and tod.cache.exists(pixelsname):
+        sm, lpix = distmap.cached_global_to_local(tod.cache, pixelsname)
+        weightsref = tod.cache.reference("{}_{}".format(weights, det))
+        yield slice(0, sm.size), sm, lpix, weightsref
+        del weightsref
+        return
+    for bslice, pixelsblock, weightsblock in pointing_blocks(
+        obs, det, pixels=pixels, weights=weights
+    ):
+        sm, lpix = distmap.global_to_local(pixelsblock)
+        sm = sm.astype(np.int64, copy=False)
+        lpix = lpix.astype(np.int64, copy=False)
+        yield bslice, sm, lpix, weightsblock
+
+
 class OpPointingHpix(Operator):
     """
     Operator which generates I/Q/U healpix pointing weights.
@@ -61,6 +332,14 @@ class OpPointingHpix(Operator):
         single_precision (bool):  Return the pixel numbers and pointing
              weights in single precision.  Default=False.
         nside_submap (int):  Size of a submap is 12 * nside_submap ** 2
+        lazy (bool):  Do not store the pointing in the TOD cache.  Instead
+            register this operator in each observation so that operators
+            using `pointing_blocks` (OpAccumDiag, OpSimScan and the
+            OpMapMaker projection) expand the pointing on demand.
+        compress_pixels (bool):  Store the pixel numbers delta and
+            variable-length encoded in tod_buffer_length blocks instead of
+            as plain integers.  Only operators using `pointing_blocks` can
+            read compressed pixel numbers.
     """
 
     def __init__(
@@ -78,6 +357,8 @@ class OpPointingHpix(Operator):
         keep_quats=False,
         single_precision=False,
         nside_submap=16,
+        lazy=False,
+        compress_pixels=False,
     ):
         self._pixels = pixels
         self._weights = weights
@@ -91,6 +372,8 @@ class OpPointingHpix(Operator):
         self._common_flag_name = common_flag_name
         self._keep_quats = keep_quats
         self._single_precision = single_precision
+        self._lazy = lazy
+        self._compress_pixels = compress_pixels
         self._nside_submap = min(nside, nside_submap)
         self._npix_submap = 12 * self._nside_submap ** 2
         self._nsubmap = (self._nside // self._nside_submap) ** 2
@@ -133,13 +416,120 @@ class OpPointingHpix(Operator):
             dtype = np.int64
         return np.arange(self._nsubmap, dtype=dtype)[self._hit_submaps]
 
+    def _common_flags(self, tod):
+        """Read the common flags and apply the bitmask."""
+        offset, nsamp = tod.local_samples
+        if self._apply_flags:
+            common = tod.local_common_flags(self._common_flag_name)
+            common = common & self._common_flag_mask
+        else:
+            common = np.zeros(nsamp, dtype=np.uint8)
+        return common
+
+    def _hwp_angle(self, tod):
+        try:
+            hwpang = tod.local_hwp_angle()
+        except:
+            hwpang = None
+        return hwpang
+
+    def _expand_buffer(
+        self, tod, det, pdata, hwpang, common, bslice, pixels, weights
+    ):
+        """Expand one buffer of pointing into the provided arrays.
+
+        The arrays must be contiguous int64 and float64 arrays with the length
+        of the buffer.
+        """
+        eps = 0.0
+        if self._epsilon is not None:
+            eps = self._epsilon[det]
+
+        cal = 1.0
+        if self._cal is not None:
+            cal = self._cal[det]
+
+        detp = None
+        if pdata is None:
+            # Read and discard
+            detp = tod.read_pntg(
+                detector=det,
+                local_start=bslice.start,
+                n=(bslice.stop - bslice.start),
+            )
+        else:
+            # Use cached version
+            detp = pdata[bslice, :]
+
+        hslice = None
+        if hwpang is not None:
+            hslice = hwpang[bslice].reshape(-1)
+        fslice = common[bslice].reshape(-1)
+
+        pointing_matrix_healpix(
+            self.hpix,
+            self._nest,
+            eps,
+            cal,
+            self._mode,
+            detp.reshape(-1),
+            hslice,
+            fslice,
+            pixels.reshape(-1),
+            weights.reshape(-1),
+        )
+        return
+
+    def expand_blocks(self, tod, det):
+        """Expand the pointing of one detector in tod_buffer_length blocks.
+
+        The pixel numbers and weights are written into scratch buffers that
+        are reused for every block.
+
+        Args:
+            tod (toast.TOD):  The TOD containing the detector.
+            det (str):  The detector name.
+
+        Yields:
+            (tuple):  The sample slice, int64 pixel numbers and float64
+                (nsamp x nnz) weights of each block.
+
+        """
+        env = Environment.get()
+        tod_buffer_length = env.tod_buffer_length()
+        offset, nsamp = tod.local_samples
+        hwpang = self._hwp_angle(tod)
+        common = self._common_flags(tod)
+        pixels = np.zeros(min(tod_buffer_length, nsamp), dtype=np.int64)
+        weights = np.zeros((min(tod_buffer_length, nsamp), self._nnz), np.float64)
+        buf_off = 0
+        buf_n = tod_buffer_length
+        while buf_off < nsamp:
+            if buf_off + buf_n > nsamp:
+                buf_n = nsamp - buf_off
+            bslice = slice(buf_off, buf_off + buf_n)
+            self._expand_buffer(
+                tod,
+                det,
+                None,
+                hwpang,
+                common,
+                bslice,
+                pixels[:buf_n],
+                weights[:buf_n],
+            )
+            yield bslice, pixels[:buf_n], weights[:buf_n]
+            buf_off += buf_n
+        return
+
     @function_timer
     def exec(self, data):
         """Create pixels and weights.
 
         This iterates over all observations and detectors, and creates
         the pixel and weight arrays representing the pointing matrix.
-        This data is stored in the TOD cache.
+        This data is stored in the TOD cache unless lazy expansion was
+        requested.
 
         Args:
             data (toast.Data): The distributed data.
@@ -148,6 +538,13 @@ class OpPointingHpix(Operator):
         env = Environment.get()
         tod_buffer_length = env.tod_buffer_length()
 
+        if self._single_precision:
+            pixtype = np.int32
+            weighttype = np.float32
+        else:
+            pixtype = np.int64
+            weighttype = np.float64
+
         for obs in data.obs:
             tod = obs["tod"]
 
@@ -160,30 +557,34 @@ class OpPointingHpix(Operator):
 
             offset, nsamp = tod.local_samples
 
-            hwpang = None
-            try:
-                hwpang = tod.local_hwp_angle()
-            except:
-                hwpang = None
+            if self._lazy:
+                # Only record the hit submaps.  Consumers expand the
+                # pointing themselves.
+                obs[lazy_pointing_key(self._pixels)] = self
+                for det in tod.local_dets:
+                    clear_local_pixels(tod.cache, "{}_{}".format(self._pixels, det))
+                    for bslice, pixels, weights in self.expand_blocks(tod, det):
+                        self._hit_submaps[pixels // self._npix_submap] = True
+                continue
 
-            # read the common flags and apply bitmask
+            obs.pop(lazy_pointing_key(self._pixels), None)
 
-            common = None
-            if self._apply_flags:
-                common = tod.local_common_flags(self._common_flag_name)
-                common = common & self._common_flag_mask
-            else:
-                common = np.zeros(nsamp, dtype=np.uint8)
+            hwpang = self._hwp_angle(tod)
 
-            for det in tod.local_dets:
-                eps = 0.0
-                if self._epsilon is not None:
-                    eps = self._epsilon[det]
+            # read the common flags and apply bitmask
 
-                cal = 1.0
-                if self._cal is not None:
-                    cal = self._cal[det]
+            common = self._common_flags(tod)
 
+            use_scratch = self._single_precision or self._compress_pixels
+            if use_scratch:
+                # Expand into double precision scratch buffers and store
+                # single precision or compressed copies.
+                pixelsbuf = np.zeros(min(tod_buffer_length, nsamp), dtype=np.int64)
+                weightsbuf = np.zeros(
+                    (min(tod_buffer_length, nsamp), self._nnz), dtype=np.float64
+                )
+
+            for det in tod.local_dets:
                 # Create cache objects and use that memory directly
 
                 pixelsname = "{}_{}".format(self._pixels, det)
@@ -192,16 +593,29 @@ class OpPointingHpix(Operator):
                 pixelsref = None
                 weightsref = None
 
+                clear_local_pixels(tod.cache, pixelsname)
+                for name in compressed_pixels_names(self._pixels, det):
+                    if tod.cache.exists(name):
+                        tod.cache.destroy(name)
+
                 if tod.cache.exists(pixelsname):
                     pixelsref = tod.cache.reference(pixelsname)
-                else:
-                    pixelsref = tod.cache.create(pixelsname, np.int64, (nsamp,))
+                    if self._compress_pixels or pixelsref.dtype != pixtype:
+                        del pixelsref
+                        tod.cache.destroy(pixelsname)
+                        pixelsref = None
+                if pixelsref is None and not self._compress_pixels:
+                    pixelsref = tod.cache.create(pixelsname, pixtype, (nsamp,))
 
                 if tod.cache.exists(weightsname):
                     weightsref = tod.cache.reference(weightsname)
-                else:
+                    if weightsref.dtype != weighttype:
+                        del weightsref
+                        tod.cache.destroy(weightsname)
+                        weightsref = None
+                if weightsref is None:
                     weightsref = tod.cache.create(
-                        weightsname, np.float64, (nsamp, self._nnz)
+                        weightsname, weighttype, (nsamp, self._nnz)
                     )
 
                 pdata = None
@@ -210,6 +624,9 @@ class OpPointingHpix(Operator):
                     # them now for the full sample range.
                     pdata = tod.local_pointing(det)
 
+                firsts = list()
+                chunks = list()
+
                 buf_off = 0
                 buf_n = tod_buffer_length
                 while buf_off < nsamp:
@@ -217,44 +634,53 @@ class OpPointingHpix(Operator):
                         buf_n = nsamp - buf_off
                     bslice = slice(buf_off, buf_off + buf_n)
 
-                    detp = None
-                    if pdata is None:
-                        # Read and discard
-                        detp = tod.read_pntg(detector=det, local_start=buf_off, n=buf_n)
+                    if use_scratch:
+                        self._expand_buffer(
+                            tod,
+                            det,
+                            pdata,
+                            hwpang,
+                            common,
+                            bslice,
+                            pixelsbuf[:buf_n],
+                            weightsbuf[:buf_n],
+                        )
+                        if self._compress_pixels:
+                            first, chunk = compress_pixel_block(pixelsbuf[:buf_n])
+                            firsts.append(first)
+                            chunks.append(chunk)
+                            self._hit_submaps[
+                                pixelsbuf[:buf_n] // self._npix_submap
+                            ] = True
+                        else:
+                            pixelsref[bslice] = pixelsbuf[:buf_n]
+                        weightsref[bslice, :] = weightsbuf[:buf_n]
                     else:
-                        # Use cached version
-                        detp = pdata[bslice, :]
-
-                    hslice = None
-                    if hwpang is not None:
-                        hslice = hwpang[bslice].reshape(-1)
-                    fslice = common[bslice].reshape(-1)
-
-                    pointing_matrix_healpix(
-                        self.hpix,
-                        self._nest,
-                        eps,
-                        cal,
-                        self._mode,
-                        detp.reshape(-1),
-                        hslice,
-                        fslice,
-                        pixelsref[bslice].reshape(-1),
-                        weightsref[bslice, :].reshape(-1),
-                    )
+                        self._expand_buffer(
+                            tod,
+                            det,
+                            pdata,
+                            hwpang,
+                            common,
+                            bslice,
+                            pixelsref[bslice],
+                            weightsref[bslice, :],
+                        )
                     buf_off += buf_n
 
-                if self._single_precision:
-                    pixels = pixelsref.astype(np.int32)
-                    del pixelsref
-                    pixelsref = tod.cache.put(pixelsname, pixels, replace=True)
-                    del pixels
-                    weights = weightsref.astype(np.float32)
-                    del weightsref
-                    weightsref = tod.cache.put(weightsname, weights, replace=True)
-                    del weights
-
-                self._hit_submaps[pixelsref // self._npix_submap] = True
+                if self._compress_pixels:
+                    index, packed = pack_pixel_index(
+                        nsamp, tod_buffer_length, firsts, chunks
+                    )
+                    del firsts
+                    del chunks
+                    indexname, packedname = compressed_pixels_names(self._pixels, det)
+                    tod.cache.put(indexname, index)
+                    tod.cache.put(packedname, packed)
+                    del index
+                    del packed
+                else:
+                    self._hit_submaps[pixelsref // self._npix_submap] = True
 
                 del pixelsref
                 del weightsref
@@ -265,12 +691,7 @@ class OpPointingHpix(Operator):
         # Store the local submaps in the data object under the same name
         # as the pixel numbers
 
-        if self._single_precision:
-            dtype = np.int32
-        else:
-            dtype = np.int64
-
-        local_submaps = np.arange(self._nsubmap, dtype=dtype)[self._hit_submaps]
+        local_submaps = np.arange(self._nsubmap, dtype=pixtype)[self._hit_submaps]
         submap_name = "{}_local_submaps".format(self._pixels)
         data[submap_name] = local_submaps
         npix_submap_name = "{}_npix_submap".format(self._pixels)
@@ -471,6 +892,7 @@ class OpMuellerPointingHpix(Operator):
                 pixelsref = None
                 weightsref = None
 
+                clear_local_pixels(tod.cache, pixelsname)
                 if tod.cache.exists(pixelsname):
                     pixelsref = tod.cache.reference(pixelsname)
                 else:
@@ -22,7 +22,7 @@ if available_utils:
         atm_atmospheric_loading_vec,
     )
 
-from .atm import AtmSim
+from .atm import AtmSim, atm_shells
 
 from toast.mpi import MPI
 
@@ -57,9 +57,12 @@ class OpSimAtmosphere(Operator):
         gain (float): Scaling applied to the simulated TOD.
         zatm (float): atmosphere extent for temperature profile.
         zmax (float): atmosphere extent for water vapor integration.
-        xstep (float): size of volume elements in X direction.
-        ystep (float): size of volume elements in Y direction.
-        zstep (float): size of volume elements in Z direction.
+        xstep (float): size of volume elements in X direction in the
+            innermost radial shell.
+        ystep (float): size of volume elements in Y direction in the
+            innermost radial shell.
+        zstep (float): size of volume elements in Z direction in the
+            innermost radial shell.
         nelem_sim_max (int): controls the size of the simulation slices.
         z0_center (float):  central value of the water vapor
              distribution.
@@ -83,6 +86,19 @@ class OpSimAtmosphere(Operator):
             volume and creating a new one [meters].
         cachedir (str):  Directory to use for loading and saving
             atmosphere realizations.  Set to None to disable caching.
+            Realizations are named after a hash of all simulation
+            parameters and RNG keys, so repeated runs with the same
+            atmosphere reuse them.
+        cache_size (int):  Maximum total size of the atmosphere cache
+            in bytes.  The least recently used realizations are removed
+            when the limit is exceeded.  None means no limit.
+        rmax_first (float):  Outer radius of the innermost radial shell [meters].
+        rmax (float):  Maximum line of sight distance [meters].
+        shell_scale (float):  Ratio of the outer radii of consecutive
+            radial shells.  Every shell is an independent simulation.
+        step_exponent (float):  The volume element of each shell grows with
+            its outer radius as (r / rmax_first)**step_exponent.  Use 1 to
+            keep the angular resolution constant.
         freq (float):  Observing frequency in GHz.
         write_debug (bool):  If True, write debugging files.
     """
@@ -113,6 +129,11 @@ class OpSimAtmosphere(Operator):
         report_timing=False,
         wind_dist=10000,
         cachedir=None,
+        cache_size=None,
+        rmax_first=100,
+        rmax=10000,
+        shell_scale=10,
+        step_exponent=0.5,
         freq=None,
         plot=False,
         write_debug=False,
@@ -135,6 +156,11 @@ class OpSimAtmosphere(Operator):
         self._zstep = zstep
         self._nelem_sim_max = nelem_sim_max
         self._cachedir = cachedir
+        self._cache_size = cache_size
+        self._rmax_first = rmax_first
+        self._rmax = rmax
+        self._shell_scale = shell_scale
+        self._step_exponent = step_exponent
         self._freq = freq
 
         self._z0_center = z0_center
@@ -167,6 +193,7 @@ class OpSimAtmosphere(Operator):
         """
         log = Logger.get()
         group = data.comm.group
+        hits_start, misses_start = AtmSim.cache_stats()
         for obs in data.obs:
             try:
                 obsname = obs["name"]
@@ -197,7 +224,7 @@ class OpSimAtmosphere(Operator):
 
             absorption = self._get_absorption_and_loading(obs)
 
-            cachedir = self._get_cache_dir(obs, comm)
+            cachedir = self._get_cache_dir(comm)
 
             if comm is not None:
                 comm.Barrier()
@@ -209,6 +236,22 @@ class OpSimAtmosphere(Operator):
 
             scan_range = self._get_scan_range(obs, comm, prefix)
 
+            # Shells beyond the top of the simulated volume are not observed
+            elmax = scan_range[3]
+            shells = [
+                x
+                for x in atm_shells(
+                    self._xstep,
+                    self._ystep,
+                    self._zstep,
+                    rmax_first=self._rmax_first,
+                    rmax=self._rmax,
+                    scale=self._shell_scale,
+                    step_exponent=self._step_exponent,
+                )
+                if x[1] * np.sin(elmax) < self._zmax
+            ]
+
             # Loop over the time span in "wind_time"-sized chunks.
             # wind_time is intended to reflect the correlation length
             # in the atmospheric noise.
@@ -239,14 +282,14 @@ class OpSimAtmosphere(Operator):
                 ind = slice(istart, istop)
                 nind = istop - istart
 
-                rmin = 0
-                rmax = 100
-                scale = 10
                 counter2start = counter2
-                counter1 = counter1start
-                xstart, ystart, zstart = self._xstep, self._ystep, self._zstep
 
-                while rmax < 100000:
+                # The detector pointing is shared by all radial shells
+                azel = self._get_detector_azel(
+                    tod, rank, prefix, common_ref, istart, nind, ind, scan_range
+                )
+
+                for ishell, rmin, rmax, xstep, ystep, zstep in shells:
                     sim, counter2 = self._simulate_atmosphere(
                         weather,
                         scan_range,
@@ -255,7 +298,7 @@ class OpSimAtmosphere(Operator):
                         comm,
                         key1,
                         key2,
-                        counter1,
+                        counter1start + ishell,
                         counter2start,
                         cachedir,
                         prefix,
@@ -263,6 +306,9 @@ class OpSimAtmosphere(Operator):
                         tmax_tot,
                         rmin,
                         rmax,
+                        xstep,
+                        ystep,
+                        zstep,
                     )
 
                     if self._plot:
@@ -279,34 +325,18 @@ class OpSimAtmosphere(Operator):
                         )
 
                     self._observe_atmosphere(
-                        sim,
-                        tod,
-                        comm,
-                        prefix,
-                        common_ref,
-                        istart,
-                        nind,
-                        ind,
-                        scan_range,
-                        times,
-                        absorption,
+                        sim, tod, comm, prefix, azel, times, absorption
                     )
 
                     del sim
 
-                    rmin = rmax
-                    rmax *= scale
-                    self._xstep *= np.sqrt(scale)
-                    self._ystep *= np.sqrt(scale)
-                    self._zstep *= np.sqrt(scale)
-                    counter1 += 1
+                del azel
 
                 if self._write_debug:
                     self._save_tod(
                         obsname, tod, times, istart, nind, ind, comm, common_ref
                     )
 
-                self._xstep, self._ystep, self._zstep = xstart, ystart, zstart
                 tmin = tmax
 
         if self._report_timing:
@@ -319,6 +349,22 @@ class OpSimAtmosphere(Operator):
                         prefix, tmr.seconds()
                     )
                 )
+
+        if self._cachedir is not None:
+            hits, misses = AtmSim.cache_stats()
+            hits -= hits_start
+            misses -= misses_start
+            if data.comm.comm_rank is not None:
+                # Every process in a group sees the same hits and misses, so
+                # only sum across the groups.
+                hits = data.comm.comm_rank.allreduce(hits)
+                misses = data.comm.comm_rank.allreduce(misses)
+            if data.comm.world_rank == 0 and hits + misses > 0:
+                log.info(
+                    "Atmosphere cache: {} hits, {} misses ({:.1f}% hit rate)".format(
+                        hits, misses, 100 * hits / (hits + misses)
+                    )
+                )
         return
 
     @function_timer
@@ -534,17 +580,13 @@ class OpSimAtmosphere(Operator):
 
         return absorption
 
-    def _get_cache_dir(self, obs, comm):
-        obsindx = self._get_from_obs("id", obs)
+    def _get_cache_dir(self, comm):
         if self._cachedir is None:
             cachedir = None
         else:
-            # The number of atmospheric realizations can be large.  Use
-            # sub-directories under cachedir.
-            subdir = str(int((obsindx % 1000) // 100))
-            subsubdir = str(int((obsindx % 100) // 10))
-            subsubsubdir = str(obsindx % 10)
-            cachedir = os.path.join(self._cachedir, subdir, subsubdir, subsubsubdir)
+            # The realizations are content-addressed and AtmSim shards them
+            # into sub-directories, so all observations share one directory.
+            cachedir = self._cachedir
             if (comm is None) or (comm.rank == 0):
                 # Handle a rare race condition when two process groups
                 # are creating the cache directories at the same time
@@ -652,6 +694,9 @@ class OpSimAtmosphere(Operator):
         tmax_tot,
         rmin,
         rmax,
+        xstep,
+        ystep,
+        zstep,
     ):
         log = Logger.get()
         rank = 0
@@ -692,9 +737,9 @@ class OpSimAtmosphere(Operator):
             0,
             self._zatm,
             self._zmax,
-            self._xstep,
-            self._ystep,
-            self._zstep,
+            xstep,
+            ystep,
+            zstep,
             self._nelem_sim_max,
             comm,
             key1,
@@ -705,6 +750,7 @@ class OpSimAtmosphere(Operator):
             rmin,
             rmax,
             write_debug=self._write_debug,
+            cache_size=self._cache_size,
         )
 
         if self._report_timing:
@@ -722,32 +768,21 @@ class OpSimAtmosphere(Operator):
 
         # Check if the cache already exists.
 
-        use_cache = False
-        have_cache = False
+        use_cache = cachedir is not None
         if rank == 0:
-            if cachedir is not None:
-                # We are saving to cache
-                use_cache = True
-            fname = None
-            if cachedir is not None:
-                fname = os.path.join(
-                    cachedir, "{}_{}_{}_{}.h5".format(key1, key2, counter1, counter2)
-                )
+            fname = sim.cache_file()
             if (fname is not None) and os.path.isfile(fname):
                 log.debug(
                     "{}Loading the atmosphere for t = {} from {}".format(
                         prefix, tmin - tmin_tot, fname
                     )
                 )
-                have_cache = True
             else:
                 log.debug(
                     "{}Simulating the atmosphere for t = {}".format(
                         prefix, tmin - tmin_tot
                     )
                 )
-        if comm is not None:
-            use_cache = comm.bcast(use_cache, root=0)
 
         err = sim.simulate(use_cache=use_cache)
         if err != 0:
@@ -763,7 +798,7 @@ class OpSimAtmosphere(Operator):
                 comm.Barrier()
             if rank == 0:
                 op = None
-                if have_cache:
+                if sim.cache_hit:
                     op = "Loaded"
                 else:
                     op = "Simulated"
@@ -779,76 +814,48 @@ class OpSimAtmosphere(Operator):
         return sim, counter2
 
     @function_timer
-    def _observe_atmosphere(
-        self,
-        sim,
-        tod,
-        comm,
-        prefix,
-        common_ref,
-        istart,
-        nind,
-        ind,
-        scan_range,
-        times,
-        absorption,
+    def _get_detector_azel(
+        self, tod, rank, prefix, common_ref, istart, nind, ind, scan_range
     ):
-        log = Logger.get()
-        rank = 0
-        if comm is not None:
-            rank = comm.rank
-        tmr = Timer()
-        if self._report_timing:
-            if comm is not None:
-                comm.Barrier()
-            tmr.start()
-
-        azmin, azmax, elmin, elmax = scan_range
+        """Read the Az/El pointing of all local detectors for one time range.
 
-        nsamp = tod.local_samples[1]
-
-        if rank == 0:
-            log.debug("{}Observing the atmosphere".format(prefix))
+        Returns:
+            (tuple):  The detectors with good samples, the local indices of
+                the samples that any of them observes, the good sample mask of
+                every detector and the detector azimuths and elevations at
+                those samples.  None if no detector has good samples.
 
-        ngood_tot = 0
-        nbad_tot = 0
+        """
+        azmin, azmax, elmin, elmax = scan_range
 
+        dets = []
+        goods = []
+        azs = []
+        els = []
         for det in tod.local_dets:
-            # Cache the output signal
-            cachename = "{}_{}".format(self._out, det)
-            if tod.cache.exists(cachename):
-                ref = tod.cache.reference(cachename)
-            else:
-                ref = tod.cache.create(cachename, np.float64, (nsamp,))
-
-            # Cache the output flags
             flag_ref = tod.local_flags(det, self._flag_name)
-
             if self._apply_flags:
                 good = np.logical_and(
                     common_ref[ind] & self._common_flag_mask == 0,
                     flag_ref[ind] & self._flag_mask == 0,
                 )
-                ngood = np.sum(good)
             else:
                 try:
                     good = common_ref[ind] & tod.UNSTABLE == 0
-                    ngood = np.sum(good)
                 except:
-                    good = slice(0, nind)
-                    ngood = nind
-            if ngood == 0:
+                    good = np.ones(nind, dtype=bool)
+            del flag_ref
+            if np.sum(good) == 0:
                 continue
 
+            azelquat = None
             try:
                 # Some TOD classes provide a shortcut to Az/El
                 az, el = tod.read_azel(detector=det, local_start=istart, n=nind)
-                az = az[good]
-                el = el[good]
             except Exception as e:
                 azelquat = tod.read_pntg(
                     detector=det, local_start=istart, n=nind, azel=True
-                )[good]
+                )
                 # Convert Az/El quaternion of the detector back into
                 # angles for the simulation.
                 theta, phi = qa.to_position(azelquat)
@@ -857,15 +864,17 @@ class OpSimAtmosphere(Operator):
                 az = 2 * np.pi - phi
                 el = np.pi / 2 - theta
 
-            if np.ptp(az) < np.pi:
-                azmin_det = np.amin(az)
-                azmax_det = np.amax(az)
+            az_good = az[good]
+            el_good = el[good]
+            if np.ptp(az_good) < np.pi:
+                azmin_det = np.amin(az_good)
+                azmax_det = np.amax(az_good)
             else:
                 # Scanning across the zero azimuth.
-                azmin_det = np.amin(az[az > np.pi]) - 2 * np.pi
-                azmax_det = np.amax(az[az < np.pi])
-            elmin_det = np.amin(el)
-            elmax_det = np.amax(el)
+                azmin_det = np.amin(az_good[az_good > np.pi]) - 2 * np.pi
+                azmax_det = np.amax(az_good[az_good < np.pi])
+            elmin_det = np.amin(el_good)
+            elmax_det = np.amax(el_good)
             if (
                 not (azmin <= azmin_det and azmax_det <= azmax)
                 and not (
@@ -877,7 +886,8 @@ class OpSimAtmosphere(Operator):
 
                 with open("bad_quats_{}_{}.pck".format(rank, det), "wb") as fout:
                     pickle.dump(
-                        [scan_range, az, el, azelquat, tod._boresight_azel], fout
+                        [scan_range, az_good, el_good, azelquat, tod._boresight_azel],
+                        fout,
                     )
                 # DEBUG end
                 raise RuntimeError(
@@ -896,36 +906,95 @@ class OpSimAtmosphere(Operator):
                     )
                 )
 
-            # Integrate detector signal
+            dets.append(det)
+            goods.append(good)
+            azs.append(az)
+            els.append(el)
+
+        if len(dets) == 0:
+            return None
+
+        goods = np.vstack(goods)
+        observed = np.any(goods, axis=0)
+        samples = np.arange(ind.start, ind.stop)[observed]
+        return (
+            dets,
+            samples,
+            goods[:, observed],
+            np.vstack(azs)[:, observed],
+            np.vstack(els)[:, observed],
+        )
 
-            atmdata = np.zeros(ngood, dtype=np.float64)
+    @function_timer
+    def _observe_atmosphere(self, sim, tod, comm, prefix, azel, times, absorption):
+        log = Logger.get()
+        rank = 0
+        if comm is not None:
+            rank = comm.rank
+        tmr = Timer()
+        if self._report_timing:
+            if comm is not None:
+                comm.Barrier()
+            tmr.start()
 
-            err = sim.observe(times[ind][good], az, el, atmdata, -1.0)
-            if err != 0:
-                # Observing failed
-                bad = np.abs(atmdata) < 1e-30
-                nbad = np.sum(bad)
-                log.error(
-                    "{}OpSimAtmosphere: Observing FAILED for {} ({:.2f} %) samples. "
-                    "det = {}, rank = {}".format(
-                        prefix, nbad, nbad * 100 / ngood, det, rank
-                    )
-                )
-                atmdata[bad] = 0
-                flag_ref[ind][good][bad] = 255
-                nbad_tot += nbad
-            ngood_tot += ngood
+        nsamp = tod.local_samples[1]
 
-            if self._gain:
-                atmdata *= self._gain
+        if rank == 0:
+            log.debug("{}Observing the atmosphere".format(prefix))
+
+        # Cache the output signal
+        refs = {}
+        for det in tod.local_dets:
+            cachename = "{}_{}".format(self._out, det)
+            if tod.cache.exists(cachename):
+                refs[det] = tod.cache.reference(cachename)
+            else:
+                refs[det] = tod.cache.create(cachename, np.float64, (nsamp,))
+
+        ngood_tot = 0
+        nbad_tot = 0
+
+        if azel is not None:
+            dets, samples, good, az, el = azel
+
+            # Integrate the signal of all detectors at once
+
+            atmdata = np.zeros(az.shape, dtype=np.float64)
+            err = sim.observe_many(times[samples], az, el, atmdata, good, -1.0)
+
+            for det, det_good, det_data in zip(dets, good, atmdata):
+                det_samples = samples[det_good]
+                det_data = det_data[det_good]
+                ngood = det_samples.size
+                if err != 0:
+                    # Observing may have failed
+                    bad = np.abs(det_data) < 1e-30
+                    nbad = np.sum(bad)
+                    if nbad > 0:
+                        log.error(
+                            "{}OpSimAtmosphere: Observing FAILED for {} ({:.2f} %) "
+                            "samples. det = {}, rank = {}".format(
+                                prefix, nbad, nbad * 100 / ngood, det, rank
+                            )
+                        )
+                        det_data[bad] = 0
+                        flag_ref = tod.local_flags(det, self._flag_name)
+                        flag_ref[det_samples[bad]] = 255
+                        del flag_ref
+                        nbad_tot += nbad
+                ngood_tot += ngood
+
+                if self._gain:
+                    det_data *= self._gain
 
-            if absorption is not None:
-                # Apply the frequency-dependent absorption-coefficient
-                atmdata *= absorption
+                if absorption is not None:
+                    # Apply the frequency-dependent absorption-coefficient
+                    det_data *= absorption
 
-            ref[ind][good] += atmdata
+                refs[det][det_samples] += det_data
+            del atmdata
 
-            del ref
+        del refs
 
         if comm is not None:
             comm.Barrier()
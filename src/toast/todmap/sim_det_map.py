@@ -18,6 +18,8 @@ from .._libtoast import scan_map_float64, scan_map_float32
 
 from ..op import Operator
 
+from .pointing import local_pointing_blocks
+
 
 class OpSimGradient(Operator):
     """Generate a fake sky signal as a gradient between the poles.
@@ -237,57 +239,57 @@ class OpSimScan(Operator):
                 else:
                     detector_map = input_map
 
-                # get the pixels and weights from the cache
-
-                pixelsname = "{}_{}".format(self._pixels, det)
-                weightsname = "{}_{}".format(self._weights, det)
-                pixels = tod.cache.reference(pixelsname)
-                weights = tod.cache.reference(weightsname)
+                cachename = "{}_{}".format(self._out, det)
+                if not tod.cache.exists(cachename):
+                    tod.cache.create(cachename, np.float64, (tod.local_samples[1],))
+                ref = tod.cache.reference(cachename)
 
-                nsamp, nnz = weights.shape
+                # get the local pixels and weights from the cache or expand
+                # them on demand
 
                 gt = GlobalTimers.get()
-                gt.start("OpSimScan.exec.global_to_local")
-                sm, lpix = detector_map.global_to_local(pixels)
-                gt.stop("OpSimScan.exec.global_to_local")
-
-                maptod = np.zeros(nsamp)
-                maptype = np.dtype(detector_map.dtype)
-                gt.start("OpSimScan.exec.scan_map")
-                if maptype.char == "d":
-                    scan_map_float64(
-                        detector_map.npix_submap,
-                        nnz,
-                        sm.astype(np.int64),
-                        lpix.astype(np.int64),
-                        detector_map.flatdata,
-                        weights.astype(np.float64).reshape(-1),
-                        maptod,
-                    )
-                elif maptype.char == "f":
-                    scan_map_float32(
-                        detector_map.npix_submap,
-                        nnz,
-                        sm.astype(np.int64),
-                        lpix.astype(np.int64),
-                        detector_map.flatdata,
-                        weights.astype(np.float64).reshape(-1),
-                        maptod,
-                    )
-                else:
-                    raise RuntimeError(
-                        "Scanning from a map only supports float32 and float64 maps"
-                    )
-                gt.stop("OpSimScan.exec.scan_map")
+                for bslice, sm, lpix, weights in local_pointing_blocks(
+                    obs,
+                    det,
+                    detector_map,
+                    pixels=self._pixels,
+                    weights=self._weights,
+                ):
+                    nsamp, nnz = weights.shape
+
+                    maptod = np.zeros(nsamp)
+                    maptype = np.dtype(detector_map.dtype)
+                    gt.start("OpSimScan.exec.scan_map")
+                    if maptype.char == "d":
+                        scan_map_float64(
+                            detector_map.npix_submap,
+                            nnz,
+                            sm,
+                            lpix,
+                            detector_map.flatdata,
+                            weights.astype(np.float64).reshape(-1),
+                            maptod,
+                        )
+                    elif maptype.char == "f":
+                        scan_map_float32(
+                            detector_map.npix_submap,
+                            nnz,
+                            sm,
+                            lpix,
+                            detector_map.flatdata,
+                            weights.astype(np.float64).reshape(-1),
+                            maptod,
+                        )
+                    else:
+                        raise RuntimeError(
+                            "Scanning from a map only supports float32 and float64 maps"
+                        )
+                    gt.stop("OpSimScan.exec.scan_map")
 
-                cachename = "{}_{}".format(self._out, det)
-                if not tod.cache.exists(cachename):
-                    tod.cache.create(cachename, np.float64, (nsamp,))
-                ref = tod.cache.reference(cachename)
-                ref[:] += maptod
+                    ref[bslice] += maptod
+
+                    del weights
 
                 del ref
-                del pixels
-                del weights
 
         return
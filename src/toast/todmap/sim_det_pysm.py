@@ -2,11 +2,13 @@
 # All rights reserved.  Use of this source code is governed by
 # a BSD-style license that can be found in the LICENSE file.
 
+import hashlib
+
 import numpy as np
 
 import healpy as hp
 
-from ..mpi import MPI
+from ..mpi import MPI, MPIShared
 
 from ..timing import function_timer
 
@@ -24,6 +26,9 @@ from ..map import DistPixels
 
 from .sim_det_map import OpSimScan
 
+# Number of frequencies used to sample the top hat bandpasses
+N_POINTS_BANDPASS = 10
+
 
 def extract_local_dets(data):
     """Extracts the local detectors from the TOD objects
@@ -152,22 +157,26 @@ class OpSimPySM(Operator):
         )
         self.apply_beam = apply_beam
 
-    @function_timer
-    def exec(self, data):
-        log = Logger.get()
-        rank = 0
-        if self.comm is not None:
-            rank = self.comm.rank
+    def _group_detectors(self, local_dets):
+        """Group detectors with identical bandpass and beam.
 
-        local_dets = extract_local_dets(data)
-        bandpasses = {}
-        fwhm_deg = {}
-        N_POINTS_BANDPASS = 10  # possibly take as parameter
-        for det in local_dets:
-            bandcenter, bandwidth, fwhm_deg[det] = extract_detector_parameters(
+        The groups are collected across the communicator so that every
+        process synthesizes the same skies in the same order.
+
+        Args:
+            local_dets (set):  The local detectors.
+
+        Returns:
+            (list):  List of (bandpass, fwhm_deg, detectors) tuples sorted by
+                the group key.
+
+        """
+        groups = {}
+        for det in sorted(local_dets):
+            bandcenter, bandwidth, fwhm_deg = extract_detector_parameters(
                 det, self.focalplanes
             )
-            bandpasses[det] = (
+            bandpass = (
                 np.linspace(
                     bandcenter - bandwidth / 2,
                     bandcenter + bandwidth / 2,
@@ -175,109 +184,160 @@ class OpSimPySM(Operator):
                 ),
                 np.ones(N_POINTS_BANDPASS),
             )
+            digest = hashlib.sha1(bandpass[0].tobytes())
+            digest.update(bandpass[1].tobytes())
+            key = (digest.hexdigest(), fwhm_deg)
+            if key not in groups:
+                groups[key] = (bandpass, fwhm_deg, set())
+            groups[key][2].add(det)
+        if self.comm is not None:
+            all_groups = self.comm.allgather(groups)
+            groups = {}
+            for proc_groups in all_groups:
+                for key, (bandpass, fwhm_deg, dets) in proc_groups.items():
+                    if key not in groups:
+                        groups[key] = (bandpass, fwhm_deg, set())
+                    groups[key][2].update(dets)
+        return [
+            (bandpass, fwhm_deg, sorted(dets))
+            for key, (bandpass, fwhm_deg, dets) in sorted(groups.items())
+        ]
 
-        if rank == 0:
-            log.debug("Collecting, Broadcasting map")
-        tm = Timer()
-        tm.start()
+    @function_timer
+    def _synthesize(self, name, bandpass, fwhm_deg):
+        """Synthesize, smooth and assemble the sky of one detector group.
 
-        for det in local_dets:
-            local_maps = dict()
-            if self.comm is not None:
-                self.comm.Barrier()
-            if rank == 0:
-                log.debug("Running PySM on {}".format(det))
-            self.pysm_sky.exec(local_maps, out="sky", bandpasses={det: bandpasses[det]})
-
-            if self.apply_beam:
-                if fwhm_deg[det] == -1:
-                    raise RuntimeError(
-                        "OpSimPySM: apply beam is True but focalplane doesn't "
-                        "have fwhm"
-                    )
-                # LibSharp also supports transforming multiple channels
-                # together each with own beam
-                if self.comm is not None:
-                    self.comm.Barrier()
-                if rank == 0:
-                    log.debug("Executing Smoothing with libsharp on {}".format(det))
-                local_maps[
-                    "sky_{}".format(det)
-                ] = pysm.apply_smoothing_and_coord_transform(
-                    local_maps["sky_{}".format(det)],
-                    fwhm=fwhm_deg[det] * u.deg,
-                    map_dist=self.pysm_sky.map_dist,
+        Returns:
+            (array):  The full 3 x npix map on the root process, None
+                elsewhere.
+
+        """
+        log = Logger.get()
+        rank = 0
+        if self.comm is not None:
+            rank = self.comm.rank
+        local_maps = dict()
+        if rank == 0:
+            log.debug("Running PySM on {}".format(name))
+        self.pysm_sky.exec(local_maps, out="sky", bandpasses={name: bandpass})
+        sky_name = "sky_{}".format(name)
+
+        if self.apply_beam:
+            if fwhm_deg == -1:
+                raise RuntimeError(
+                    "OpSimPySM: apply beam is True but focalplane doesn't have fwhm"
                 )
-                if self.comm is not None:
-                    self.comm.Barrier()
-                if rank == 0:
-                    log.debug("Smoothing completed on {}".format(det))
+            # LibSharp also supports transforming multiple channels
+            # together each with own beam
+            if rank == 0:
+                log.debug("Executing Smoothing with libsharp on {}".format(name))
+            local_maps[sky_name] = pysm.apply_smoothing_and_coord_transform(
+                local_maps[sky_name],
+                fwhm=fwhm_deg * u.deg,
+                map_dist=self.pysm_sky.map_dist,
+            )
 
-            n_components = 3
+        n_components = 3
 
-            if self.comm is not None:
-                self.comm.Barrier()
-            if rank == 0:
-                log.debug(
-                    "Assemble PySM map on rank0, shape of local map is {}".format(
-                        local_maps["sky_{}".format(det)].shape
-                    )
+        if rank == 0:
+            log.debug(
+                "Assemble PySM map on rank0, shape of local map is {}".format(
+                    local_maps[sky_name].shape
                 )
-            full_map_rank0 = assemble_map_on_rank0(
-                self.comm,
-                local_maps["sky_{}".format(det)],
-                np.arange(len(local_maps["sky_{}".format(det)][0]))
-                if self.comm is None
-                else self.pysm_sky.map_dist.pixel_indices,
-                n_components,
-                self.npix,
             )
-
-            if self.comm is not None:
-                self.comm.Barrier()
-            if rank == 0:
-                log.debug("Communication completed")
-            if rank == 0 and self.coord != "G":
-                # PySM is always in Galactic, make rotation to Ecliptic or Equatorial
-                rot = hp.Rotator(coord=["G", self.coord])
-                # this requires healpy 1.12.8
-                try:
-                    full_map_rank0 = rot.rotate_map_alms(
-                        full_map_rank0, use_pixel_weights=True
-                    )
-                except AttributeError:
-                    print(
-                        "PySM coordinate conversion from G to another reference frame requires"
-                        "healpy.Rotator.rotate_map_alms available since healpy 1.12.8"
-                    )
-                    raise
-            if rank == 0 and self._nest:
-                # PySM is RING, convert to NEST if desired.
-                full_map_rank0 = hp.reorder(full_map_rank0, r2n=True)
-            # full_map_rank0 dict contains on rank 0 the smoothed PySM map
-
-            if self.comm is not None:
-                self.comm.Barrier()
-            if rank == 0:
-                log.debug(
-                    "PySM map min / max pixel value = {} / {}".format(
-                        hp.ma(full_map_rank0).min(), hp.ma(full_map_rank0).max()
-                    )
+        full_map_rank0 = assemble_map_on_rank0(
+            self.comm,
+            local_maps[sky_name],
+            np.arange(len(local_maps[sky_name][0]))
+            if self.comm is None
+            else self.pysm_sky.map_dist.pixel_indices,
+            n_components,
+            self.npix,
+        )
+        del local_maps
+
+        if rank == 0 and self.coord != "G":
+            # PySM is always in Galactic, make rotation to Ecliptic or Equatorial
+            rot = hp.Rotator(coord=["G", self.coord])
+            # this requires healpy 1.12.8
+            try:
+                full_map_rank0 = rot.rotate_map_alms(
+                    full_map_rank0, use_pixel_weights=True
                 )
-                log.debug("Broadcasting the map to other processes")
-            self.distmap.broadcast_healpix_map(full_map_rank0)
-            if rank == 0:
-                log.debug("Running OpSimScan")
-            scansim = OpSimScan(input_map=self.distmap, out=self._out, dets=[det])
-            scansim.exec(data)
-            if rank == 0:
-                tod = data.obs[0]["tod"]
-                sig = tod.cache.reference(self._out + "_" + det)
-                log.debug(
-                    "Rank 0 timeline min / max after smoothing = {} / {}".format(
-                        sig.min(), sig.max()
-                    )
+            except AttributeError:
+                print(
+                    "PySM coordinate conversion from G to another reference frame requires"
+                    "healpy.Rotator.rotate_map_alms available since healpy 1.12.8"
+                )
+                raise
+        if rank == 0 and self._nest:
+            # PySM is RING, convert to NEST if desired.
+            full_map_rank0 = hp.reorder(full_map_rank0, r2n=True)
+        if rank == 0:
+            full_map_rank0 = np.asarray(full_map_rank0, dtype=np.float64)
+            log.debug(
+                "PySM map min / max pixel value = {} / {}".format(
+                    hp.ma(full_map_rank0).min(), hp.ma(full_map_rank0).max()
+                )
+            )
+        return full_map_rank0
+
+    def _fill_distmap(self, full_map):
+        """Copy the local submaps out of the node-shared full map."""
+        if self.distmap.data is None:
+            return
+        npix_submap = self.distmap.npix_submap
+        for ilocal, isubmap in enumerate(self.distmap.local_submaps):
+            first = isubmap * npix_submap
+            last = min(first + npix_submap, self.npix)
+            self.distmap.data[ilocal, : last - first, :] = full_map[:, first:last].T
+            # Pixels past the end of the map in a partial last submap
+            self.distmap.data[ilocal, last - first :, :] = 0
+        return
+
+    @function_timer
+    def exec(self, data):
+        """Synthesize the sky once per detector group and scan it.
+
+        Detectors with the same bandpass and beam see the same sky.  Each
+        group sky is assembled on the root process and copied once into a
+        node-shared full map, from which every process extracts its local
+        submaps before scanning the local detectors of the group.
+
+        Args:
+            data (toast.Data): The distributed data.
+
+        """
+        log = Logger.get()
+        rank = 0
+        if self.comm is not None:
+            rank = self.comm.rank
+
+        local_dets = extract_local_dets(data)
+        groups = self._group_detectors(local_dets)
+
+        tm = Timer()
+        tm.start()
+
+        with MPIShared((3, self.npix), np.float64, self.comm) as full_map:
+            for igroup, (bandpass, fwhm_deg, dets) in enumerate(groups):
+                name = "group{}".format(igroup)
+                full_map_rank0 = self._synthesize(name, bandpass, fwhm_deg)
+                if rank == 0:
+                    log.debug("Sharing the map of {} detectors".format(len(dets)))
+                full_map.set(full_map_rank0, (0, 0), fromrank=0)
+                del full_map_rank0
+                self._fill_distmap(full_map)
+
+                scan_dets = [det for det in dets if det in local_dets]
+                if len(scan_dets) == 0:
+                    continue
+                if rank == 0:
+                    log.debug("Running OpSimScan")
+                scansim = OpSimScan(
+                    input_map=self.distmap, out=self._out, dets=scan_dets
                 )
+                scansim.exec(data)
 
         tm.stop()
         if rank == 0:
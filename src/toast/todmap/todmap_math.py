@@ -11,18 +11,17 @@ from ..op import Operator
 
 from .. import qarray as qa
 
-from .._libtoast import (
-    cov_accum_diag,
-    cov_accum_zmap,
-    cov_accum_diag_hits,
-    cov_accum_diag_invnpp,
-    scan_map_float64,
-    scan_map_float32,
-    apply_flags_to_pixels,
-)
+from .._libtoast import cov_accum_diag_flagged, scan_map_float64, scan_map_float32
 
 from ..map import DistPixels
 
+from .pointing import pointing_blocks
+
+
+# Pointing types accumulated without conversion
+_accum_pixel_types = (np.dtype(np.int64), np.dtype(np.int32))
+_accum_weight_types = (np.dtype(np.float64), np.dtype(np.float32))
+
 
 class OpAccumDiag(Operator):
     """Operator which accumulates the diagonal covariance and noise weighted map.
@@ -111,6 +110,13 @@ class OpAccumDiag(Operator):
 
         self._globloc = None
 
+        # Placeholders for the disabled inputs and outputs
+        self._empty = {
+            np.uint8: np.empty(0, dtype=np.uint8),
+            np.int64: np.empty(0, dtype=np.int64),
+            np.float64: np.empty(0, dtype=np.float64),
+        }
+
         if zmap is not None:
             self._do_z = True
             self._nsub = zmap.nsubmap
@@ -205,8 +211,6 @@ class OpAccumDiag(Operator):
         for obs in data.obs:
             tod = obs["tod"]
 
-            nsamp = tod.local_samples[1]
-
             commonflags = None
             if self._apply_flags:
                 commonflags = tod.local_common_flags(self._common_flag_name).copy()
@@ -215,41 +219,6 @@ class OpAccumDiag(Operator):
                 if self._detectors is not None and det not in self._detectors:
                     continue
 
-                # get the pixels and weights from the cache
-
-                pixelsname = "{}_{}".format(self._pixels, det)
-                weightsname = "{}_{}".format(self._weights, det)
-                pixels = tod.cache.reference(pixelsname)
-                weights = tod.cache.reference(weightsname)
-
-                cachename = None
-                signal = None
-
-                if self._do_z:
-                    signal = tod.local_signal(det, self._name)
-
-                # get flags
-
-                if self._apply_flags:
-                    gt.start("OpAccumDiag.exec.apply_flags")
-                    # Don't change the cached pixel numbers
-                    pixels = pixels.astype(np.int64).copy()
-                    detflags = tod.local_flags(det, self._flag_name)
-                    apply_flags_to_pixels(
-                        commonflags.astype(np.uint8),
-                        np.uint8(self._common_flag_mask),
-                        detflags.astype(np.uint8),
-                        np.uint8(self._flag_mask),
-                        pixels,
-                    )
-                    gt.stop("OpAccumDiag.exec.apply_flags")
-
-                # local pointing
-
-                gt.start("OpAccumDiag.exec.global_to_local")
-                sm, lpix = self._globloc.global_to_local(pixels)
-                gt.stop("OpAccumDiag.exec.global_to_local")
-
                 detweight = 1.0
 
                 if self._detweights is not None:
@@ -261,88 +230,98 @@ class OpAccumDiag(Operator):
                     if detweight == 0:
                         continue
 
-                # Now call the correct accumulation operator depending
-                # on which input pixel objects were given.
-
-                if self._do_invn and self._do_z:
-                    invnpp = self._invnpp.flatdata
-                    if invnpp is None:
-                        invnpp = np.empty(shape=0, dtype=np.float64)
-                    zmap = self._zmap.flatdata
-                    if zmap is None:
-                        zmap = np.empty(shape=0, dtype=np.float64)
-                    hits = self._hits.flatdata
-                    if hits is None:
-                        hits = np.empty(shape=0, dtype=np.int64)
-                    cov_accum_diag(
-                        self._nsub,
-                        self._subsize,
-                        self._nnz,
-                        sm.astype(np.int64),
-                        lpix.astype(np.int64),
-                        weights.reshape(-1).astype(np.float64),
-                        detweight,
-                        signal,
-                        invnpp,
-                        hits,
-                        zmap,
-                    )
+                fullsignal = None
 
-                elif self._do_invn:
-                    invnpp = self._invnpp.flatdata
-                    if invnpp is None:
-                        invnpp = np.empty(shape=0, dtype=np.float64)
-                    hits = self._hits.flatdata
-                    if hits is None:
-                        hits = np.empty(shape=0, dtype=np.int64)
-                    cov_accum_diag_invnpp(
-                        self._nsub,
-                        self._subsize,
-                        self._nnz,
-                        sm.astype(np.int64),
-                        lpix.astype(np.int64),
-                        weights.reshape(-1).astype(np.float64),
-                        detweight,
-                        invnpp,
-                        hits,
-                    )
+                if self._do_z:
+                    fullsignal = tod.local_signal(det, self._name)
 
-                elif self._do_z:
-                    zmap = self._zmap.flatdata
-                    if zmap is None:
-                        zmap = np.empty(shape=0, dtype=np.float64)
-                    cov_accum_zmap(
-                        self._nsub,
-                        self._subsize,
-                        self._nnz,
-                        sm.astype(np.int64),
-                        lpix.astype(np.int64),
-                        weights.reshape(-1).astype(np.float64),
-                        detweight,
+                detflags = None
+                if self._apply_flags:
+                    detflags = tod.local_flags(det, self._flag_name)
+
+                # get the pixels and weights from the cache or expand them
+                # on demand
+
+                for bslice, pixels, weights in pointing_blocks(
+                    obs, det, pixels=self._pixels, weights=self._weights
+                ):
+                    signal = None
+                    if self._do_z:
+                        signal = fullsignal[bslice]
+                    self._accumulate(
+                        gt,
+                        pixels,
+                        weights,
                         signal,
-                        zmap,
+                        commonflags,
+                        detflags,
+                        bslice,
+                        detweight,
                     )
 
-                elif self._do_hits:
-                    hits = self._hits.flatdata
-                    if hits is None:
-                        hits = np.empty(shape=0, dtype=np.int64)
-                    cov_accum_diag_hits(
-                        self._nsub,
-                        self._subsize,
-                        self._nnz,
-                        sm.astype(np.int64),
-                        lpix.astype(np.int64),
-                        hits,
-                    )
+                del fullsignal
+                del detflags
+
+        return
 
-                # print("det {}:".format(det))
-                # if self._zmap is not None:
-                #     print(self._zmap.data)
-                # if self._hits is not None:
-                #     print(self._hits.data)
-                # if self._invnpp is not None:
-                #     print(self._invnpp.data)
+    def _accumulate(
+        self, gt, pixels, weights, signal, commonflags, detflags, bslice, detweight
+    ):
+        """Accumulate one block of samples of one detector.
+
+        The flags, the global to local pixel translation and the
+        accumulation are applied in a single compiled pass over the native
+        precision pixels and weights, so no per-detector temporaries are
+        needed.
+
+        """
+        glob2loc = self._globloc.glob2loc
+        if glob2loc is None:
+            # No local submaps
+            return
+
+        gt.start("OpAccumDiag.exec.accumulate")
+
+        if pixels.dtype not in _accum_pixel_types:
+            pixels = pixels.astype(np.int64)
+        if weights.dtype not in _accum_weight_types:
+            weights = weights.astype(np.float64)
+
+        empty_u8 = self._empty[np.uint8]
+        empty_f64 = self._empty[np.float64]
+        common_mask = np.uint8(self._common_flag_mask)
+        det_mask = np.uint8(self._flag_mask)
+        if self._apply_flags:
+            common = np.asarray(commonflags[bslice], dtype=np.uint8)
+            det = np.asarray(detflags[bslice], dtype=np.uint8)
+        else:
+            common = empty_u8
+            det = empty_u8
+
+        def flat(pixelmap, do_accum, dtype):
+            if not do_accum or pixelmap.flatdata is None:
+                return self._empty[dtype]
+            return pixelmap.flatdata
+
+        cov_accum_diag_flagged(
+            self._nsub,
+            self._subsize,
+            self._nnz,
+            pixels,
+            weights,
+            common,
+            common_mask,
+            det,
+            det_mask,
+            glob2loc,
+            detweight,
+            (signal if self._do_z else empty_f64),
+            flat(self._invnpp, self._do_invn, np.float64),
+            flat(self._hits, self._do_hits, np.int64),
+            flat(self._zmap, self._do_z, np.float64),
+        )
+
+        gt.stop("OpAccumDiag.exec.accumulate")
 
         return
 